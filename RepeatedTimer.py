@@ -1,26 +1,37 @@
-from threading import Timer
+from scheduler import sharedScheduler
 
 class RepeatedTimer(object):
+    """Call function every interval seconds at a fixed rate, as a job on the
+       shared scheduler thread."""
+
     def __init__(self, interval, function, *args, **kwargs):
-        self._timer     = None
-        self.interval   = interval
+        self._job       = None
+        self._interval  = interval
         self.function   = function
         self.args       = args
         self.kwargs     = kwargs
         self.is_running = False
 
+    @property
+    def interval(self):
+        return self._interval
+
+    @interval.setter
+    def interval(self, interval):
+        self._interval = interval
+        if self._job is not None:
+            self._job.interval = interval
+
     def _run(self):
-        self.is_running = False
-        self.start()
         self.function(*self.args, **self.kwargs)
 
     def start(self):
         if not self.is_running:
-            self._timer = Timer(self.interval, self._run)
-            self._timer.start()
+            self._job = sharedScheduler().every(self._interval, self._run)
             self.is_running = True
 
     def stop(self):
-        self._timer.cancel()
+        if self._job is not None:
+            self._job.cancel()
+            self._job = None
         self.is_running = False
-
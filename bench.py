@@ -0,0 +1,310 @@
+"""Benchmarks for the acquisition, storage and analysis hot paths.
+
+Run from this directory:
+
+    python bench.py [--output results.json] [--baseline baseline.json]
+                    [--only insert,codec] [--constrained]
+
+Each case is timed over the spectra in samples/ for at least --min-time
+seconds, three times, and the best rate is kept. Results are printed and,
+with --output, written as JSON. With --baseline, each rate is compared with
+the one saved in an earlier run, and the exit status is 1 if any case is
+more than --tolerance slower, so a regression shows up before the board
+starts missing 2 second windows.
+
+The insert case writes through HistogramWriter into a temporary copy of
+histograms, so it needs a database with the schema loaded; by default a
+throwaway radiation_bench database:
+
+    createdb -O radiation radiation_bench
+    psql --user=radiation --host=localhost -W -f psql-update radiation_bench
+
+It is skipped if the database can't be reached.
+
+--constrained approximates the BeagleBone: the run is pinned to one CPU
+(with taskset), its address space is capped at --memory megabytes, and it
+is only allowed to run for --cpu-share of the time, by stopping and
+continuing the process every few milliseconds.
+"""
+
+import argparse, datetime, glob, importlib, json, os, platform, resource
+import signal, sys, time
+import numpy as np
+import psycopg2
+import getEnergy
+from identify import Identifier
+from util import histCodec
+from util.geofence import Geofence
+from util.gpsd import GPS
+from util.histWriter import HistogramWriter
+from util.monotonic import monotonic
+from util.simTools import sampleSpectrum
+
+csvImport = importlib.import_module("util.import")
+
+SAMPLES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "samples",
+                       "*.csv")
+
+BASE = (30.314745493, -97.719284377)
+
+def loadSpectra(pattern=SAMPLES):
+    return [np.loadtxt(path, delimiter=",").astype(np.int64)
+            for path in sorted(glob.glob(pattern))]
+
+def fakeSample(hist, index):
+    """A sample dict as headlessMonitor queues it."""
+    return {"longitude": BASE[1] + index * 1e-5, "latitude": BASE[0],
+            "hdop": 2.5, "sampletime": 2, "temp": 35.0, "cps": hist.sum() / 2.0,
+            "histogram": hist.tolist(), "altitude": 150.0, "sensor": 0,
+            "version": 0.9,
+            "time": datetime.datetime(2014, 5, 1, 12, 0, index % 60)}
+
+# Each case takes the spectra and returns (unit, function); function runs
+# one pass and returns the number of units it processed.
+
+def benchInsert(spectra, args):
+    conn = psycopg2.connect(database = args.database, user = "radiation",
+                            password = "radiation", host = "localhost")
+    cur = conn.cursor()
+    cur.execute("CREATE TEMP TABLE histograms " +
+                "(LIKE public.histograms INCLUDING DEFAULTS)")
+    conn.commit()
+    writer = HistogramWriter(batchSize=30)
+    writer.conn = conn
+    samples = [fakeSample(spectra[i % len(spectra)], i) for i in range(30)]
+
+    def run():
+        writer.pending = list(samples)
+        if not writer.flush():
+            raise RuntimeError("Insert failed")
+        return len(samples)
+    return "rows", run
+
+def benchCodec(spectra, args):
+    def run():
+        for hist in spectra:
+            histCodec.decode(histCodec.encode(hist))
+        return len(spectra)
+    return "spectra", run
+
+def benchCalibrate(spectra, args):
+    bins = np.arange(4096)
+    temps = np.linspace(30, 44, len(spectra))
+
+    def run():
+        for hist, temp in zip(spectra, temps):
+            energies = getEnergy.tempGain(temp, bins)
+            np.histogram(energies, bins=3000, range=(0, 3000), weights=hist)
+        return len(spectra)
+    return "spectra", run
+
+def benchRebin(spectra, args):
+    hists = np.array(spectra)
+    temps = np.linspace(30, 44, len(spectra))
+    grid = np.arange(0, 3001, 1.0)
+
+    def run():
+        getEnergy.defaultCalibration.rebin(hists, temps, grid)
+        return len(spectra)
+    return "spectra", run
+
+def benchSampleSpectrum(spectra, args):
+    random = np.random.RandomState(1)
+
+    def run():
+        for hist in spectra:
+            sampleSpectrum(hist, random)
+        return len(spectra)
+    return "spectra", run
+
+def benchCSVIngest(spectra, args):
+    lines = []
+    for i, hist in enumerate(spectra * 10):
+        lines.append("%r,%r,2.5,2014-05-01T12:00:%02d,2,35.0,%r,%s\n" %
+                     (BASE[0], BASE[1] + i * 1e-5, i % 60, hist.sum() / 2.0,
+                      ",".join(str(count) for count in hist)))
+
+    def run():
+        text, rows, skipped = csvImport.parseChunk((lines, "array"))
+        return rows
+    return "rows", run
+
+def benchNMEA(spectra, args):
+    gps = GPS("/dev/null")
+    sentences = ["$GPGGA,%02d%02d%02d.00,3018.8847,N,09743.1571,W,1,08,0.9," %
+                 (12, i // 60, i % 60) + "150.0,M,-22.0,M,,*47\r\n"
+                 for i in range(600)]
+
+    def run():
+        for sentence in sentences:
+            gps.currentLocation = sentence
+            gps.getLocation()
+        return len(sentences)
+    return "sentences", run
+
+def benchGeofence(spectra, args):
+    fence = Geofence.fromConfig({"baseCoords": {"latitude": BASE[0],
+                                                "longitude": BASE[1],
+                                                "range": 100}})
+    random = np.random.RandomState(2)
+    points = zip(BASE[0] + random.uniform(-0.01, 0.01, 1000),
+                 BASE[1] + random.uniform(-0.01, 0.01, 1000))
+
+    def run():
+        for latitude, longitude in points:
+            fence.update(latitude, longitude)
+        return len(points)
+    return "fixes", run
+
+def benchIdentify(spectra, args):
+    ident = Identifier()
+    hists = np.array(spectra * 50)
+    temps = np.linspace(30, 44, len(hists))
+
+    def run():
+        ident.fit(hists, temps, 2)
+        return len(hists)
+    return "spectra", run
+
+CASES = [("insert", benchInsert),
+         ("codec", benchCodec),
+         ("calibrate", benchCalibrate),
+         ("rebin", benchRebin),
+         ("sample-spectrum", benchSampleSpectrum),
+         ("csv-ingest", benchCSVIngest),
+         ("nmea", benchNMEA),
+         ("geofence", benchGeofence),
+         ("identify", benchIdentify)]
+
+def measure(run, minTime, rounds=3):
+    """Return the best rate, in units per second, over rounds of at least
+       minTime seconds each."""
+    best = 0.0
+    for _ in range(rounds):
+        units = 0
+        started = monotonic()
+        while True:
+            units += run()
+            elapsed = monotonic() - started
+            if elapsed >= minTime:
+                break
+        best = max(best, units / elapsed)
+    return best
+
+def compare(results, baseline, tolerance):
+    """Print each case's change from the baseline. Returns the names of the
+       cases that got slower by more than tolerance."""
+    regressions = []
+    for name, result in sorted(results.items()):
+        before = baseline.get("results", {}).get(name)
+        if before is None:
+            continue
+        change = result["rate"] / before["rate"] - 1
+        flag = ""
+        if change < -tolerance:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print "%-16s %12.1f -> %12.1f %s/s %+7.1f%%%s" % \
+              (name, before["rate"], result["rate"], result["unit"],
+               100 * change, flag)
+    return regressions
+
+def throttle(pid, share, period=0.02):
+    """Fork a process that lets pid run only share of the time. Returns the
+       throttler's pid."""
+    child = os.fork()
+    if child:
+        return child
+    try:
+        while True:
+            time.sleep(period * share)
+            os.kill(pid, signal.SIGSTOP)
+            time.sleep(period * (1 - share))
+            os.kill(pid, signal.SIGCONT)
+    except OSError:
+        pass
+    finally:
+        os._exit(0)
+
+def constrain(args):
+    """Apply the --constrained limits, re-running under taskset if needed.
+       The benchmarks then run in a throttled child process, and this only
+       returns in that child; the parent waits for it and exits with its
+       status. (Stopping the parent itself would look like ^Z to the
+       shell.)"""
+    if os.environ.get("BENCH_PINNED") != "1":
+        os.environ["BENCH_PINNED"] = "1"
+        try:
+            os.execvp("taskset", ["taskset", "-c", "0", sys.executable] +
+                      sys.argv)
+        except OSError:
+            print "taskset not found; not pinning to one CPU"
+    megabytes = args.memory * 1024 * 1024
+    resource.setrlimit(resource.RLIMIT_AS, (megabytes, megabytes))
+    sys.stdout.flush()
+    worker = os.fork()
+    if worker == 0:
+        return
+    throttler = throttle(worker, args.cpu_share)
+    status = os.waitpid(worker, 0)[1]
+    os.kill(throttler, signal.SIGKILL)
+    os.waitpid(throttler, 0)
+    sys.exit(os.WEXITSTATUS(status) if os.WIFEXITED(status) else 1)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--output", help="write results to this JSON file")
+    parser.add_argument("--baseline", help="compare with this JSON file")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="slowdown counted as a regression (default 0.1)")
+    parser.add_argument("--only", help="comma-separated cases to run")
+    parser.add_argument("--min-time", type=float, default=0.5,
+                        help="seconds to time each case for, per round")
+    parser.add_argument("--database", default="radiation_bench",
+                        help="database for the insert case")
+    parser.add_argument("--constrained", action="store_true",
+                        help="approximate the BeagleBone's resources")
+    parser.add_argument("--memory", type=int, default=512,
+                        help="address space limit in MB when constrained")
+    parser.add_argument("--cpu-share", type=float, default=0.25,
+                        help="share of one CPU allowed when constrained")
+    args = parser.parse_args()
+
+    if args.constrained:
+        constrain(args)
+    only = args.only.split(",") if args.only else None
+    spectra = loadSpectra()
+    results = {}
+    for name, case in CASES:
+        if only is not None and name not in only:
+            continue
+        try:
+            unit, run = case(spectra, args)
+        except psycopg2.Error as error:
+            print "%-16s skipped: %s" % (name, str(error).strip())
+            continue
+        rate = measure(run, args.min_time)
+        results[name] = {"unit": unit, "rate": rate, "perUnit": 1 / rate}
+        print "%-16s %12.1f %s/s %10.1f us each" % (name, rate, unit,
+                                                     1e6 / rate)
+
+    report = {"time": datetime.datetime.utcnow().isoformat() + "Z",
+              "host": platform.node(), "platform": platform.platform(),
+              "python": platform.python_version(), "numpy": np.__version__,
+              "constrained": {"memory": args.memory,
+                              "cpuShare": args.cpu_share}
+                             if args.constrained else None,
+              "results": results}
+    if args.output:
+        with open(args.output, "w") as out:
+            json.dump(report, out, indent=1, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as saved:
+            baseline = json.load(saved)
+        if bool(baseline.get("constrained")) != args.constrained:
+            print "Warning: baseline and this run differ in --constrained"
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
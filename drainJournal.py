@@ -0,0 +1,74 @@
+"""Write a sample journal's backlog to histograms and compact it.
+
+headlessMonitor drains its journal (see util/journal.py) by itself whenever
+the database is healthy. This is for a journal the monitor isn't running on:
+after a crash, or from an SD card brought back to the server. Records already
+acknowledged in journal_acks are skipped, so draining twice, or draining a
+journal the monitor had partly written, inserts nothing twice.
+
+Apply sql/journal.sql first. Run from this directory, with the monitor
+stopped (the journal is locked while it runs):
+
+    python drainJournal.py /home/debian/journal
+    python drainJournal.py /home/debian/journal --compact
+    python drainJournal.py /home/debian/journal --info
+"""
+
+import argparse, json, os, sys
+from util.histWriter import HistogramWriter, configuredColumns
+from util.journal import Journal
+
+CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      "radmonitor.config")
+
+def printInfo(journal):
+    info = journal.info()
+    print "Journal %(id)s in %(directory)s" % info
+    print "%(segments)d segments, %(bytes)d bytes" % info
+    print "Records %s to %d, acknowledged to %d, %d waiting" % \
+          (info["firstSeq"], info["nextSeq"] - 1, info["acked"],
+           info["backlog"])
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("directory", help="journal directory")
+    parser.add_argument("--batch", type=int, default=500,
+                        help="records written per transaction")
+    parser.add_argument("--compact", action="store_true",
+                        help="afterwards, delete acknowledged segments")
+    parser.add_argument("--info", action="store_true",
+                        help="describe the journal and exit")
+    args = parser.parse_args()
+
+    if args.info:
+        journal = Journal(args.directory, readOnly=True)
+        printInfo(journal)
+        journal.close()
+        return
+
+    with open(CONFIG) as config:
+        config = json.load(config)
+    journal = Journal(args.directory)
+    writer = HistogramWriter(batchSize=args.batch,
+                             storage=config.get("histogramStorage", "array"),
+                             extraColumns=configuredColumns(config),
+                             partitioned=config.get("partitioned", False),
+                             journal=journal, database='radiation',
+                             user='radiation', password='radiation',
+                             host='localhost')
+    print "Draining %d records" % journal.backlog()
+    drained = writer.drain()
+    if writer.conn is not None:
+        writer.conn.close()
+    print "Wrote %d rows" % writer.rowsWritten
+    if journal.corrupt:
+        print "Skipped %d corrupt records" % journal.corrupt
+    if args.compact:
+        print "Removed %d segments" % journal.compact()
+    printInfo(journal)
+    journal.close()
+    if not drained:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1,30 +1,163 @@
+"""Temperature-dependent energy calibration.
+
+The detector gain drifts with temperature, so the keV value of a bin depends
+on the temperature recorded with the spectrum. Calibration bands give a linear
+bin -> keV fit for each temperature range:
+
+    [upper temperature, slope, intercept]
+
+where a band applies below its upper temperature (and at or above the previous
+band's); the last band has an upper temperature of null. Bands can be set per
+eMorpho compression setting in the "calibration" section of radmonitor.config,
+keyed by compression, with "default" used for any other compression.
+defaultCalibration, which tempGain, identify.py and reprocess.py use, is
+read from radmonitor.config when this module loads; without a config the
+fits below are used.
+
+Calibration works on whole spectra or (N x bins) batches at once: the band
+lookup is a searchsorted over the temperatures and the per-band tables are
+built once and cached, so a day of rows is converted in a few NumPy passes.
+"""
+
+import json, os
 import psycopg2
+import numpy as np
+
+CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      "radmonitor.config")
+
+DEFAULT_BANDS = [[32, 1.28, -9.83],
+                 [38, 1.34, -12.02],
+                 [40, 1.37, -13.41],
+                 [42, 1.38, -10.06],
+                 [None, 1.43, -12.96]]
+
+class Calibration(object):
+    """Vectorized bin -> keV conversion for batches of spectra."""
+
+    def __init__(self, bands=None):
+        if bands is None:
+            bands = {"default": DEFAULT_BANDS}
+        self.bands = dict((str(key), value) for key, value in bands.items())
+        self._tables = {}
+        self._bins = {}
+
+    @classmethod
+    def fromConfig(cls, config):
+        """Build a Calibration from a loaded radmonitor.config dict."""
+        return cls(config.get("calibration"))
+
+    def table(self, compression=None):
+        """Return cached (upper temperatures, slopes, intercepts) arrays for
+           a compression setting."""
+        key = str(compression)
+        if key not in self.bands:
+            key = "default"
+        if key not in self._tables:
+            bands = self.bands[key]
+            upper = np.array([np.inf if band[0] is None else band[0]
+                              for band in bands], dtype=float)
+            slopes = np.array([band[1] for band in bands], dtype=float)
+            intercepts = np.array([band[2] for band in bands], dtype=float)
+            if np.any(np.diff(upper) <= 0) or upper[-1] != np.inf:
+                raise ValueError("Calibration bands for %s must be in " % key +
+                                 "increasing temperature order and end " +
+                                 "with an open (null) band")
+            self._tables[key] = (upper, slopes, intercepts)
+        return self._tables[key]
+
+    def coefficients(self, temps, compression=None):
+        """Return slope and intercept arrays for an array of temperatures.
+           compression is either one setting or an array matching temps."""
+        temps = np.asarray(temps, dtype=float)
+        slopes = np.empty(temps.shape)
+        intercepts = np.empty(temps.shape)
+        if np.ndim(compression) == 0:
+            groups = [(compression, Ellipsis)]
+        else:
+            compression = np.asarray(compression)
+            groups = [(value, compression == value)
+                      for value in np.unique(compression)]
+        for value, rows in groups:
+            upper, bandSlopes, bandIntercepts = self.table(value)
+            # An unknown (NaN) temperature sorts past the open last band;
+            # use that band, as for any temperature above the others
+            band = np.minimum(np.searchsorted(upper, temps[rows],
+                                              side="right"), len(upper) - 1)
+            slopes[rows] = bandSlopes[band]
+            intercepts[rows] = bandIntercepts[band]
+        return slopes, intercepts
+
+    def _binIndex(self, bins):
+        if bins not in self._bins:
+            self._bins[bins] = np.arange(bins + 1, dtype=float)
+        return self._bins[bins]
+
+    def energy(self, temps, bins, compression=None):
+        """keV value of the given bin positions; broadcasts like NumPy."""
+        slopes, intercepts = self.coefficients(temps, compression)
+        return slopes * np.asarray(bins) + intercepts
+
+    def binEdges(self, temps, bins=4096, compression=None):
+        """Return the keV edges of every bin: shape (bins + 1,) for a single
+           temperature or (N, bins + 1) for N temperatures."""
+        slopes, intercepts = self.coefficients(temps, compression)
+        index = self._binIndex(bins)
+        return slopes[..., np.newaxis] * index + intercepts[..., np.newaxis]
+
+    def rebin(self, hists, temps, grid, compression=None, chunk=4096):
+        """Resample spectra onto common keV bin edges.
+
+           hists is (bins,) or (N, bins), temps a matching scalar or (N,)
+           array and grid an increasing array of M + 1 keV edges. Counts are
+           redistributed assuming they are spread evenly across each source
+           bin, so totals inside the grid are preserved. Returns (M,) or
+           (N, M) floats. Rows are processed chunk at a time to bound memory.
+        """
+        hists = np.asarray(hists, dtype=float)
+        single = hists.ndim == 1
+        hists = np.atleast_2d(hists)
+        temps = np.atleast_1d(np.asarray(temps, dtype=float))
+        grid = np.asarray(grid, dtype=float)
+        if np.ndim(compression) != 0:
+            compression = np.atleast_1d(compression)
+        count, bins = hists.shape
+        out = np.empty((count, len(grid) - 1))
+
+        for start in range(0, count, chunk):
+            rows = slice(start, start + chunk)
+            block = hists[rows]
+            comp = compression if np.ndim(compression) == 0 \
+                   else compression[rows]
+            slopes, intercepts = self.coefficients(temps[rows], comp)
+            cumulative = np.zeros((len(block), bins + 1))
+            np.cumsum(block, axis=1, out=cumulative[:, 1:])
+            # Fractional bin position of every grid edge, for every row
+            position = (grid[np.newaxis, :] - intercepts[:, np.newaxis]) / \
+                       slopes[:, np.newaxis]
+            np.clip(position, 0, bins, out=position)
+            whole = np.minimum(position.astype(int), bins - 1)
+            fraction = position - whole
+            line = np.arange(len(block))[:, np.newaxis]
+            below = cumulative[line, whole] + fraction * block[line, whole]
+            out[rows] = np.diff(below, axis=1)
+
+        if single:
+            return out[0]
+        return out
+
+def configuredCalibration(path=CONFIG):
+    """Return the Calibration set in radmonitor.config, or the default
+       bands if there is no config."""
+    try:
+        with open(path) as config:
+            return Calibration.fromConfig(json.load(config))
+    except IOError:
+        return Calibration()
 
-def tempGain(temp,bin):
-    if temp<32:
-        SLOPE = 1.28
-        INTERCEPT = -9.83
-        ENERGY = SLOPE*bin + INTERCEPT
-    #for 32<temp<38
-    elif temp<38:
-        SLOPE = 1.34
-        INTERCEPT = -12.02
-        ENERGY = SLOPE*bin + INTERCEPT
-    #for 38<temp<40
-    elif temp<40:
-        SLOPE = 1.37
-        INTERCEPT = -13.41
-        ENERGY = SLOPE*bin + INTERCEPT
-    #for 40<temp<42
-    elif temp<42:
-        SLOPE = 1.38
-        INTERCEPT = -10.06
-        ENERGY = SLOPE*bin + INTERCEPT
-    else:
-        SLOPE = 1.43
-        INTERCEPT = -12.96
-        ENERGY = SLOPE*bin + INTERCEPT
-    #print "Slope is ", SLOPE, "and intercept is ", INTERCEPT
-    return ENERGY
-    #print "The slope is ", SLOPE,"and the intercept is ", INTERCEPT, "for a detector with a temp of ", temp
+defaultCalibration = configuredCalibration()
 
+def tempGain(temp, bin):
+    """Return the keV value of bin for a detector at temp, using the default
+       calibration bands. Either argument may be an array."""
+    return defaultCalibration.energy(temp, bin)
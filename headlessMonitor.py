@@ -7,73 +7,266 @@ to use that, and when you plug it back in to a Windows machine you will not be
 able to read location data. You need to set it back to NMEA first using the
 gpsd tools.
 
-Here we simply record new data every SAMPLE_TIME seconds until killed. If GPS
-lock is lost, the data is simply dropped.
+Here we simply record new data every SAMPLE_TIME seconds until killed. Every
+attached eMorpho is opened and acquires on its own thread, and the main loop
+keeps them on one sample clock (see util/detectors.py): each cycle arms all
+of them together and collects their histograms as one group, so a USB
+problem with one detector only drops that detector's samples. The group then
+goes through a pipeline of stages on their own threads (see
+util/pipeline.py): enrich adds one GPS position for the whole group, derive
+the anomaly scores, persist hands the samples to a shared background
+HistogramWriter, which batches them into Postgres (see util/histWriter.py),
+and notify prints them and blinks the LED. With the "journal" section of
+radmonitor.config enabled, every sample is first written to an on-device
+journal and the writer fills Postgres from it, so nothing is lost while the
+database is down (see util/journal.py). If GPS lock is lost, the data is
+simply dropped. The time each detector spent unarmed before each histogram
+is recorded in its deadtime column.
+
+radmonitor.config is read from this script's directory and watched while
+running (see util/configWatch.py). Edits to the detector registers, sample
+time, sensor, version, per-detector settings and geofence are applied at the
+next sample boundary; other settings need a restart.
+
+With the replay options (see --help and util/replay.py) no hardware is
+needed: recorded or synthetic spectra and a GPS track are played back,
+optionally many times faster than real time, with injected faults. Replayed
+samples are written as simulated rows, and the journal, offloading and
+metric summaries are left off, so a replay never passes for real data.
 """
 
-import emorpho, time, psycopg2
+import time
 from numpy import isnan, mean, sqrt, square
 from util.wifi import WiFi as wifi
 from util.gpsd import GPSD as gps
-import os, signal, sys, json, datetime
-from geopy import distance
+from util.histWriter import HistogramWriter, configuredColumns
+from util.journal import configuredJournal
+from util.anomaly import AnomalyDetector
+from util.geofence import Geofence
+from util.leds import controller as leds
+from util.pipeline import Pipeline
+from util.offload import Offloader, configuredTransport
+from util.monotonic import monotonic
+from util.configWatch import ConfigWatcher
+from util.detectors import Acquisition, Detector, discover, registersFor
+from scheduler import sharedScheduler
+from util import replay, metrics
+import argparse, os, signal, sys, json, datetime
+import psycopg2
+
+argParser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+replay.addArguments(argParser)
+args = argParser.parse_args()
+session = replay.Replay.fromArgs(args, lambda: psycopg2.connect(
+    database = 'radiation', user = 'radiation', password = 'radiation',
+    host = 'localhost'))
+
+# Clocks for timing samples; a replay substitutes its own
+if session is None:
+  now, clock, sleep = time.time, monotonic, time.sleep
+  wifi = wifi()
+else:
+  now, clock, sleep = session.clock.time, session.clock.monotonic, \
+                      session.clock.sleep
+  wifi = replay.NullWiFi()
 
 SAMPLE_TIME = 2 # seconds
-wifi = wifi()
+
+gpsTime = metrics.histogram("gps_lookup_seconds", "Position lookup")
+drops = metrics.counter("dropped_samples_total", "Samples not recorded",
+                        ("cause",))
+gpsRestarts = metrics.counter("gps_restarts_total", "GPS session restarts")
+writerQueue = metrics.gauge("writer_queue_depth", "Samples waiting to be written")
 TZ = ""
 sensor = "0"
 version = "0.0"
-gpsBase = (0.0, 0.0)
-gpsRange = 100
+CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      "radmonitor.config")
+
+# Settings applied while running; the rest need a restart
+LIVE_SETTINGS = ("radsettings", "sampleTime", "sensor", "version",
+                 "detectors", "geofence", "baseCoords")
 
 def loadConfig():
-  json_config = open('/home/debian/radmonitor-master/radmonitor.config')
-  config = json.load(json_config)
-  json_config.close()
-  for setting in config["radsettings"]:
-    setattr(e, setting, config["radsettings"][setting])
+  global SAMPLE_TIME
+  config = watcher.config
   SAMPLE_TIME = config["sampleTime"]
-  e.clearStats()
-  e.startTimedHistogram(SAMPLE_TIME)
   return config
 
+def detectorSensor(config, detector, position, count):
+  """The sensor id to record a detector's samples under: from its entry in
+     the "detectors" section, else the configured sensor for the first
+     detector and the following ids for the others."""
+  configured, registers = registersFor(config, detector, count)
+  if configured is not None:
+    return configured
+  if position == 0:
+    return config["sensor"]
+  print "Warning: no sensor configured for detector %s; using %d" % \
+        (detector, int(config["sensor"]) + position)
+  return int(config["sensor"]) + position
+
+def openDetectors(config):
+  """Open every attached eMorpho, waiting until there is at least one."""
+  factory = session.emorpho if session is not None else emorpho.eMorpho
+  while True:
+    found = discover(factory)
+    if found:
+      break
+    print "Could not connect to Rad Sensor"
+    leds().set("gps", "heartbeat")
+    time.sleep(5)
+  leds().set("gps", "off")
+  for position, (index, handle, serial) in enumerate(found):
+    registers = registersFor(config, serial, len(found))[1]
+    detector = Detector(index, handle, serial,
+                        detectorSensor(config, serial, position, len(found)),
+                        acquisition)
+    detector.configure(registers)
+    acquisition.add(detector)
+    print "Detector %s recording as sensor %s" % (serial, detector.sensor)
+
+def reconfigureDetectors(config):
+  """Queue each detector's changed registers and update its sensor id."""
+  count = len(acquisition.detectors)
+  for position, detector in enumerate(acquisition.detectors):
+    registers = registersFor(config, detector.serial, count)[1]
+    detector.sensor = detectorSensor(config, detector.serial, position, count)
+    if registers is None or detector.registers is None:
+      if registers != detector.registers:
+        print "Restart to switch %s to or from eMorphoSetup" % detector.serial
+      continue
+    changed = dict((setting, value) for setting, value in registers.items()
+                   if detector.registers.get(setting) != value)
+    if changed:
+      detector.update(changed)
+
+def applyConfig(changes):
+  """Apply config changes between cycles, so no sample is lost and none
+     straddles the change. Only changed registers are written to the
+     detectors, just before they are next armed."""
+  global SAMPLE_TIME, sensor, version, fence
+  if "sampleTime" in changes:
+    SAMPLE_TIME = changes["sampleTime"]
+    acquisition.setPeriod(SAMPLE_TIME)
+  if "sensor" in changes:
+    sensor = changes["sensor"]
+  if "version" in changes:
+    version = changes["version"]
+  if set(changes) & set(["radsettings", "detectors", "sensor"]):
+    reconfigureDetectors(watcher.config)
+  if "geofence" in changes or "baseCoords" in changes:
+    fence = makeFence(watcher.config)
+  print "Applied config changes:", ", ".join(sorted(changes))
+  ignored = [key for key in changes if key not in LIVE_SETTINGS]
+  if ignored:
+    print "Restart to apply:", ", ".join(sorted(ignored))
+
 def haltMonitor(signal, frame):
   wifi.stop()
+  watcher.stop()
+  acquisition.stop()
+  pipeline.stop()
   gps.stop()
+  writer.stop()
+  if journal is not None:
+    journal.close()
+  for offloader in offloaders:
+    offloader.stop()
+  if summaryWriter is not None:
+    summaryWriter.stop()
   print "Exiting headlessMonitor cleanly"
   sys.exit(0)
 
 signal.signal(signal.SIGINT, haltMonitor)
 
-def connectToRad():
-  e.scan()
-  while e.open(0) == False:
-    print "Could not connect to Rad Sensor"
-    os.system("echo heartbeat > /sys/class/leds/beaglebone\:green\:usr2/trigger")
-    time.sleep(5)
-    e.scan()
-  os.system("echo none > /sys/class/leds/beaglebone\:green\:usr2/trigger")
+wifi.start()
 
-conn = psycopg2.connect(database = 'radiation', user = 'radiation',
-                        password = 'radiation', host = 'localhost')
+if session is None:
+  import emorpho
 
-cur = conn.cursor()
+watcher = ConfigWatcher(CONFIG)
+config = loadConfig()
+watcher.start()
 
-wifi.start()
+acquisition = Acquisition(SAMPLE_TIME, clock, sleep, now,
+                          fatal = (replay.ReplayFinished,))
+openDetectors(config)
 
-e = emorpho.eMorpho()
-connectToRad()
+def zoneChanged(event, zone):
+  print "Zone %s: %s %s" % (event, zone.kind, zone.name)
 
-config = loadConfig()
+def makeFence(config):
+  fence = Geofence.fromConfig(config)
+  fence.subscribe(zoneChanged)
+  return fence
 
-gpsBase = (config["baseCoords"]["latitude"], config["baseCoords"]["longitude"])
-gpsRange = config["baseCoords"]["range"]
+fence = makeFence(config)
 sensor = config["sensor"]
 version = config["version"]
 TZ = config["timezone"]
 AdjustTime = config["gpsTime"]
 
-gps = gps(TZ, AdjustTime)
+anomalyConfig = dict(config.get("anomaly", {}))
+anomalyEnabled = anomalyConfig.pop("enabled", False)
+# One background model per detector and compression, as their gains and
+# responses differ; each is made on the first sample it would score
+anomalyModels = {}
+
+# A replay only writes simulated rows, straight to the database
+journal = configuredJournal(config) if session is None else None
+if journal is not None and journal.backlog():
+  print "Journal holds %d samples not yet in the database" % journal.backlog()
+
+writerColumns = configuredColumns(config)
+if session is not None:
+  writerColumns += ("simulated",)
+writer = HistogramWriter(database = 'radiation', user = 'radiation',
+                         password = 'radiation', host = 'localhost',
+                         storage = config.get("histogramStorage", "array"),
+                         extraColumns = writerColumns,
+                         partitioned = config.get("partitioned", False),
+                         journal = journal,
+                         **config.get("writer", {}))
+writer.start()
+
+offloadConfig = dict(config.get("offload", {}))
+offloaders = []
+if offloadConfig.pop("enabled", False) and session is None:
+  # Offload state is kept per sensor id
+  for offloadSensor in sorted(set(str(detector.sensor)
+                                  for detector in acquisition.detectors)):
+    offloader = Offloader(configuredTransport(config), offloadSensor,
+                          offloadConfig["spool"], linkUp = lambda: wifi.Up,
+                          interval = offloadConfig.get("interval", 60),
+                          batchRows = offloadConfig.get("batchRows", 1800),
+                          rateLimit = offloadConfig.get("rateLimit"),
+                          database = 'radiation', user = 'radiation',
+                          password = 'radiation', host = 'localhost')
+    offloader.start()
+    offloaders.append(offloader)
+
+metricsConfig = config.get("metrics", {})
+if metricsConfig.get("textfile"):
+  sharedScheduler().every(metricsConfig.get("textfileInterval", 15),
+                          metrics.writeTextfile, metricsConfig["textfile"],
+                          jobName="metricsTextfile")
+if metricsConfig.get("httpPort"):
+  metrics.serve(metricsConfig["httpPort"])
+summaryWriter = None
+if metricsConfig.get("database", False) and session is None:
+  summaryWriter = metrics.SummaryWriter(sensor,
+                                        metricsConfig.get("summaryInterval", 300),
+                                        database = 'radiation',
+                                        user = 'radiation',
+                                        password = 'radiation',
+                                        host = 'localhost')
+  summaryWriter.start()
+
+if session is None:
+  gps = gps(TZ, AdjustTime)
+else:
+  gps = session.gpsd(TZ)
 gps.start()
 
 # def getFix(session):
@@ -87,65 +280,106 @@ gps.start()
 #            else:
 #                return None
 
-state = gpsState = True
 gpsTimeout = 0
-sessionCounter = 0
-
-while True:
-    time.sleep(SAMPLE_TIME)
-    sessionCounter = sessionCounter + 1
-    if sessionCounter > 1000:
-      loadConfig()
-      sessionCounter = 0
-#    location = gps.getFix()
-    location = gps.getLocation()
-    if location.longitude == 0.0 or isnan(location.longitude):
-        print "Error: No GPS location"
-        gpsTimeout = gpsTimeout + 1
-        if gpsState:
-          os.system("echo default-on > /sys/class/leds/beaglebone\:green\:usr2/trigger")
-          gpsState = False
-        else:
-          os.system("echo none > /sys/class/leds/beaglebone\:green\:usr2/trigger")
-          gpsState = True 
-        if gpsTimeout >= 5:
-          print "Restarting GPS"
-          gpsTimeout = 0
-          gps.retry()
-        continue
-    else:
-       baseDistance = distance.vincenty(gpsBase, (location.latitude, location.longitude)).meters 
-       if baseDistance <= gpsRange:
-         if wifi.running == False:
-           print "In range of router"
-           wifi.start()
-
-    hist = e.readHistogram()
-    if hist == False:
-        print "Error: Couldn't read the histogram"
-        connectToRad()
-        continue
-
-    stats = e.readStats()
-    e.startTimedHistogram(SAMPLE_TIME)
-
-    # TODO: There's some logic in monitor.py to handle GPS dropouts by
-    # recording HDOP of -1. We should replicate that here.a
-    cur.execute("INSERT INTO histograms (location, hdop, time, sampletime, temp, cps, histogram, altitude, sensor, version) " +
-                "VALUES (ST_GeomFromText('POINT(%s %s)', 4326), %s, %s, %s, %s, %s, %s, %s, %s, %s)",
-                (location.longitude, location.latitude, location.gpsError, location.timestamp, SAMPLE_TIME,
-                 e.getTemperature(), 
-                 stats["cps"], 
-                 hist, 
-                 location.altitude, 
-                 sensor, 
-                 version))
-    conn.commit()
-
-    print "Added Entry ", location.timestamp, stats["cps"], location.latitude, location.longitude, location.gpsError, distance.vincenty(gpsBase, (location.latitude, location.longitude)).meters
-    if state:
-      os.system("echo default-on > /sys/class/leds/beaglebone\:green\:usr1/trigger")
-      state = False
+
+def enrich(group):
+  """Attach the position interpolated to the middle of the window to every
+     sample in the group."""
+  global gpsTimeout
+  with gpsTime.time():
+    location = gps.locationAt(group["windowStart"], group["windowEnd"])
+    if location is None:
+      location = gps.getLocation()
+  if location.longitude == 0.0 or isnan(location.longitude):
+    print "Error: No GPS location"
+    drops.inc(len(group["samples"]), cause="no_gps")
+    gpsTimeout = gpsTimeout + 1
+    leds().set("gps", "error")
+    if gpsTimeout >= 5:
+      print "Restarting GPS"
+      gpsRestarts.inc()
+      gpsTimeout = 0
+      gps.retry()
+    return None
+  leds().set("gps", "off")
+  fence.update(location.latitude, location.longitude)
+  # Checked on every fix, not just on entering: the WiFi check stops the
+  # link after a failure even while we stay in range of the router
+  if fence.inside("base") and wifi.running == False:
+    print "In range of router"
+    wifi.start()
+  if fence.inside("exclusion"):
+    print "In exclusion zone, sample not recorded"
+    drops.inc(len(group["samples"]), cause="exclusion")
+    return None
+  # TODO: There's some logic in monitor.py to handle GPS dropouts by
+  # recording HDOP of -1. We should replicate that here.
+  for sample in group["samples"]:
+    sample.update({"longitude": location.longitude,
+                   "latitude": location.latitude,
+                   "hdop": location.gpsError,
+                   "time": location.timestamp,
+                   "altitude": location.altitude,
+                   "version": version,
+                   "simulated": session is not None})
+  return group
+
+def derive(group):
+  for sample in group["samples"]:
+    sample["anomaly"] = None
+    if anomalyEnabled:
+      key = (sample["detector"], sample["compression"])
+      if key not in anomalyModels:
+        anomalyModels[key] = AnomalyDetector(compression=sample["compression"],
+                                             **anomalyConfig)
+      sample["anomaly"] = anomalyModels[key].update(sample["histogram"],
+                                                    sample["sampletime"])
+  return group
+
+def persist(group):
+  written = []
+  for sample in group["samples"]:
+    if writer.put(sample):
+      written.append(sample)
     else:
-      os.system("echo none > /sys/class/leds/beaglebone\:green\:usr1/trigger")
-      state = True
+      print "Error: Writer queue full, dropped sample"
+      drops.inc(cause="writer_full")
+  if not written:
+    return None
+  group["samples"] = written
+  return group
+
+def notify(group):
+  writerQueue.set(writer.queueDepth())
+  for sample in group["samples"]:
+    print "Added Entry ", sample["detector"], sample["time"], sample["cps"], sample["latitude"], sample["longitude"], sample["hdop"], fence.names(), sample["anomaly"], \
+          "dead %.3fs" % sample["deadtime"], "queue", writer.queueDepth(), "flush %.3fs" % writer.lastFlushLatency
+  leds().toggle("sample")
+  return group
+
+pipeline = Pipeline([("enrich", enrich), ("derive", derive),
+                     ("persist", persist), ("notify", notify)])
+pipeline.start()
+acquisition.start()
+
+started = monotonic()
+try:
+  while True:
+    group = acquisition.next()
+    changes = watcher.take()
+    if changes:
+      applyConfig(changes)
+    if group["samples"] and not pipeline.put(group):
+      print "Error: Pipeline backlog full, dropped samples"
+      drops.inc(len(group["samples"]), cause="pipeline_full")
+except replay.ReplayFinished:
+  acquisition.stop()
+  pipeline.stop()
+  elapsed = monotonic() - started
+  for stats in acquisition.stats():
+    print "%(detector)s: %(reads)d reads (%(failures)d failed)" % stats
+  print "Replay finished: %d fixes dropped, %.1fs" % (gps.dropped, elapsed)
+  for stage in pipeline.stats():
+    print "  %(name)-8s %(processed)6d processed %(dropped)6d dropped " \
+          "max %(maxDuration).4fs" % stage
+  haltMonitor(None, None)
@@ -0,0 +1,265 @@
+"""Isotope identification against the reference spectra in samples/.
+
+Each reference spectrum is moved onto a common keV grid with the default
+calibration, stripped of the background it was recorded over, and normalized
+to unit sum; spectra of the same isotope (Co-60 at several distances, ...) are
+averaged into one template. The background spectra are kept as extra
+templates, so a measured spectrum x (counts per grid bin) is modelled as
+
+    x ~ T a,  a >= 0
+
+with one column of T per isotope and per background. a is the weighted
+least-squares fit with weights from the background shape, so the Gram matrix
+G = T' W T and the projection W T are fixed and computed once. A batch of N
+spectra is then one (N x bins) by (bins x K) product for the right-hand sides
+and a few dozen sweeps of projected coordinate descent on the K x K problem,
+done for all rows at once:
+
+    ident = Identifier()
+    rates, sigmas, confidences = ident.fit(hists, temps, sampletimes)
+    ident.identify(hist, temp, 2)    # [("Cs-137", cps, confidence), ...]
+
+Rates are the counts per second each template accounts for. Uncertainties
+come from Poisson errors on the measured counts propagated through the
+linear fit. The confidence is 2 Phi(z) - 1 for a rate z standard errors
+above zero: 0 for a template the fit leaves out, 0.95 at 1.96 sigma, and so
+on.
+
+Run from this directory to summarize a stretch of histograms rows, or a
+spectrum store (util/spectrumStore.py):
+
+    python identify.py [--start 2014-05-01 --end 2014-05-02] [--store DIR]
+"""
+
+import argparse, calendar, glob, os
+import numpy as np
+import psycopg2
+from dateutil import parser as dateparser
+import getEnergy
+from util import histCodec
+from util.monotonic import monotonic
+from util.spectrumStore import SpectrumStore
+
+SAMPLES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "samples")
+
+# Template name -> sample files, relative to SAMPLES
+TEMPLATES = [("Cs-137", ("cs137*.csv", "*-cs137-*.csv")),
+             ("Co-60", ("co60*.csv",)),
+             ("K-40", ("banana.csv",)),
+             ("brick", ("brick.csv",)),
+             ("paleo", ("paleo.csv",))]
+BACKGROUNDS = ("*-background.csv",)
+
+GRID = np.arange(30.0, 3001.0, 10.0)
+
+def files(patterns, directory=SAMPLES):
+    return sorted(set(path for pattern in patterns
+                      for path in glob.glob(os.path.join(directory, pattern))))
+
+def strip(spectrum, background, quantile=5):
+    """Subtract the largest multiple of background that spectrum mostly
+       stays above, so what is left is the source's own contribution."""
+    usable = background > 0
+    scale = np.percentile(spectrum[usable] / background[usable], quantile)
+    return np.maximum(spectrum - max(scale, 0.0) * background, 0.0)
+
+def normalCDF(z):
+    """Standard normal CDF, elementwise (Abramowitz and Stegun 7.1.26)."""
+    x = np.abs(z) / np.sqrt(2.0)
+    t = 1.0 / (1.0 + 0.3275911 * x)
+    erf = 1 - t * (0.254829592 + t * (-0.284496736 + t * (1.421413741 +
+          t * (-1.453152027 + t * 1.061405429)))) * np.exp(-x * x)
+    return 0.5 * (1 + np.sign(z) * erf)
+
+class Identifier(object):
+    """Fits spectra as non-negative combinations of the template library.
+
+       grid gives the keV bin edges spectra are compared on, temperature the
+       one the reference spectra are calibrated at, and sweeps the maximum
+       number of coordinate descent passes per fit."""
+
+    def __init__(self, templates=TEMPLATES, backgrounds=BACKGROUNDS,
+                 grid=GRID, temperature=35.0, calibration=None, sweeps=50,
+                 directory=SAMPLES):
+        self.grid = np.asarray(grid, dtype=float)
+        self.calibration = calibration or getEnergy.defaultCalibration
+        self.sweeps = sweeps
+
+        def load(paths):
+            spectra = [np.loadtxt(path, delimiter=",") for path in paths]
+            return self.calibration.rebin(np.array(spectra), temperature,
+                                          self.grid)
+
+        backgroundSpectra = load(files(backgrounds, directory))
+        if not len(backgroundSpectra):
+            raise ValueError("No background spectra in %s" % directory)
+        backgroundSpectra /= backgroundSpectra.sum(axis=1)[:, np.newaxis]
+        background = backgroundSpectra.mean(axis=0)
+
+        self.isotopes = []
+        columns = []
+        for name, patterns in templates:
+            paths = files(patterns, directory)
+            if not paths:
+                continue
+            nets = [strip(spectrum, background * spectrum.sum())
+                    for spectrum in load(paths)]
+            template = np.mean([net / net.sum() for net in nets], axis=0)
+            self.isotopes.append(name)
+            columns.append(template)
+        self.names = self.isotopes + ["background"] * len(backgroundSpectra)
+        self.matrix = np.array(columns + list(backgroundSpectra)).T
+
+        # Weights ~ 1 / expected variance for background-like spectra; the
+        # floor keeps near-empty high energy bins from dominating.
+        weights = 1.0 / np.maximum(background, 0.1 / len(background))
+        weighted = self.matrix * weights[:, np.newaxis]
+        self.gram = np.dot(self.matrix.T, weighted)
+        self.weighted = weighted
+        self.inverse = np.linalg.pinv(self.gram)
+        # Rows of the unconstrained solution operator, squared, turn counts
+        # per bin into variances of the fitted coefficients.
+        self.variance = np.dot(self.inverse, weighted.T) ** 2
+
+    def project(self, hists, temps, compression=None):
+        """Rebin raw spectra onto the template grid."""
+        return self.calibration.rebin(hists, temps, self.grid, compression)
+
+    def solve(self, x):
+        """Fit (N x bins) grid spectra. Returns (coefficients, sigmas), both
+           (N x K), in counts."""
+        x = np.atleast_2d(np.asarray(x, dtype=float))
+        b = np.dot(x, self.weighted)
+        a = np.maximum(np.dot(b, self.inverse.T), 0.0)
+        diagonal = np.diag(self.gram)
+        tolerance = 1e-6 * max(x.sum(axis=1).max(), 1.0)
+        for _ in range(self.sweeps):
+            change = 0.0
+            for k in range(len(diagonal)):
+                step = (np.dot(a, self.gram[:, k]) - b[:, k]) / diagonal[k]
+                updated = np.maximum(a[:, k] - step, 0.0)
+                change = max(change, np.abs(updated - a[:, k]).max())
+                a[:, k] = updated
+            if change < tolerance:
+                break
+        sigmas = np.sqrt(np.dot(np.maximum(x, 0.0), self.variance.T) + 1.0)
+        return a, sigmas
+
+    def fit(self, hists, temps, sampletimes=1.0, compression=None,
+            chunk=4096):
+        """Fit raw (N x bins) spectra taken at temps over sampletimes seconds.
+           Returns (rates, sigmas, confidences), each (N x K) with columns in
+           the order of self.names; rates and sigmas are in counts per
+           second."""
+        hists = np.atleast_2d(hists)
+        temps = np.atleast_1d(np.asarray(temps, dtype=float))
+        sampletimes = np.broadcast_to(np.asarray(sampletimes, dtype=float),
+                                      (len(hists),))
+        if np.ndim(compression) != 0:
+            compression = np.atleast_1d(compression)
+        rates = np.empty((len(hists), len(self.names)))
+        sigmas = np.empty_like(rates)
+        for start in range(0, len(hists), chunk):
+            rows = slice(start, start + chunk)
+            comp = compression if np.ndim(compression) == 0 \
+                   else compression[rows]
+            a, s = self.solve(self.project(hists[rows], temps[rows], comp))
+            live = sampletimes[rows][:, np.newaxis]
+            rates[rows] = a / live
+            sigmas[rows] = s / live
+        confidences = np.where(rates > 0, 2 * normalCDF(rates / sigmas) - 1,
+                               0.0)
+        return rates, sigmas, confidences
+
+    def identify(self, hist, temp, sampletime=1.0, compression=None,
+                 threshold=0.0):
+        """Fit one spectrum. Returns [(isotope, cps, confidence), ...] for the
+           isotope templates, most confident first, leaving out those below
+           threshold confidence."""
+        rates, sigmas, confidences = self.fit(hist, temp, sampletime,
+                                              compression)
+        found = [(name, rates[0, k], confidences[0, k])
+                 for k, name in enumerate(self.isotopes)
+                 if confidences[0, k] >= threshold]
+        return sorted(found, key=lambda result: -result[2])
+
+def report(ident, times, rates, confidences, threshold):
+    """Print, for each isotope, how many samples it was found in and its
+       strongest detection."""
+    for k, name in enumerate(ident.isotopes):
+        found = confidences[:, k] >= threshold
+        if not found.any():
+            print "%-8s not found" % name
+            continue
+        strongest = np.flatnonzero(found)[np.argmax(rates[found, k])]
+        print "%-8s %6d samples, strongest %8.1f cps at %s" % \
+              (name, found.sum(), rates[strongest, k], times[strongest])
+
+def readRows(conn, start, end, chunk=5000):
+    """Yield (times, hists, temps, sampletimes, compression) batches of the
+       histograms rows between start and end."""
+    cur = conn.cursor()
+    histogram = histCodec.selectColumns(histCodec.configuredStorage())
+    lastId = 0
+    while True:
+        cur.execute("SELECT id, time, temp, sampletime, compression, " +
+                    histogram + " FROM histograms WHERE time >= %s " +
+                    "AND time < %s AND id > %s ORDER BY id LIMIT %s",
+                    (start, end, lastId, chunk))
+        rows = cur.fetchall()
+        if not rows:
+            break
+        lastId = rows[-1][0]
+        hists = [histCodec.fromRow(row[5], row[6]) for row in rows]
+        bins = max(len(hist) for hist in hists)
+        batch = np.zeros((len(rows), bins))
+        for i, hist in enumerate(hists):
+            batch[i, :len(hist)] = hist
+        yield ([row[1] for row in rows], batch,
+               [row[2] for row in rows], [row[3] or 1 for row in rows],
+               [row[4] or 0 for row in rows])
+    cur.close()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--start", help="first time to include")
+    parser.add_argument("--end", help="time to stop at")
+    parser.add_argument("--store", help="read spectra from this spectrum " +
+                                        "store instead of the database")
+    parser.add_argument("--threshold", type=float, default=0.999,
+                        help="confidence needed to count a detection")
+    args = parser.parse_args()
+
+    ident = Identifier()
+    started = monotonic()
+    if args.store:
+        store = SpectrumStore(args.store)
+        epoch = lambda text: calendar.timegm(
+            dateparser.parse(text).utctimetuple())
+        rows = store.select(start=epoch(args.start) if args.start else None,
+                            end=epoch(args.end) if args.end else None)
+        times = store.column("time")[rows]
+        rates, sigmas, confidences = ident.fit(
+            store.spectra[rows], store.column("temp")[rows],
+            store.column("sampletime")[rows], store.column("compression")[rows])
+    else:
+        if not (args.start and args.end):
+            parser.error("--start and --end are needed without --store")
+        conn = psycopg2.connect(database = "radiation", user = "radiation",
+                                password = "radiation", host = "localhost")
+        times, results = [], []
+        for batch in readRows(conn, dateparser.parse(args.start),
+                              dateparser.parse(args.end)):
+            times.extend(batch[0])
+            results.append(ident.fit(*batch[1:]))
+        conn.close()
+        if not results:
+            print "No rows"
+            return
+        rates, sigmas, confidences = [np.concatenate(parts)
+                                      for parts in zip(*results)]
+    print "Fit %d spectra in %.1f s" % (len(rates), monotonic() - started)
+    report(ident, times, rates, confidences, args.threshold)
+
+if __name__ == "__main__":
+    main()
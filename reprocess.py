@@ -0,0 +1,338 @@
+"""Rerun analysis over the whole histograms table in parallel.
+
+When the calibration or a scoring method changes, its results have to be
+rederived for every stored row. A job here is a function from a batch of rows
+as NumPy arrays to output columns:
+
+    def score(batch):
+        # batch["id"], batch["histogram"] (N x bins), batch["temp"], ...
+        return {"anomaly": detector.scoreMany(batch["histogram"])}
+
+    ANOMALY = Job("anomaly", score, [("anomaly", "double precision")])
+
+The id space is cut into fixed ranges that a pool of worker processes take
+in turn. Each worker has its own connection, reads its range through a
+server-side (named) cursor a batch at a time, COPYs the outputs into a
+temporary table and writes them with one UPDATE ... FROM (or DELETE and
+INSERT for a separate results table). The range is recorded in
+reprocess_ranges in the same transaction, so a rerun or a restart after a
+crash skips everything already written and nothing is written twice.
+Workers share nothing but the database, so throughput grows with the number
+of cores until Postgres itself is the limit.
+
+Apply sql/reprocess.sql first. Run from this directory:
+
+    python reprocess.py anomaly [--workers 4] [--range-size 10000]
+    python reprocess.py isotopes --restart
+    python reprocess.py mymodule:JOB          # a Job defined elsewhere
+    python reprocess.py anomaly --status
+"""
+
+import os
+# Parallelism comes from processes; keep each one's BLAS single threaded so
+# the workers don't oversubscribe the cores. (Must be set before NumPy loads.)
+os.environ.setdefault("OPENBLAS_NUM_THREADS", "1")
+os.environ.setdefault("OMP_NUM_THREADS", "1")
+
+import argparse, importlib, multiprocessing, time
+import numpy as np
+import psycopg2
+from identify import Identifier
+from util import histCodec, pgcopy
+from util.anomaly import AnomalyDetector
+from util.monotonic import monotonic
+
+CONNECT = {"database": "radiation", "user": "radiation",
+           "password": "radiation", "host": "localhost"}
+
+class Job(object):
+    """A reprocessing job: function takes a batch dict of arrays ("id",
+       "histogram" and each of inputs, with NULLs as NaN) and returns a dict
+       of arrays, one per output. outputs are (column, SQL type) pairs;
+       table is histograms, whose columns are updated in place, or a results
+       table with an integer id primary key."""
+
+    def __init__(self, name, function, outputs, inputs=(), table="histograms"):
+        self.name = name
+        self.function = function
+        self.outputs = list(outputs)
+        self.inputs = list(inputs)
+        self.table = table
+
+_detectors = {}
+
+def scoreAnomaly(batch):
+    """Score rows in id order with a model per compression that learns from
+       them as the monitor's does, so it warms up from the seeds the same way."""
+    sampletimes = np.where(np.isnan(batch["sampletime"]), 1.0,
+                           batch["sampletime"])
+    scores = np.zeros(len(batch["id"]))
+    for row in np.argsort(batch["id"]):
+        compression = batch["compression"][row]
+        compression = None if np.isnan(compression) else int(compression)
+        if compression not in _detectors:
+            _detectors[compression] = AnomalyDetector(compression=compression)
+        scores[row] = _detectors[compression].update(batch["histogram"][row],
+                                                     sampletimes[row])
+    return {"anomaly": scores}
+
+_identifier = None
+
+def fitIsotopes(batch):
+    global _identifier
+    if _identifier is None:
+        _identifier = Identifier()
+    temps = np.where(np.isnan(batch["temp"]), 35.0, batch["temp"])
+    sampletimes = np.where(np.isnan(batch["sampletime"]), 1.0,
+                           batch["sampletime"])
+    compression = np.where(np.isnan(batch["compression"]), 0,
+                           batch["compression"]).astype(int)
+    rates, sigmas, confidences = _identifier.fit(batch["histogram"], temps,
+                                                 sampletimes, compression)
+    isotopes = len(_identifier.isotopes)
+    best = np.argmax(confidences[:, :isotopes] +
+                     1e-9 * rates[:, :isotopes], axis=1)
+    rows = np.arange(len(best))
+    return {"isotope": [_identifier.isotopes[k] for k in best],
+            "rate": rates[rows, best], "confidence": confidences[rows, best]}
+
+JOBS = {"anomaly": Job("anomaly", scoreAnomaly,
+                       [("anomaly", "double precision")],
+                       inputs=["sampletime", "compression"]),
+        "isotopes": Job("isotopes", fitIsotopes,
+                        [("isotope", "text"), ("rate", "real"),
+                         ("confidence", "real")],
+                        inputs=["temp", "sampletime", "compression"],
+                        table="histogram_isotopes")}
+
+def loadJob(spec):
+    """Look up a job by name in JOBS, or as module:attribute."""
+    if spec in JOBS:
+        return JOBS[spec]
+    if ":" not in spec:
+        raise ValueError("Unknown job %s; choose from %s or give module:JOB" %
+                         (spec, ", ".join(sorted(JOBS))))
+    module, attribute = spec.split(":", 1)
+    job = getattr(importlib.import_module(module), attribute)
+    if not isinstance(job, Job):
+        raise ValueError("%s is not a reprocess.Job" % spec)
+    return job
+
+def plan(conn, job, rangeSize, startId=None, endId=None):
+    """Return the (firstid, lastid) ranges of histograms not yet covered by
+       the job's checkpoints."""
+    cur = conn.cursor()
+    cur.execute("SELECT min(id), max(id) FROM histograms")
+    low, high = cur.fetchone()
+    cur.execute("SELECT firstid, lastid FROM reprocess_ranges WHERE job = %s",
+                (job.name,))
+    done = cur.fetchall()
+    cur.close()
+    if low is None:
+        return []
+    low = max(low, startId or low)
+    high = min(high, endId or high)
+    ranges = []
+    for first in range(low - low % rangeSize, high + 1, rangeSize):
+        # Only checkpoint ids that exist (or were asked for), so rows added
+        # later are picked up by the next run
+        ranges.extend(uncovered(max(first, low),
+                                min(first + rangeSize - 1, high), done))
+    return ranges
+
+def uncovered(first, last, done):
+    """The parts of [first, last] outside the checkpointed ranges done."""
+    pieces = []
+    start = first
+    for a, b in sorted(done):
+        if b < start or a > last:
+            continue
+        if a > start:
+            pieces.append((start, a - 1))
+        start = max(start, b + 1)
+    if start <= last:
+        pieces.append((start, last))
+    return pieces
+
+def readBatches(conn, job, first, last, batchSize):
+    """Yield batches of the rows with ids in [first, last], read through a
+       named cursor."""
+    storage = histCodec.configuredStorage()
+    histogram = histCodec.selectColumns(storage,
+                                        "array_to_string(histogram, ',')")
+    columns = ["id", histogram] + job.inputs
+    cur = conn.cursor("reprocess_%s_%d" % (job.name, first))
+    cur.itersize = batchSize
+    cur.execute("SELECT " + ", ".join(columns) + " FROM histograms " +
+                "WHERE id BETWEEN %s AND %s AND " +
+                histCodec.storedCondition(storage) + " ORDER BY id",
+                (first, last))
+    while True:
+        rows = cur.fetchmany(batchSize)
+        if not rows:
+            break
+        hists = [histCodec.decode(row[2]) if row[2] is not None
+                 else np.fromstring(row[1], dtype=np.int64, sep=",")
+                 for row in rows]
+        matrix = np.zeros((len(rows), max(len(hist) for hist in hists)),
+                          dtype=np.int64)
+        for i, hist in enumerate(hists):
+            matrix[i, :len(hist)] = hist
+        batch = {"id": np.array([row[0] for row in rows], dtype=np.int64),
+                 "histogram": matrix}
+        for i, name in enumerate(job.inputs):
+            batch[name] = np.array([np.nan if row[3 + i] is None
+                                    else row[3 + i] for row in rows],
+                                   dtype=float)
+        yield batch
+    cur.close()
+
+def outputValue(value):
+    """A result as a plain Python value for COPY, with NaN as NULL."""
+    if hasattr(value, "item"):
+        value = value.item()
+    if isinstance(value, float) and value != value:
+        return None
+    return value
+
+def processRange(conn, job, first, last, batchSize):
+    """Run the job over one id range and commit its results together with
+       the checkpoint. Returns the number of rows written."""
+    started = monotonic()
+    names = [name for name, kind in job.outputs]
+    cur = conn.cursor()
+    cur.execute("CREATE TEMP TABLE reprocess_staging (id integer, " +
+                ", ".join("%s %s" % output for output in job.outputs) +
+                ") ON COMMIT DROP")
+    count = 0
+    for batch in readBatches(conn, job, first, last, batchSize):
+        results = job.function(batch)
+        columns = [batch["id"]] + [results[name] for name in names]
+        text = "".join(pgcopy.formatRow([outputValue(value)
+                                         for value in row])
+                       for row in zip(*columns))
+        pgcopy.copyText(cur, "reprocess_staging", ["id"] + names, text)
+        count += len(batch["id"])
+    if job.table == "histograms":
+        cur.execute("UPDATE histograms SET " +
+                    ", ".join("%s = s.%s" % (name, name) for name in names) +
+                    " FROM reprocess_staging AS s WHERE histograms.id = s.id")
+    else:
+        cur.execute("DELETE FROM " + job.table + " WHERE id BETWEEN %s " +
+                    "AND %s", (first, last))
+        cur.execute("INSERT INTO " + job.table + " (id, " + ", ".join(names) +
+                    ") SELECT id, " + ", ".join(names) +
+                    " FROM reprocess_staging")
+    cur.execute("INSERT INTO reprocess_ranges (job, firstid, lastid, rows, " +
+                "seconds) VALUES (%s, %s, %s, %s, %s)",
+                (job.name, first, last, count, monotonic() - started))
+    conn.commit()
+    cur.close()
+    return count
+
+# Worker process state: each has its own connection and job
+_worker = {}
+
+def startWorker(spec, batchSize):
+    _worker["conn"] = psycopg2.connect(**CONNECT)
+    _worker["job"] = loadJob(spec)
+    _worker["batchSize"] = batchSize
+
+def runRange(bounds):
+    conn = _worker["conn"]
+    try:
+        count = processRange(conn, _worker["job"], bounds[0], bounds[1],
+                             _worker["batchSize"])
+        return bounds, count, None
+    except Exception as error:
+        conn.rollback()
+        return bounds, 0, "%s: %s" % (type(error).__name__, error)
+
+def run(spec, ranges, workers, batchSize):
+    """Process ranges on a pool of workers, printing progress. Returns the
+       ranges that failed."""
+    pool = multiprocessing.Pool(workers, startWorker, (spec, batchSize))
+    started = monotonic()
+    total = 0
+    failed = []
+    try:
+        for i, (bounds, count, error) in enumerate(
+                pool.imap_unordered(runRange, ranges)):
+            if error:
+                print "Error: ids %d-%d failed: %s" % (bounds[0], bounds[1],
+                                                       error)
+                failed.append(bounds)
+                continue
+            total += count
+            elapsed = monotonic() - started
+            print "%d/%d ranges, %d rows, %.0f rows/s" % \
+                  (i + 1, len(ranges), total, total / max(elapsed, 1e-6))
+        pool.close()
+    except KeyboardInterrupt:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return failed
+
+def status(conn, job):
+    cur = conn.cursor()
+    cur.execute("SELECT count(*), sum(rows), min(firstid), max(lastid), " +
+                "sum(seconds), max(finished) FROM reprocess_ranges " +
+                "WHERE job = %s", (job.name,))
+    ranges, rows, first, last, seconds, finished = cur.fetchone()
+    cur.close()
+    if not ranges:
+        print "%s: nothing processed" % job.name
+        return
+    print "%s: %d ranges, %d rows between ids %d and %d, last at %s" % \
+          (job.name, ranges, rows, first, last, finished)
+    print "%.0f rows per worker-second" % (rows / max(seconds, 1e-6))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("job", help="%s, or module:JOB" %
+                                    ", ".join(sorted(JOBS)))
+    parser.add_argument("--workers", type=int,
+                        default=multiprocessing.cpu_count(),
+                        help="worker processes (default: one per core)")
+    parser.add_argument("--range-size", type=int, default=10000,
+                        help="ids per checkpointed range")
+    parser.add_argument("--batch", type=int, default=2000,
+                        help="rows fetched and processed at a time")
+    parser.add_argument("--start-id", type=int, help="first id to process")
+    parser.add_argument("--end-id", type=int, help="last id to process")
+    parser.add_argument("--restart", action="store_true",
+                        help="forget the job's checkpoints and start over")
+    parser.add_argument("--status", action="store_true",
+                        help="show the job's progress and exit")
+    args = parser.parse_args()
+
+    job = loadJob(args.job)
+    conn = psycopg2.connect(**CONNECT)
+    if args.status:
+        status(conn, job)
+        conn.close()
+        return
+    if args.restart:
+        cur = conn.cursor()
+        cur.execute("DELETE FROM reprocess_ranges WHERE job = %s", (job.name,))
+        conn.commit()
+        cur.close()
+    ranges = plan(conn, job, args.range_size, args.start_id, args.end_id)
+    conn.close()
+    if not ranges:
+        print "%s: nothing left to do" % job.name
+        return
+    print "%s: %d ranges of %d ids on %d workers" % (job.name, len(ranges),
+                                                     args.range_size,
+                                                     args.workers)
+    started = time.time()
+    failed = run(args.job, ranges, args.workers, args.batch)
+    print "Finished in %.0f s" % (time.time() - started)
+    if failed:
+        print "%d ranges failed; rerun to retry them" % len(failed)
+        raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
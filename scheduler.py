@@ -0,0 +1,174 @@
+"""Single-thread job scheduler.
+
+One thread runs every periodic job in the process from a heap ordered by due
+time, instead of each timer starting a new thread per tick. Jobs are either
+
+- fixed-rate (every()): due at start + k * interval on the monotonic clock,
+  so timing never drifts however long the callback takes, or
+- fixed-delay (afterEach()): due interval seconds after the previous run
+  finished.
+
+A fixed-rate job that falls behind is not run repeatedly to catch up; the
+missed ticks are counted in its overruns and skipped attributes and it
+resumes on its original grid. Every job also records its run count and last
+and longest run time. Jobs should return quickly; anything that might block
+for long (like bringing an interface up) should be started in the background
+and checked on the next run.
+
+Most code should use the shared scheduler:
+
+    from scheduler import sharedScheduler
+    job = sharedScheduler().every(0.2, blink)
+    ...
+    job.cancel()
+"""
+
+import atexit, heapq, itertools, os, select, threading, traceback
+from util.monotonic import monotonic
+
+class Job(object):
+    """A scheduled callback. Change interval at any time; it applies from
+       the next run."""
+
+    def __init__(self, scheduler, function, interval, fixedRate, args, kwargs,
+                 name):
+        self.scheduler = scheduler
+        self.function = function
+        self.interval = interval
+        self.fixedRate = fixedRate
+        self.args = args
+        self.kwargs = kwargs
+        self.name = name or getattr(function, "__name__", "job")
+        self.due = None
+        self.cancelled = False
+        self.runs = 0
+        self.overruns = 0
+        self.skipped = 0
+        self.errors = 0
+        self.lastDuration = 0.0
+        self.maxDuration = 0.0
+
+    def cancel(self):
+        """Stop the job; it will not run again."""
+        self.cancelled = True
+        self.scheduler.wake()
+
+    def stats(self):
+        return {"name": self.name, "runs": self.runs,
+                "overruns": self.overruns, "skipped": self.skipped,
+                "errors": self.errors, "lastDuration": self.lastDuration,
+                "maxDuration": self.maxDuration}
+
+class Scheduler(threading.Thread):
+    """Runs jobs on one daemon thread. Waits use select() on a wakeup pipe,
+       so they are exact and adding or cancelling a job takes effect at
+       once."""
+
+    def __init__(self, clock=monotonic):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.clock = clock
+        self.heap = []
+        self.lock = threading.Lock()
+        self.counter = itertools.count()
+        self.running = True
+        self.wakeRead, self.wakeWrite = os.pipe()
+
+    def every(self, interval, function, *args, **kwargs):
+        """Run function every interval seconds at a fixed rate, starting one
+           interval from now."""
+        return self._add(function, interval, True, args, kwargs, interval)
+
+    def afterEach(self, interval, function, *args, **kwargs):
+        """Run function repeatedly with interval seconds between the end of
+           one run and the start of the next, starting one interval from
+           now."""
+        return self._add(function, interval, False, args, kwargs, interval)
+
+    def once(self, delay, function, *args, **kwargs):
+        """Run function once, delay seconds from now."""
+        return self._add(function, None, True, args, kwargs, delay)
+
+    def _add(self, function, interval, fixedRate, args, kwargs, delay):
+        name = kwargs.pop("jobName", None)
+        job = Job(self, function, interval, fixedRate, args, kwargs, name)
+        self._push(job, self.clock() + delay)
+        return job
+
+    def _push(self, job, due):
+        job.due = due
+        with self.lock:
+            heapq.heappush(self.heap, (due, next(self.counter), job))
+        self.wake()
+
+    def wake(self):
+        os.write(self.wakeWrite, "x")
+
+    def run(self):
+        while self.running:
+            with self.lock:
+                while self.heap and self.heap[0][2].cancelled:
+                    heapq.heappop(self.heap)
+                timeout = None
+                if self.heap:
+                    timeout = max(0.0, self.heap[0][0] - self.clock())
+            if timeout != 0.0:
+                ready = select.select([self.wakeRead], [], [], timeout)[0]
+                if ready:
+                    os.read(self.wakeRead, 4096)
+                    continue
+            with self.lock:
+                if not self.heap or self.heap[0][0] > self.clock():
+                    continue
+                due, _, job = heapq.heappop(self.heap)
+            if not job.cancelled:
+                self._runJob(job, due)
+
+    def _runJob(self, job, due):
+        started = self.clock()
+        try:
+            job.function(*job.args, **job.kwargs)
+        except Exception:
+            job.errors += 1
+            print "Error in scheduled job %s:" % job.name
+            traceback.print_exc()
+        finished = self.clock()
+        job.runs += 1
+        job.lastDuration = finished - started
+        job.maxDuration = max(job.maxDuration, job.lastDuration)
+        if job.interval is None or job.cancelled:
+            return
+        if not job.fixedRate:
+            self._push(job, finished + job.interval)
+            return
+        nextDue = due + job.interval
+        if nextDue <= finished:
+            missed = int((finished - nextDue) // job.interval) + 1
+            job.overruns += 1
+            job.skipped += missed
+            nextDue += missed * job.interval
+        self._push(job, nextDue)
+
+    def jobs(self):
+        """Return the scheduled jobs."""
+        with self.lock:
+            return [job for due, _, job in sorted(self.heap)
+                    if not job.cancelled]
+
+    def stop(self):
+        self.running = False
+        self.wake()
+        self.join(2)
+
+_shared = None
+_sharedLock = threading.Lock()
+
+def sharedScheduler():
+    """Return the process-wide Scheduler, starting it on first use."""
+    global _shared
+    with _sharedLock:
+        if _shared is None:
+            _shared = Scheduler()
+            _shared.start()
+            atexit.register(_shared.stop)
+    return _shared
@@ -0,0 +1,9 @@
+--
+-- Real-time anomaly score; see util/anomaly.py.
+--
+-- Apply with:  psql --user=radiation --host=localhost -W -f sql/anomaly.sql
+--
+
+ALTER TABLE histograms ADD COLUMN anomaly double precision;
+
+COMMENT ON COLUMN histograms.anomaly IS 'Spectral anomaly score computed on the device; about 1 for background.';
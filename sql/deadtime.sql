@@ -0,0 +1,9 @@
+--
+-- Detector dead time before each sample; see headlessMonitor.py.
+--
+-- Apply with:  psql --user=radiation --host=localhost -W -f sql/deadtime.sql
+--
+
+ALTER TABLE histograms ADD COLUMN deadtime real;
+
+COMMENT ON COLUMN histograms.deadtime IS 'Seconds between the end of the previous timed histogram and the start of this one.';
@@ -0,0 +1,11 @@
+--
+-- Packed histogram column; see util/histCodec.py.
+--
+-- Apply with:  psql --user=radiation --host=localhost -W -f sql/histpack.sql
+--
+
+ALTER TABLE histograms ADD COLUMN histpack bytea;
+
+ALTER TABLE histograms ALTER COLUMN histpack SET STORAGE EXTERNAL;
+
+COMMENT ON COLUMN histograms.histpack IS 'Histogram packed by util/histCodec.py (delta, zigzag, varint, zlib).';
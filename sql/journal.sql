@@ -0,0 +1,15 @@
+--
+-- Acknowledged journal records; see util/journal.py.
+--
+-- Apply with:  psql --user=radiation --host=localhost -W -f sql/journal.sql
+--
+
+CREATE TABLE journal_acks (
+    journal text PRIMARY KEY,
+    seq bigint NOT NULL DEFAULT 0,
+    updated timestamp with time zone NOT NULL DEFAULT now()
+);
+
+COMMENT ON TABLE journal_acks IS 'Last journal sequence number written to histograms, per device journal; updated in the same transaction as the rows.';
+
+ALTER TABLE public.journal_acks OWNER TO radiation;
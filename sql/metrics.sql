@@ -0,0 +1,23 @@
+--
+-- Rolling summaries of the monitor's metrics; see util/metrics.py.
+--
+-- Apply with:  psql --user=radiation --host=localhost -W -f sql/metrics.sql
+--
+
+CREATE TABLE monitor_metrics (
+    time timestamp with time zone NOT NULL,
+    sensor integer,
+    name text NOT NULL,
+    labels text,
+    count bigint,
+    value double precision,
+    p50 double precision,
+    p90 double precision,
+    p99 double precision
+);
+
+CREATE INDEX monitor_metrics_name_time ON monitor_metrics (name, time);
+
+COMMENT ON TABLE monitor_metrics IS 'Per-interval metric summaries: counts for counters; count, mean (value) and percentiles for latencies; value for gauges.';
+
+ALTER TABLE public.monitor_metrics OWNER TO radiation;
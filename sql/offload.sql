@@ -0,0 +1,29 @@
+--
+-- Offload bookkeeping; see util/offload.py.
+--
+-- offload_state is used on the devices, offload_ingest on the server that
+-- merges their batches. Creating both everywhere does no harm.
+--
+-- Apply with:  psql --user=radiation --host=localhost -W -f sql/offload.sql
+--
+
+CREATE TABLE offload_state (
+    sensor integer PRIMARY KEY,
+    sentid integer NOT NULL DEFAULT 0
+);
+
+COMMENT ON TABLE offload_state IS 'Highest histograms id already spooled for offload, per sensor.';
+
+CREATE TABLE offload_ingest (
+    sensor integer NOT NULL,
+    firstid integer NOT NULL,
+    lastid integer NOT NULL,
+    rows integer NOT NULL,
+    merged timestamp with time zone NOT NULL DEFAULT now(),
+    PRIMARY KEY (sensor, firstid)
+);
+
+COMMENT ON TABLE offload_ingest IS 'Offload batches already merged into histograms, by device id range.';
+
+ALTER TABLE public.offload_state OWNER TO radiation;
+ALTER TABLE public.offload_ingest OWNER TO radiation;
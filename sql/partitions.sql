@@ -0,0 +1,86 @@
+--
+-- Monthly partitions and summary tiers for histograms; see util/partitions.py.
+--
+-- Apply with:  psql --user=radiation --host=localhost -W -f sql/partitions.sql
+--
+-- Partitions are child tables named histograms_yYYYYmMM (UTC months), plus
+-- histograms_undated for rows without a time, each with a CHECK constraint on
+-- "time" so that queries on histograms with a time window only scan the
+-- matching months (constraint_exclusion = partition, the default). Inserts
+-- into histograms are routed to the right child by a trigger, which creates
+-- the child the first time a month is seen. Existing rows stay in the parent
+-- until util/partitions.py convert moves them.
+--
+
+CREATE OR REPLACE FUNCTION histograms_partition_name(t timestamp with time zone)
+RETURNS text AS $$
+    SELECT CASE WHEN $1 IS NULL THEN 'histograms_undated'
+                ELSE 'histograms_y' || to_char($1 AT TIME ZONE 'UTC', 'YYYY"m"MM')
+           END;
+$$ LANGUAGE sql IMMUTABLE;
+
+CREATE OR REPLACE FUNCTION ensure_histograms_partition(t timestamp with time zone)
+RETURNS text AS $$
+DECLARE
+    name text := histograms_partition_name(t);
+    first timestamp;
+BEGIN
+    PERFORM 1 FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE c.relname = name AND n.nspname = current_schema();
+    IF FOUND THEN
+        RETURN name;
+    END IF;
+
+    IF t IS NULL THEN
+        EXECUTE 'CREATE TABLE ' || quote_ident(name) ||
+                ' (CHECK ("time" IS NULL)) INHERITS (histograms)';
+    ELSE
+        first := date_trunc('month', t AT TIME ZONE 'UTC');
+        EXECUTE 'CREATE TABLE ' || quote_ident(name) ||
+                ' (CHECK ("time" >= ' || quote_literal(first AT TIME ZONE 'UTC') ||
+                ' AND "time" < ' ||
+                quote_literal((first + interval '1 month') AT TIME ZONE 'UTC') ||
+                ')) INHERITS (histograms)';
+    END IF;
+    EXECUTE 'ALTER TABLE ' || quote_ident(name) || ' ADD PRIMARY KEY (id)';
+    EXECUTE 'CREATE INDEX ' || quote_ident(name || '_time') || ' ON ' ||
+            quote_ident(name) || ' USING btree ("time")';
+    EXECUTE 'CREATE INDEX ' || quote_ident(name || '_location') || ' ON ' ||
+            quote_ident(name) || ' USING gist (location)';
+    RETURN name;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION histograms_insert() RETURNS trigger AS $$
+BEGIN
+    EXECUTE 'INSERT INTO ' || quote_ident(ensure_histograms_partition(NEW."time")) ||
+            ' SELECT ($1).*' USING NEW;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER histograms_partition BEFORE INSERT ON histograms
+    FOR EACH ROW EXECUTE PROCEDURE histograms_insert();
+
+--
+-- Summary tiers, filled by util/partitions.py summarize. Buckets are UTC
+-- hours and days; bounding boxes are in SRID 4326.
+--
+
+CREATE TABLE histograms_hourly (
+    bucket timestamp with time zone NOT NULL,
+    sensor integer NOT NULL DEFAULT 0,
+    simulated boolean NOT NULL DEFAULT false,
+    samples integer NOT NULL,
+    livetime double precision NOT NULL,
+    meancps double precision,
+    spectrum bigint[],
+    xmin double precision,
+    ymin double precision,
+    xmax double precision,
+    ymax double precision,
+    bbox geometry,
+    PRIMARY KEY (bucket, sensor, simulated)
+);
+
+CREATE TABLE histograms_daily (LIKE histograms_hourly INCLUDING ALL);
@@ -0,0 +1,29 @@
+--
+-- Reprocessing checkpoints and results; see reprocess.py.
+--
+-- Apply with:  psql --user=radiation --host=localhost -W -f sql/reprocess.sql
+--
+
+CREATE TABLE reprocess_ranges (
+    job text NOT NULL,
+    firstid integer NOT NULL,
+    lastid integer NOT NULL,
+    rows integer NOT NULL,
+    seconds real,
+    finished timestamp with time zone NOT NULL DEFAULT now(),
+    PRIMARY KEY (job, firstid)
+);
+
+COMMENT ON TABLE reprocess_ranges IS 'histograms id ranges a reprocessing job has finished; committed with its results.';
+
+CREATE TABLE histogram_isotopes (
+    id integer PRIMARY KEY,
+    isotope text,
+    rate real,
+    confidence real
+);
+
+COMMENT ON TABLE histogram_isotopes IS 'Most confident isotope template fit to each histograms row, from reprocess.py isotopes.';
+
+ALTER TABLE public.reprocess_ranges OWNER TO radiation;
+ALTER TABLE public.histogram_isotopes OWNER TO radiation;
@@ -0,0 +1,29 @@
+--
+-- Spatial grid rollups in SRID 3663; see util/rollup.py.
+--
+-- Apply with:  psql --user=radiation --host=localhost -W -f sql/rollup.sql
+--
+
+CREATE TABLE grid_state (
+    grid text PRIMARY KEY,
+    shape text NOT NULL,
+    size double precision NOT NULL,
+    last_id integer NOT NULL DEFAULT 0
+);
+
+COMMENT ON COLUMN grid_state.last_id IS 'Highest histograms.id already counted in grid_cells.';
+
+CREATE TABLE grid_cells (
+    grid text NOT NULL REFERENCES grid_state (grid) ON DELETE CASCADE,
+    cx integer NOT NULL,
+    cy integer NOT NULL,
+    samples integer NOT NULL,
+    livetime double precision NOT NULL,
+    sumcps double precision NOT NULL,
+    spectrum bigint[],
+    tmin timestamp with time zone,
+    tmax timestamp with time zone,
+    PRIMARY KEY (grid, cx, cy)
+);
+
+CREATE INDEX grid_cells_tmax ON grid_cells USING btree (grid, tmax);
@@ -1,4 +1,5 @@
 from RepeatedTimer import RepeatedTimer
+from util.leds import GPIO
 from time import sleep
 
 class StatusLED(RepeatedTimer):
@@ -21,18 +22,8 @@ class StatusLED(RepeatedTimer):
             print("Status {} not defined".format(status))
 
     def setupPort(self):
-        # select port
-        try:
-            with open("/sys/class/gpio/export","w") as export:
-                export.write("{}".format(self.port))
-        except (IOError, OSError):
-            with open("/sys/class/gpio/unexport","w") as unexport:
-                unexport.write("{}".format(self.port))
-            with open("/sys/class/gpio/export","w") as export:
-                export.write("{}".format(self.port))
-        # set to output
-        with open("/sys/class/gpio/gpio{}/direction".format(self.port),"w") as direction:
-            direction.write("{}".format("out"))
+        # export the port and keep its value file open
+        self.gpio = GPIO(self.port)
 
     def blink(self):
         if self.status == 'on':
@@ -40,13 +31,9 @@ class StatusLED(RepeatedTimer):
         elif self.status == 'off':
             self.value = 0
         else:                             # toggle
-            if self.value == 0:
-                self.value = 1
-            elif self.value == 1:
-                self.value = 0
-        # change value
-        with open("/sys/class/gpio/gpio{}/value".format(self.port),"w") as value:
-            value.write("{}".format(self.value))
+            self.value = 1 - self.value
+        # change value; only written if it differs from the last write
+        self.gpio.set(self.value)
         
 # rt = StatusLED(18)
 # try:
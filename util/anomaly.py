@@ -0,0 +1,192 @@
+"""Streaming spectral anomaly scoring.
+
+Each spectrum is summed into a few wide energy windows and compared with a
+running background model:
+
+- the background shape, an exponentially weighted mean of recent
+  background-like spectra, normalized to unit sum;
+- the background count rate, weighted the same way;
+- a small set of principal directions along which the background is known
+  to vary (radon, soil K/U/Th, ...), taken from a weighted covariance of
+  past residuals.
+
+For a sample with n counts in window totals x, the Poisson-normalized residual
+r = (x - n * shape) / sqrt(n * shape) is projected off the background
+directions with a precomputed matrix P, and the score is
+
+    (|P r|^2 + max(0, z)^2) / (dof + 1)
+
+where z is the gross count excess over the background rate and dof the number
+of residual degrees of freedom left after projection. The score is about 1 for
+background and grows with any spectral shape or count excess the background
+model cannot explain.
+
+Samples scoring under the threshold update the model incrementally; the
+principal directions and P are only recomputed every refit updates, so scoring
+a sample costs one reduceat and one small matrix-vector product. The model
+starts from the samples/*-background.csv spectra, recorded at compression 7
+and rescaled to the detector's compression (each step of compression halves
+the bins' width in energy). The first warmup samples update the model
+whatever they score, as a running mean, so a seed that doesn't match the
+detector is replaced before the threshold applies.
+"""
+
+import glob, os
+import numpy as np
+
+SEEDS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..",
+                     "samples", "*-background.csv")
+SEED_COMPRESSION = 7
+
+def rescale(hist, fromCompression, toCompression):
+    """Move a histogram recorded at one compression onto the bins of
+       another, keeping its length. Each step down in compression doubles
+       the bin numbers, so counts are spread over the finer bins (and those
+       past the end dropped), or summed into coarser ones."""
+    hist = np.asarray(hist, dtype=float)
+    if fromCompression is None or toCompression is None:
+        return hist
+    steps = int(fromCompression) - int(toCompression)
+    bins = len(hist)
+    if steps > 0:
+        factor = 2 ** steps
+        return np.repeat(hist[:-(-bins // factor)] / factor, factor)[:bins]
+    if steps < 0:
+        factor = 2 ** -steps
+        padded = np.zeros(-(-bins // factor) * factor)
+        padded[:bins] = hist
+        out = np.zeros(bins)
+        coarse = padded.reshape(-1, factor).sum(axis=1)
+        out[:len(coarse)] = coarse
+        return out
+    return hist
+
+class AnomalyDetector(object):
+    """Score spectra against a continuously updated background model.
+
+       windows is the number of energy windows the bins are summed into,
+       components the number of background directions projected out,
+       halfLife the number of background samples over which the model
+       forgets, refit how many updates pass between recomputing the
+       projection, and threshold the score above which a sample is treated
+       as anomalous and kept out of the background model. compression is
+       the detector's (None: the seeds'), and warmup the number of samples
+       learned from unconditionally at the start. The background rate is
+       kept in counts per second of sampletime."""
+
+    def __init__(self, bins=4096, windows=128, components=3, halfLife=300,
+                 refit=150, threshold=5.0, seeds=SEEDS, compression=None,
+                 warmup=150, seedCompression=SEED_COMPRESSION):
+        self.starts = np.linspace(0, bins, windows + 1).astype(int)[:-1]
+        self.windows = windows
+        self.components = components
+        self.alpha = 1 - 0.5 ** (1.0 / halfLife)
+        self.refit = refit
+        self.threshold = threshold
+        self.dof = windows - 1 - components
+        self.updates = 0
+        self.warmup = warmup
+        self.compression = compression
+        self.seedCompression = seedCompression
+        self.rate = None
+        self.seed(sorted(glob.glob(seeds)) if isinstance(seeds, str)
+                  else seeds)
+
+    def group(self, hist):
+        """Sum a histogram into the energy windows."""
+        return np.add.reduceat(np.asarray(hist, dtype=float), self.starts)
+
+    def seed(self, spectra):
+        """Start the model from background spectra: given as arrays or paths
+           to CSV files, recorded at seedCompression. Differences between
+           the seeds become the initial background directions."""
+        shapes = []
+        for spectrum in spectra:
+            if isinstance(spectrum, str):
+                spectrum = np.loadtxt(spectrum, delimiter=",")
+            grouped = self.group(rescale(spectrum, self.seedCompression,
+                                         self.compression))
+            shapes.append(grouped / grouped.sum())
+        if shapes:
+            shapes = np.array(shapes)
+            self.shape = np.maximum(shapes.mean(axis=0), 1e-9)
+        else:
+            shapes = np.zeros((0, self.windows))
+            self.shape = np.ones(self.windows) / self.windows
+        self.shape /= self.shape.sum()
+        self.covariance = np.identity(self.windows)
+        for grouped in shapes:
+            direction = (grouped - self.shape) / np.sqrt(self.shape)
+            length = np.sqrt(np.dot(direction, direction))
+            if length > 0:
+                direction /= length
+                self.covariance += 10.0 * np.outer(direction, direction)
+        self.project()
+
+    def project(self):
+        """Recompute the background directions and the projection matrix."""
+        values, vectors = np.linalg.eigh(self.covariance)
+        basis = vectors[:, np.argsort(values)[::-1][:self.components]]
+        self.projection = np.identity(self.windows) - np.dot(basis, basis.T)
+
+    def score(self, hist, sampletime=1.0):
+        """Return (score, residual) for a histogram without learning from it."""
+        x = self.group(hist)
+        n = x.sum()
+        if n <= 0:
+            return 0.0, None
+        expected = n * self.shape
+        residual = (x - expected) / np.sqrt(expected)
+        projected = np.dot(self.projection, residual)
+        excess = 0.0
+        if self.rate:
+            expectedCounts = self.rate * sampletime
+            excess = max(0.0, (n - expectedCounts) / np.sqrt(expectedCounts))
+        score = (np.dot(projected, projected) + excess * excess) / \
+                (self.dof + 1)
+        return float(score), residual
+
+    def scoreMany(self, hists, sampletimes=1.0):
+        """Score an (N x bins) batch of histograms against the current model
+           without learning from them. Returns N scores, 0 for empty ones."""
+        x = np.add.reduceat(np.asarray(hists, dtype=float), self.starts,
+                            axis=1)
+        n = x.sum(axis=1)
+        empty = n <= 0
+        n[empty] = 1.0
+        expected = n[:, np.newaxis] * self.shape
+        projected = np.dot((x - expected) / np.sqrt(expected),
+                           self.projection.T)
+        excess = np.zeros(len(n))
+        if self.rate:
+            expectedCounts = self.rate * np.asarray(sampletimes, dtype=float)
+            excess = np.maximum(0.0, (n - expectedCounts) /
+                                     np.sqrt(expectedCounts))
+        scores = ((projected ** 2).sum(axis=1) + excess ** 2) / (self.dof + 1)
+        scores[empty] = 0.0
+        return scores
+
+    def update(self, hist, sampletime=1.0):
+        """Score a histogram and, if it looks like background or the model
+           is still warming up, fold it into the model. Returns the score."""
+        score, residual = self.score(hist, sampletime)
+        warming = self.updates < self.warmup
+        if residual is None or (score >= self.threshold and not warming):
+            return score
+        x = self.group(hist)
+        n = x.sum()
+        a = self.alpha
+        if warming:
+            # A running mean of the samples so far replaces the seed
+            a = max(a, 1.0 / (self.updates + 2))
+        self.shape = (1 - a) * self.shape + a * np.maximum(x / n, 1e-9)
+        self.shape /= self.shape.sum()
+        rate = n / float(sampletime)
+        self.rate = rate if self.rate is None else \
+                    (1 - a) * self.rate + a * rate
+        self.covariance *= 1 - a
+        self.covariance += a * np.outer(residual, residual)
+        self.updates += 1
+        if self.updates % self.refit == 0 or self.updates == self.warmup:
+            self.project()
+        return score
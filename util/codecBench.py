@@ -0,0 +1,63 @@
+"""Report histCodec compression ratio and throughput on the sample spectra.
+
+Run from the util directory:
+
+    python codecBench.py [--repeat 200]
+
+For each spectrum in samples/ this prints the size of the Postgres integer[]
+representation (4 bytes per bin plus a 24-byte header), the packed sizes with
+and without zlib, and then the overall encode and decode rates.
+"""
+
+import argparse, glob, os, time
+import numpy as np
+import histCodec
+
+SAMPLES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..",
+                       "samples", "*.csv")
+
+def loadSamples(pattern=SAMPLES):
+    """Return (name, histogram) pairs for every sample spectrum."""
+    spectra = []
+    for path in sorted(glob.glob(pattern)):
+        hist = np.loadtxt(path, delimiter=",").astype(np.int64)
+        spectra.append((os.path.basename(path), hist))
+    return spectra
+
+def rate(function, items, repeat):
+    started = time.time()
+    for _ in range(repeat):
+        for item in items:
+            function(item)
+    return repeat * len(items) / (time.time() - started)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--repeat", type=int, default=200,
+                        help="passes over the samples when timing")
+    args = parser.parse_args()
+
+    spectra = loadSamples()
+    rawTotal = varintTotal = zlibTotal = 0
+    print "%-44s %8s %8s %8s %7s" % ("spectrum", "int[]", "varint", "zlib",
+                                     "ratio")
+    for name, hist in spectra:
+        raw = 24 + 4 * len(hist)
+        varint = len(histCodec.encode(hist, compress=False))
+        packed = len(histCodec.encode(hist))
+        assert np.array_equal(histCodec.decode(histCodec.encode(hist)), hist)
+        rawTotal += raw
+        varintTotal += varint
+        zlibTotal += packed
+        print "%-44s %8d %8d %8d %6.1fx" % (name, raw, varint, packed,
+                                            float(raw) / packed)
+    print "%-44s %8d %8d %8d %6.1fx" % ("total", rawTotal, varintTotal,
+                                        zlibTotal, float(rawTotal) / zlibTotal)
+
+    hists = [hist for name, hist in spectra]
+    blobs = histCodec.encodeMany(hists)
+    print "encode: %.0f spectra/s" % rate(histCodec.encode, hists, args.repeat)
+    print "decode: %.0f spectra/s" % rate(histCodec.decode, blobs, args.repeat)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+"""Watch radmonitor.config and report what changed.
+
+A ConfigWatcher waits on inotify for the config file to be written or
+replaced (editors usually write a new file and rename it over the old one,
+so the directory is watched, not the file). Each time, it parses the file,
+compares it with the last good config and queues the differences; take()
+hands them over, so that the acquisition loop can apply them at a sample
+boundary of its choosing. A file that fails to parse is reported and
+otherwise ignored until it is fixed.
+
+Without inotify (not Linux, or an old kernel) the file's modification time is
+polled once a second on the shared scheduler instead.
+
+Differences are a dict of the top-level settings whose values changed, with
+their new values. "radsettings" is diffed one level deeper, so it holds only
+the detector registers that changed.
+"""
+
+import ctypes, ctypes.util, json, os, struct, threading, time
+from scheduler import sharedScheduler
+
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+
+EVENT = struct.Struct("iIII")
+
+def diff(old, new):
+    """Return the settings of new that differ from old."""
+    changes = {}
+    for key in set(old) | set(new):
+        if old.get(key) == new.get(key):
+            continue
+        if key == "radsettings" and key in old and key in new:
+            changes[key] = dict((name, value)
+                                for name, value in new[key].items()
+                                if old[key].get(name) != value)
+        else:
+            changes[key] = new.get(key)
+    return changes
+
+def inotify():
+    """Return (init, addWatch) from libc, or None without inotify."""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        return libc.inotify_init, libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+
+class ConfigWatcher(threading.Thread):
+    """Watch a JSON config file. config holds the last good config."""
+
+    def __init__(self, path, settle=0.1):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.path = os.path.abspath(path)
+        self.settle = settle
+        self.lock = threading.Lock()
+        self.changes = {}
+        self.running = True
+        self.job = None
+        self.fd = None
+        self.mtime = os.stat(self.path).st_mtime
+        self.config = self.read()
+
+    def read(self):
+        with open(self.path) as config:
+            return json.load(config)
+
+    def reload(self):
+        """Read the file and queue its differences from the last good
+           config. Returns the differences."""
+        try:
+            config = self.read()
+        except (IOError, ValueError) as error:
+            print "Ignoring unreadable config %s: %s" % (self.path, error)
+            return {}
+        changes = diff(self.config, config)
+        if changes:
+            with self.lock:
+                for key, value in changes.items():
+                    if key == "radsettings" and key in self.changes:
+                        self.changes[key].update(value)
+                    else:
+                        self.changes[key] = value
+            self.config = config
+        return changes
+
+    def take(self):
+        """Return and clear the differences queued since the last call."""
+        with self.lock:
+            changes, self.changes = self.changes, {}
+        return changes
+
+    def start(self):
+        calls = inotify()
+        if calls is not None:
+            init, addWatch = calls
+            self.fd = init()
+            if self.fd >= 0 and addWatch(self.fd, os.path.dirname(self.path),
+                                         IN_CLOSE_WRITE | IN_MOVED_TO |
+                                         IN_CREATE) >= 0:
+                threading.Thread.start(self)
+                return
+        self.job = sharedScheduler().every(1, self.poll, jobName="configWatch")
+
+    def run(self):
+        name = os.path.basename(self.path)
+        while self.running:
+            events = os.read(self.fd, 4096)
+            if not self.touches(events, name):
+                continue
+            # Let the editor finish writing before reading
+            time.sleep(self.settle)
+            self.reload()
+
+    def touches(self, events, name):
+        """Whether a buffer of inotify events mentions the file."""
+        offset = 0
+        while offset + EVENT.size <= len(events):
+            length = EVENT.unpack_from(events, offset)[3]
+            start = offset + EVENT.size
+            if events[start:start + length].rstrip("\0") == name:
+                return True
+            offset = start + length
+        return False
+
+    def poll(self):
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            return
+        if mtime != self.mtime:
+            self.mtime = mtime
+            self.reload()
+
+    def stop(self):
+        self.running = False
+        if self.job is not None:
+            self.job.cancel()
@@ -0,0 +1,360 @@
+"""Several eMorphos acquiring in step, each on its own thread.
+
+discover() opens every attached eMorpho and identifies it by serial number.
+Each one then runs as a Detector thread, and an Acquisition (driven by the
+monitor's main loop) keeps them on one sample clock:
+
+    Acquisition.next()                  Detector threads
+    arm cycle k                 --->    startTimedHistogram(duration)
+                                        wait out the window, read out
+                                <---    report(k, reading)
+    wait for every detector that joined, up to grace seconds after the
+    window closes; return the cycle's readings as one group
+
+The next cycle is armed as soon as a group is returned, so all detectors
+open and close their windows together and a group shares one GPS position.
+A detector whose readout fails reconnects on its own thread while the
+others carry on, and joins again at the first cycle after it is back. One
+that misses the grace period has its reading for that cycle dropped.
+
+Register settings come from radmonitor.config: "radsettings", overridden per
+serial by the "detectors" section,
+
+    "detectors": {"eRC0331": {"sensor": 2, "radsettings": {"HV": 1025}}}
+
+or, for a serial with no entry when several detectors are attached, from
+eMorphoConfig.eMorphoSetup.
+"""
+
+import threading, time, traceback
+from eMorphoConfig import eMorphoSetup
+from util.leds import controller as leds
+from util.monotonic import monotonic
+from util import metrics
+
+readTime = metrics.histogram("read_histogram_seconds",
+                             "eMorpho histogram readout", ("detector",))
+statsTime = metrics.histogram("read_stats_seconds", "eMorpho stats readout",
+                              ("detector",))
+armTime = metrics.histogram("arm_seconds", "Starting the next timed histogram",
+                            ("detector",))
+lateness = metrics.histogram("readout_lateness_seconds",
+                             "Delay from a window closing to its readout",
+                             ("detector",))
+deadTime = metrics.histogram("dead_time_seconds",
+                             "Detector unarmed time between windows",
+                             ("detector",))
+jitter = metrics.histogram("sample_jitter_seconds",
+                           "Deviation of the sample period from sampleTime")
+samplesRead = metrics.counter("samples_read_total", "Histograms read out",
+                              ("detector",))
+reconnects = metrics.counter("detector_reconnects_total", "eMorpho reconnects",
+                             ("detector",))
+drops = metrics.counter("dropped_samples_total", "Samples not recorded",
+                        ("cause",))
+
+def serialOf(e, index):
+    """The serial number the eMorpho handle reports, or a name from its
+       index if it can't say."""
+    for name in ("getSerial", "serialNumber", "serial"):
+        value = getattr(e, name, None)
+        if callable(value):
+            try:
+                value = value()
+            except Exception:
+                value = None
+        if value:
+            return str(value)
+    return "device%d" % index
+
+def discover(factory, limit=8):
+    """Open every attached eMorpho. factory() returns a new, unopened
+       handle. Returns a list of (index, handle, serial)."""
+    probe = factory()
+    count = probe.scan()
+    bounded = isinstance(count, int)
+    found = []
+    for index in range(count if bounded else limit):
+        e = probe if not found else factory()
+        if e is not probe:
+            e.scan()
+        if e.open(index) == False:
+            if bounded:
+                continue
+            break
+        found.append((index, e, serialOf(e, index)))
+    return found
+
+def registersFor(config, serial, count):
+    """Return (sensor, registers) for a detector from the config. registers
+       is None when eMorphoSetup should configure it, and sensor is None
+       when the config doesn't give one."""
+    entry = config.get("detectors", {}).get(serial)
+    registers = dict(config["radsettings"])
+    if entry is not None:
+        registers.update(entry.get("radsettings", {}))
+        return entry.get("sensor"), registers
+    if count > 1:
+        try:
+            eMorphoSetup(_Registers(), serial)
+            return None, None
+        except ValueError:
+            pass
+    return None, registers
+
+class _Registers(object):
+    """Accepts eMorphoSetup's register writes, to check a serial is known."""
+
+class Detector(threading.Thread):
+    """Acquires from one eMorpho in the cycles of an Acquisition."""
+
+    def __init__(self, index, e, serial, sensor, acquisition):
+        threading.Thread.__init__(self, name=serial)
+        self.daemon = True
+        self.index = index
+        self.e = e
+        self.serial = serial
+        self.sensor = sensor
+        self.acquisition = acquisition
+        self.registers = None
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.connected = True
+        self.windowEnd = None
+        self.reads = 0
+        self.failures = 0
+
+    def configure(self, registers):
+        """Set register values (None: use eMorphoSetup) from scratch."""
+        self.registers = None if registers is None else dict(registers)
+        if registers is None:
+            eMorphoSetup(self.e, self.serial)
+        else:
+            for setting, value in registers.items():
+                setattr(self.e, setting, value)
+        self.e.clearStats()
+
+    def update(self, registers):
+        """Queue register changes, written before the detector is next armed
+           so no window straddles them."""
+        with self.lock:
+            self.pending.update(registers)
+
+    def _applyPending(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        for setting, value in pending.items():
+            setattr(self.e, setting, value)
+            if self.registers is not None:
+                self.registers[setting] = value
+
+    def reconnect(self, limit=8):
+        """Reopen this detector, by serial if the USB index changed, retrying
+           until it is back or acquisition stops."""
+        self.connected = False
+        self.windowEnd = None
+        reconnects.inc(detector=self.serial)
+        acquisition = self.acquisition
+        while acquisition.running:
+            self.e.scan()
+            for index in [self.index] + [i for i in range(limit)
+                                         if i != self.index]:
+                if self.e.open(index) == False:
+                    continue
+                serial = serialOf(self.e, index)
+                if serial == self.serial or serial == "device%d" % index:
+                    self.index = index
+                    self.configure(self.registers)
+                    self.connected = True
+                    leds().set("gps", "off")
+                    return True
+                if hasattr(self.e, "close"):
+                    self.e.close()
+            print "Could not reconnect to detector %s" % self.serial
+            leds().set("gps", "heartbeat")
+            acquisition.sleep(5)
+        return False
+
+    def cycle(self, cycle, duration):
+        """Run one timed histogram. Returns the reading, or None if the
+           detector failed and has been reconnected."""
+        e = self.e
+        self._applyPending()
+        with armTime.time(detector=self.serial):
+            e.startTimedHistogram(duration)
+        clock = self.acquisition.clock
+        started = clock()
+        dead = 0.0 if self.windowEnd is None else \
+               max(0.0, started - self.windowEnd)
+        due = started + duration
+        self.acquisition.sleep(due - clock())
+        lateness.observe(max(0.0, clock() - due), detector=self.serial)
+        self.reads += 1
+        with readTime.time(detector=self.serial):
+            hist = e.readHistogram()
+        if hist == False:
+            print "Error: Couldn't read the histogram from %s" % self.serial
+            self.failures += 1
+            drops.inc(cause="read_failed")
+            self.acquisition.failed(self, cycle)
+            self.reconnect()
+            return None
+        with statsTime.time(detector=self.serial):
+            stats = e.readStats()
+        # The detector stopped counting when the window was due; the readout
+        # that follows is dead time for the next window
+        self.windowEnd = due
+        samplesRead.inc(detector=self.serial)
+        deadTime.observe(dead, detector=self.serial)
+        return {"histogram": hist, "cps": stats["cps"], "sampletime": duration,
+                "deadtime": dead, "temp": e.getTemperature(),
+                "compression": getattr(e, "compression", None),
+                "sensor": self.sensor, "detector": self.serial}
+
+    def run(self):
+        acquisition = self.acquisition
+        last = -1
+        while True:
+            joined = acquisition.join(self, last)
+            if joined is None:
+                return
+            last, duration = joined
+            try:
+                reading = self.cycle(last, duration)
+            except acquisition.fatal as error:
+                acquisition.abort(error)
+                return
+            except Exception:
+                print "Error: Detector %s failed:" % self.serial
+                traceback.print_exc()
+                self.failures += 1
+                drops.inc(cause="read_failed")
+                acquisition.failed(self, last)
+                self.reconnect()
+                continue
+            if reading is not None:
+                acquisition.report(self, last, reading)
+
+class Acquisition(object):
+    """The shared sample clock. clock and sleep are monotonic seconds (a
+       replay's own, when replaying); grace is how long after a window closes
+       to wait for slow detectors, and join how late into a window a detector
+       may still start it. Exceptions of the types in fatal stop acquisition
+       and are raised from next()."""
+
+    def __init__(self, period, clock=monotonic, sleep=time.sleep, now=time.time,
+                 grace=None, fatal=()):
+        self.period = period
+        self.clock = clock
+        self.sleep = sleep
+        self.now = now
+        self.grace = grace
+        self.fatal = tuple(fatal)
+        self.detectors = []
+        self.condition = threading.Condition()
+        self.cycleNumber = -1
+        self.armed = None
+        self.duration = period
+        self.open = False
+        self.expected = set()
+        self.readings = {}
+        self.error = None
+        self.running = True
+
+    def add(self, detector):
+        self.detectors.append(detector)
+
+    def start(self):
+        for detector in self.detectors:
+            detector.start()
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+
+    def abort(self, error):
+        with self.condition:
+            self.error = error
+            self.condition.notify_all()
+
+    def setPeriod(self, period):
+        """Change the sample time from the next cycle on."""
+        self.period = period
+
+    def join(self, detector, last):
+        """Called by a detector thread: wait for a cycle after last that has
+           just been armed, and join it. Returns (cycle, duration), or None
+           when acquisition stops."""
+        with self.condition:
+            while self.running:
+                if self.open and self.cycleNumber > last and \
+                   self.clock() - self.armed <= self.lateJoin():
+                    self.expected.add(detector)
+                    return self.cycleNumber, self.duration
+                if self.cycleNumber > last:
+                    last = self.cycleNumber
+                self.condition.wait(0.5)
+            return None
+
+    def lateJoin(self):
+        return min(0.1 * self.duration, 0.25)
+
+    def report(self, detector, cycle, reading):
+        with self.condition:
+            if not self.open or cycle != self.cycleNumber:
+                drops.inc(cause="late")
+                return
+            self.readings[detector] = reading
+            self.condition.notify_all()
+
+    def failed(self, detector, cycle):
+        with self.condition:
+            if cycle == self.cycleNumber:
+                self.expected.discard(detector)
+                self.condition.notify_all()
+
+    def next(self):
+        """Arm the next cycle, wait for it, and return its group:
+           {"windowStart": epoch, "windowEnd": epoch, "samples": readings},
+           readings in the order the detectors were added."""
+        with self.condition:
+            if self.error is not None:
+                raise self.error
+            previous = self.armed
+            self.cycleNumber += 1
+            self.duration = self.period
+            self.armed = self.clock()
+            windowStart = self.now()
+            self.expected = set()
+            self.readings = {}
+            self.open = True
+            self.condition.notify_all()
+        if previous is not None:
+            jitter.observe(abs(self.armed - previous - self.duration))
+        due = self.armed + self.duration
+        grace = self.grace if self.grace is not None else \
+                min(0.25 * self.duration, 1.0)
+        self.sleep(due - self.clock())
+        with self.condition:
+            while self.error is None and \
+                  (not self.expected or
+                   set(self.readings) < self.expected) and \
+                  self.clock() < due + grace:
+                self.condition.wait(0.01)
+            if self.error is not None:
+                raise self.error
+            self.open = False
+            for detector in self.expected - set(self.readings):
+                print "Error: No reading from %s in time" % detector.serial
+                drops.inc(cause="late")
+            readings = [self.readings[detector] for detector in self.detectors
+                        if detector in self.readings]
+        return {"windowStart": windowStart, "windowEnd": self.now(),
+                "samples": readings}
+
+    def stats(self):
+        return [{"detector": detector.serial, "sensor": detector.sensor,
+                 "connected": detector.connected, "reads": detector.reads,
+                 "failures": detector.failures}
+                for detector in self.detectors]
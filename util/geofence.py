@@ -0,0 +1,139 @@
+"""Geofencing against any number of zones.
+
+Zones are circles (a center and a range in meters) or polygons (a list of
+[latitude, longitude] vertices), each with a name and a kind:
+
+- "base": a base station; the monitor brings WiFi up on entering one.
+- "exclusion": an area where samples are not recorded.
+- "survey": an area of interest; entering and leaving it is only reported.
+
+Zones are projected once to the Texas Central plane (SRID 3663), where
+distances are plain Euclidean meters, and entered in a uniform grid index, so
+classifying a fix is one projection, one dictionary lookup and exact tests
+against the few zones that overlap that grid cell. update() compares each
+classification with the previous one and calls subscribers with "enter" and
+"exit" events.
+
+Zones are read from the "geofence" section of radmonitor.config; a config
+with only the old "baseCoords" setting gives a single base zone.
+"""
+
+import math
+import numpy as np
+from util.projection import texasCentral
+
+class CircleZone(object):
+
+    def __init__(self, name, kind, latitude, longitude, range):
+        self.name = name
+        self.kind = kind
+        self.x, self.y = [float(v) for v in texasCentral(longitude, latitude)]
+        self.radius = float(range)
+
+    def bounds(self):
+        return (self.x - self.radius, self.y - self.radius,
+                self.x + self.radius, self.y + self.radius)
+
+    def contains(self, x, y):
+        dx = x - self.x
+        dy = y - self.y
+        return dx * dx + dy * dy <= self.radius * self.radius
+
+class PolygonZone(object):
+
+    def __init__(self, name, kind, polygon):
+        self.name = name
+        self.kind = kind
+        polygon = np.asarray(polygon, dtype=float)
+        xs, ys = texasCentral(polygon[:, 1], polygon[:, 0])
+        self.xs = [float(v) for v in xs]
+        self.ys = [float(v) for v in ys]
+
+    def bounds(self):
+        return (min(self.xs), min(self.ys), max(self.xs), max(self.ys))
+
+    def contains(self, x, y):
+        """Even-odd ray casting test."""
+        inside = False
+        xs, ys = self.xs, self.ys
+        j = len(xs) - 1
+        for i in range(len(xs)):
+            if (ys[i] > y) != (ys[j] > y) and \
+               x < (xs[j] - xs[i]) * (y - ys[i]) / (ys[j] - ys[i]) + xs[i]:
+                inside = not inside
+            j = i
+        return inside
+
+def makeZone(spec):
+    """Build a zone from its config dict."""
+    spec = dict(spec)
+    name = spec.pop("name")
+    kind = spec.pop("kind", "survey")
+    if "polygon" in spec:
+        return PolygonZone(name, kind, spec["polygon"])
+    return CircleZone(name, kind, spec["latitude"], spec["longitude"],
+                      spec["range"])
+
+class Geofence(object):
+    """Classify fixes against zones and report zone entries and exits.
+
+       cellSize is the side in meters of the grid used to index the zones."""
+
+    def __init__(self, zones, cellSize=250.0):
+        self.zones = list(zones)
+        self.cellSize = float(cellSize)
+        self.index = {}
+        for zone in self.zones:
+            xmin, ymin, xmax, ymax = [int(math.floor(v / self.cellSize))
+                                      for v in zone.bounds()]
+            for cx in range(xmin, xmax + 1):
+                for cy in range(ymin, ymax + 1):
+                    self.index.setdefault((cx, cy), []).append(zone)
+        self.current = frozenset()
+        self.subscribers = []
+
+    @classmethod
+    def fromConfig(cls, config):
+        """Build a Geofence from a loaded radmonitor.config dict."""
+        fence = config.get("geofence")
+        if fence is None:
+            base = config["baseCoords"]
+            return cls([CircleZone("base", "base", base["latitude"],
+                                   base["longitude"], base["range"])])
+        return cls([makeZone(zone) for zone in fence.get("zones", [])],
+                   fence.get("cellSize", 250.0))
+
+    def subscribe(self, callback, kind=None, name=None):
+        """Call callback(event, zone) on "enter" and "exit" events, optionally
+           only for zones of one kind or with one name."""
+        self.subscribers.append((callback, kind, name))
+
+    def classify(self, latitude, longitude):
+        """Return the zones containing a point."""
+        x, y = texasCentral(longitude, latitude)
+        x, y = float(x), float(y)
+        cell = (int(math.floor(x / self.cellSize)),
+                int(math.floor(y / self.cellSize)))
+        return frozenset(zone for zone in self.index.get(cell, ())
+                         if zone.contains(x, y))
+
+    def update(self, latitude, longitude):
+        """Classify a new fix, fire enter and exit events for any change from
+           the previous fix, and return the zones containing it."""
+        zones = self.classify(latitude, longitude)
+        for event, changed in (("exit", self.current - zones),
+                               ("enter", zones - self.current)):
+            for zone in changed:
+                for callback, kind, name in self.subscribers:
+                    if (kind is None or kind == zone.kind) and \
+                       (name is None or name == zone.name):
+                        callback(event, zone)
+        self.current = zones
+        return zones
+
+    def inside(self, kind):
+        """Whether the last fix was inside any zone of a kind."""
+        return any(zone.kind == kind for zone in self.current)
+
+    def names(self):
+        return ",".join(sorted(zone.name for zone in self.current))
@@ -1,14 +1,96 @@
+"""GPS access, through gpsd (GPSD) or straight off a serial port (GPS).
+
+GPSD's reader thread blocks on gpsd reports and keeps the most recent fixes,
+with their times already parsed, in a FixBuffer. locationAt() interpolates a
+position for the middle of an acquisition window from that buffer, so each
+spectrum is tagged with where the detector was while it was counting rather
+than where it was when the histogram was read out. With adjustTime, the
+reader thread also sets the system clock from the fixes when it is more than
+10 seconds off.
+"""
+
 from __future__ import absolute_import
-import serial, threading, time, pytz, os
+import threading, time, pytz, os, bisect, calendar, math, socket
 from numpy import mean, sqrt, square
 from datetime import datetime, timedelta
 from pytz import timezone
 from dateutil import parser
-from gps import *
+
+# The gps and serial modules are only needed to talk to real hardware; the
+# replay backend in util/replay.py uses this module without them.
+try:
+    from gps import *
+except ImportError:
+    gps = None
+try:
+    import serial
+except ImportError:
+    serial = None
+
+def parseTime(value):
+    """Return a gpsd time (epoch float or ISO 8601 UTC string) as epoch
+       seconds, or None if it can't be parsed."""
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        whole = calendar.timegm(time.strptime(value[:19], "%Y-%m-%dT%H:%M:%S"))
+    except (TypeError, ValueError):
+        return None
+    fraction = value[19:].rstrip("Z")
+    if fraction.startswith("."):
+        whole += float(fraction)
+    return float(whole)
+
+def fixError(mode, epx, epy, epv):
+    """RMS of the position error estimates, as recorded in the hdop column;
+       -1 without a fix."""
+    if mode == 2:
+        return math.sqrt((epx * epx + epy * epy) / 2.0)
+    if mode == 3:
+        return math.sqrt((epx * epx + epy * epy + epv * epv) / 3.0)
+    return -1
+
+class FixBuffer(object):
+    """Ring of recent fixes, written by one thread and read by any number of
+       others without locking. Fixes are immutable tuples of
+
+           (epoch, received, latitude, longitude, altitude, gpsError, mode)
+
+       and the write counter only moves once a slot has been filled, so
+       readers always see whole fixes."""
+
+    def __init__(self, size=64):
+        self.slots = [None] * size
+        self.count = 0
+
+    def append(self, fix):
+        self.slots[self.count % len(self.slots)] = fix
+        self.count += 1
+
+    def snapshot(self):
+        """Return the buffered fixes, oldest first."""
+        count = self.count
+        size = len(self.slots)
+        fixes = [self.slots[i % size] for i in range(max(0, count - size), count)]
+        return sorted(fix for fix in fixes if fix is not None)
+
+class Location(object):
+    """A position interpolated from buffered fixes. Has the attributes of
+       gpsd's fix that the monitor uses."""
+
+    def __init__(self, latitude, longitude, altitude, gpsError, mode,
+                 timestamp):
+        self.latitude = latitude
+        self.longitude = longitude
+        self.altitude = altitude
+        self.gpsError = gpsError
+        self.mode = mode
+        self.timestamp = timestamp
+        self.time_accurate = False
 
 class GPSD(threading.Thread):
 
-    def __init__(self, TZ, adjustTime):
+    def __init__(self, TZ, adjustTime, bufferSize=64):
         threading.Thread.__init__(self)
         self.daemon = True
         self.session = gps(mode=WATCH_ENABLE|WATCH_NEWSTYLE)
@@ -19,11 +101,48 @@ class GPSD(threading.Thread):
         print self.tzOffsetHours
         self.adjustTime = adjustTime in ['true', '1', 'True']
         self.previousGPSTime = None
+        self.previousFix = None
+        self.fixes = FixBuffer(bufferSize)
         
     def run(self):
         while self.running:
-          self.session.next()
-          time.sleep(0.2)
+          try:
+            report = self.session.next()
+          except (StopIteration, socket.error, IOError):
+            # gpsd went away or retry() replaced the session; wait for it
+            time.sleep(1)
+            continue
+          if report.get("class") == "TPV":
+            self.record(report)
+
+    def record(self, report):
+        """Add a TPV report to the fix buffer if it carries a position."""
+        mode = report.get("mode", 0)
+        epoch = parseTime(report.get("time"))
+        if mode < 2 or epoch is None or "lat" not in report:
+          return
+        nan = float("nan")
+        error = fixError(mode, report.get("epx", nan), report.get("epy", nan),
+                         report.get("epv", nan))
+        self.syncClock(epoch)
+        self.fixes.append((epoch, time.time(), report["lat"], report["lon"],
+                           report.get("alt", nan), error, mode))
+
+    def syncClock(self, epoch):
+        """Set the system clock to a fix's GPS time if adjustTime is on and
+           it is more than 10 seconds off. The first fix is only used to
+           confirm the second."""
+        previous, self.previousFix = self.previousFix, epoch
+        if not self.adjustTime or previous is None or \
+           abs(time.time() - epoch) <= 10:
+          return
+        timestamp = datetime.fromtimestamp(epoch, self.tz)
+        print "Updating System time from GPS to: " + str(timestamp)
+        command = 'date --set="' + str(timestamp) + '"'
+        os.system(command)
+        # Buffered fixes were received by the old clock; they would skew the
+        # offset locationAt() finds between the clocks
+        self.fixes = FixBuffer(len(self.fixes.slots))
 
     def stop(self):
         self.running = False
@@ -31,7 +150,44 @@ class GPSD(threading.Thread):
         self.join(2)
 
     def retry(self):
+        old = self.session
         self.session = gps(mode=WATCH_ENABLE|WATCH_NEWSTYLE)
+        old.close()
+
+    def locationAt(self, start, end, maxGap=2.0):
+        """Return the position at the middle of the acquisition window
+           [start, end], given in system time.time() seconds, interpolated
+           between the buffered fixes either side of it. Returns None if the
+           nearest fixes are more than maxGap seconds away.
+
+           The system clock need not agree with GPS time: the smallest
+           difference between when a fix was received and its GPS time is
+           used as the offset between the two clocks."""
+        fixes = self.fixes.snapshot()
+        if not fixes:
+          return None
+        offset = min(fix[1] - fix[0] for fix in fixes)
+        target = (start + end) / 2.0 - offset
+        epochs = [fix[0] for fix in fixes]
+        i = bisect.bisect_left(epochs, target)
+        if i == 0 or i == len(fixes):
+          nearest = fixes[0] if i == 0 else fixes[-1]
+          if abs(nearest[0] - target) > maxGap:
+            return None
+          before = after = nearest
+          weight = 0.0
+        else:
+          before, after = fixes[i - 1], fixes[i]
+          if min(target - before[0], after[0] - target) > maxGap:
+            return None
+          weight = (target - before[0]) / (after[0] - before[0])
+
+        def blend(field):
+          return before[field] + weight * (after[field] - before[field])
+
+        return Location(blend(2), blend(3), blend(4),
+                        max(before[5], after[5]), min(before[6], after[6]),
+                        datetime.fromtimestamp(target, self.tz))
 
     def getLocation(self):
         location = self.session.fix
@@ -40,19 +196,16 @@ class GPSD(threading.Thread):
           if self.previousGPSTime == None or abs(location.timestamp - self.previousGPSTime) > timedelta(seconds=30):
             location.timestamp = location.timestamp - self.tzOffsetHours # some timezone is accounted for by GPS
         else:
-          location.timestamp = parser.parse(location.time).astimezone(self.tz)
-        location.gpsError = -1
-        if location.mode == 2:
-          location.gpsError = sqrt(mean(square([location.epx, location.epy])))
-        if location.mode == 3:
-          location.gpsError = sqrt(mean(square([location.epx, location.epy, location.epv])))
+          epoch = parseTime(location.time)
+          if epoch is None:
+            location.timestamp = parser.parse(location.time).astimezone(self.tz)
+          else:
+            location.timestamp = datetime.fromtimestamp(epoch, self.tz)
+        location.gpsError = fixError(location.mode, location.epx, location.epy,
+                                     location.epv)
         location.time_accurate = False
-        if(self.adjustTime and self.previousGPSTime is not None and location.gpsError >= 0):
-          currentTime = datetime.now(self.tz)
-          if abs(currentTime - location.timestamp).total_seconds() > 10:
-            print "Updating System time from GPS to: " + str(location.timestamp)
-            command = 'date --set="' + str(location.timestamp) + '"'
-            os.system(command)
+        # The clock itself is set by record() as reports arrive
+        if(self.adjustTime and self.previousFix is not None and location.gpsError >= 0):
           location.time_accurate = True
         self.previousGPSTime = location.timestamp
         return location
@@ -0,0 +1,443 @@
+"""Smoothed count-rate and significance maps on the Texas Central plane.
+
+Instead of interpolating between every measurement, observations are
+projected to SRID 3663 in one vectorized call, binned onto a raster with
+bincount (counts and live time per pixel), and smoothed with a Gaussian
+kernel by FFT convolution, so the cost is O(pixels log pixels) whatever the
+number of points. From the smoothed sums
+
+    intensity    = K*counts / K*live             (live-time weighted cps)
+    significance = (K*counts - b K*live) / sqrt(b K^2*live)
+
+where b is the background rate (by default the live-time weighted median of
+the pixel rates) and K^2*live is the Poisson variance of the weighted sum.
+Pixels with less than minLive seconds of smoothed live time are left empty.
+
+Maps are written as a single image or as a pyramid of 256 pixel tiles,
+tiles/{zoom}/{x}/{y}.png, on a fixed grid in SRID 3663 meters with
+RESOLUTION / 2**zoom meters per pixel. Each tile's fingerprint (a hash of the
+binned data under it, including the kernel's reach, and of the rendering
+settings) is kept in tiles.json, and a rerun only smooths and rewrites the
+tiles whose fingerprint changed. A color scale or background chosen from the
+data is kept there too and reused, so new data doesn't restyle every tile.
+Images need Matplotlib; the surfaces don't.
+
+Observations come from histograms, or from a square rollup grid (see
+rollup.py), which is much faster to read for large areas. Run from the util
+directory:
+
+    python heatmap.py image map.png [--resolution 10] [--bandwidth 50]
+    python heatmap.py tiles tiles/ --zooms 6-10 [--rollup square-50]
+    python heatmap.py ... --surface significance
+"""
+
+import argparse, hashlib, json, os
+import numpy as np
+import psycopg2
+import projection, rollup
+
+TILE = 256
+RESOLUTION = 2560.0             # meters per pixel at zoom 0
+
+class Observations(object):
+    """Points in SRID 3663 with their live time and counts."""
+
+    def __init__(self, x, y, livetime, counts):
+        self.x = np.asarray(x, dtype=float)
+        self.y = np.asarray(y, dtype=float)
+        self.livetime = np.asarray(livetime, dtype=float)
+        self.counts = np.asarray(counts, dtype=float)
+
+    def bounds(self):
+        return self.x.min(), self.y.min(), self.x.max(), self.y.max()
+
+def readObservations(conn, where=None, chunk=50000):
+    """Read every located histograms row through a named cursor and project
+       them in bulk."""
+    cur = conn.cursor("heatmap")
+    cur.itersize = chunk
+    cur.execute("SELECT ST_X(location), ST_Y(location), sampletime, cps " +
+                "FROM histograms WHERE location IS NOT NULL AND cps IS NOT " +
+                "NULL AND sampletime > 0" + (" AND (%s)" % where if where
+                                             else ""))
+    blocks = []
+    while True:
+        rows = cur.fetchmany(chunk)
+        if not rows:
+            break
+        blocks.append(np.array(rows, dtype=float))
+    cur.close()
+    rows = np.concatenate(blocks) if blocks else np.zeros((0, 4))
+    x, y = projection.texasCentral(rows[:, 0], rows[:, 1])
+    return Observations(x, y, rows[:, 2], rows[:, 2] * rows[:, 3])
+
+def rollupObservations(conn, name):
+    """Use the cells of a rollup grid as observations at the cell centers."""
+    shape, size = name.split("-")
+    if shape != "square":
+        raise ValueError("Only square rollup grids can be rasterized")
+    cur = conn.cursor()
+    cells = rollup.cellRates(cur, rollup.Grid(shape, float(size)))
+    cur.close()
+    return Observations(cells["x"], cells["y"], cells["livetime"],
+                        cells["cps"] * cells["livetime"])
+
+class Raster(object):
+    """Counts and live time summed per pixel. Row 0 is the southern edge."""
+
+    def __init__(self, xmin, ymin, resolution, width, height):
+        self.xmin = xmin
+        self.ymin = ymin
+        self.resolution = resolution
+        self.width = width
+        self.height = height
+        self.counts = np.zeros((height, width))
+        self.live = np.zeros((height, width))
+
+    @classmethod
+    def around(cls, observations, resolution, margin=0.0):
+        """A raster aligned to multiples of resolution covering the
+           observations plus margin meters."""
+        xmin, ymin, xmax, ymax = observations.bounds()
+        xmin = np.floor((xmin - margin) / resolution) * resolution
+        ymin = np.floor((ymin - margin) / resolution) * resolution
+        width = int(np.ceil((xmax + margin - xmin) / resolution)) + 1
+        height = int(np.ceil((ymax + margin - ymin) / resolution)) + 1
+        return cls(xmin, ymin, resolution, width, height)
+
+    def add(self, observations):
+        """Bin observations; those outside the raster are ignored."""
+        col = np.floor((observations.x - self.xmin) /
+                       self.resolution).astype(int)
+        row = np.floor((observations.y - self.ymin) /
+                       self.resolution).astype(int)
+        inside = (col >= 0) & (col < self.width) & (row >= 0) & \
+                 (row < self.height)
+        index = row[inside] * self.width + col[inside]
+        size = self.width * self.height
+        self.counts += np.bincount(index, observations.counts[inside],
+                                   size).reshape(self.counts.shape)
+        self.live += np.bincount(index, observations.livetime[inside],
+                                 size).reshape(self.live.shape)
+
+def gaussianKernel(sigma):
+    """A normalized Gaussian kernel of sigma pixels, cut off at 3 sigma."""
+    radius = max(int(np.ceil(3 * sigma)), 1)
+    offsets = np.arange(-radius, radius + 1)
+    line = np.exp(-0.5 * (offsets / float(sigma)) ** 2)
+    kernel = np.outer(line, line)
+    return kernel / kernel.sum()
+
+def fastLength(n):
+    """The smallest 2^a 3^b 5^c at least n, which FFTs handle quickly."""
+    best = 2 ** int(np.ceil(np.log2(n)))
+    for five in (1, 5, 25):
+        for three in (1, 3, 9, 27):
+            factor = five * three
+            if factor > n:
+                break
+            two = 2 ** int(np.ceil(np.log2(float(n) / factor)))
+            best = min(best, two * factor)
+    return best
+
+class Convolver(object):
+    """Same-size convolutions of images of one shape with fixed kernels,
+       by zero-padded real FFTs."""
+
+    def __init__(self, shape, kernels):
+        self.shape = shape
+        self.radius = (kernels[0].shape[0] - 1) // 2
+        self.padded = tuple(fastLength(n + 2 * self.radius) for n in shape)
+        self.transforms = [np.fft.rfft2(kernel, self.padded)
+                           for kernel in kernels]
+
+    def __call__(self, image, which=0):
+        result = np.fft.irfft2(np.fft.rfft2(image, self.padded) *
+                               self.transforms[which], self.padded)
+        r = self.radius
+        return result[r:r + self.shape[0], r:r + self.shape[1]]
+
+class Surface(object):
+    """Smoothed intensity (cps) and significance (sigma) of a raster, and its
+       live time within the kernel (weighted 1 at the center, so in seconds
+       near the point itself). Pixels with less than minLive are NaN."""
+
+    def __init__(self, raster, sigma, background=None, minLive=1.0):
+        kernel = gaussianKernel(sigma)
+        convolve = Convolver(raster.counts.shape, [kernel, kernel ** 2])
+        counts = convolve(raster.counts)
+        live = convolve(raster.live)
+        variance = convolve(raster.live, 1)
+        self.live = live / kernel.max()
+        empty = self.live < minLive
+        if background is None:
+            background = weightedMedian(raster.counts, raster.live)
+        self.background = background
+        with np.errstate(divide="ignore", invalid="ignore"):
+            self.intensity = np.where(empty, np.nan, counts / live)
+            self.significance = np.where(
+                empty | (background <= 0), np.nan,
+                (counts - background * live) /
+                np.sqrt(background * np.maximum(variance, 1e-12)))
+
+def weightedMedian(counts, live):
+    """Live-time weighted median of the count rates of pixels or points."""
+    occupied = live > 0
+    if not occupied.any():
+        return 0.0
+    rates = counts[occupied] / live[occupied]
+    weights = live[occupied]
+    order = np.argsort(rates)
+    cumulative = np.cumsum(weights[order])
+    return float(rates[order][np.searchsorted(cumulative,
+                                              cumulative[-1] / 2.0)])
+
+class Style(object):
+    """How a surface is colored."""
+
+    def __init__(self, surface="intensity", vmin=None, vmax=None, cmap=None,
+                 alpha=200):
+        self.surface = surface
+        if surface == "significance":
+            self.vmin = -5.0 if vmin is None else vmin
+            self.vmax = 5.0 if vmax is None else vmax
+            self.cmap = cmap or "RdBu_r"
+        else:
+            self.vmin = 0.0 if vmin is None else vmin
+            self.vmax = vmax
+            self.cmap = cmap or "jet"
+        self.alpha = alpha
+
+    def values(self, surface):
+        return getattr(surface, self.surface)
+
+    def colors(self, values):
+        """RGBA bytes for an array of values, north up, NaN transparent."""
+        from matplotlib import cm
+        vmax = self.vmax
+        if vmax is None:
+            vmax = np.nanpercentile(values, 99) if np.isfinite(values).any() \
+                   else 1.0
+        scaled = (values - self.vmin) / max(vmax - self.vmin, 1e-12)
+        rgba = cm.get_cmap(self.cmap)(np.clip(np.nan_to_num(scaled), 0, 1),
+                                      bytes=True)
+        rgba[..., 3] = np.where(np.isnan(values), 0, self.alpha)
+        return rgba[::-1]
+
+    def key(self):
+        return [self.surface, self.vmin, self.vmax, self.cmap, self.alpha]
+
+def writeImage(path, rgba):
+    from matplotlib import image
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    image.imsave(path, rgba)
+
+def renderImage(observations, path, resolution=10.0, bandwidth=50.0,
+                style=None, background=None, minLive=1.0):
+    """Render one image covering all the observations. Returns the Surface."""
+    style = style or Style()
+    raster = Raster.around(observations, resolution, 3 * bandwidth)
+    raster.add(observations)
+    surface = Surface(raster, bandwidth / resolution, background, minLive)
+    writeImage(path, style.colors(style.values(surface)))
+    return surface
+
+def resolution(zoom):
+    return RESOLUTION / 2 ** zoom
+
+class TileRenderer(object):
+    """Renders the tile pyramid into directory, skipping unchanged tiles.
+       Tiles are smoothed block tiles at a time, and a block whose tiles
+       are all unchanged is not smoothed at all. Without a vmax in the
+       style or a background, they are chosen from the first data rendered
+       and kept in tiles.json, so that tiles rendered at different times
+       match."""
+
+    def __init__(self, directory, bandwidth=50.0, style=None, background=None,
+                 minLive=1.0, block=4):
+        self.directory = directory
+        self.bandwidth = bandwidth
+        self.style = style or Style()
+        self.background = background
+        self.minLive = minLive
+        self.block = block
+        self.statePath = os.path.join(directory, "tiles.json")
+        self.state = {}
+        if os.path.exists(self.statePath):
+            with open(self.statePath) as state:
+                self.state = json.load(state)
+        self.scale = self.state.setdefault("scale", {})
+
+    def path(self, zoom, tx, ty):
+        return os.path.join(self.directory, str(zoom), str(tx), "%d.png" % ty)
+
+    def render(self, observations, zoom):
+        """Render one zoom level. Returns (tiles written, tiles unchanged,
+           tiles removed)."""
+        res = resolution(zoom)
+        extent = TILE * res
+        sigma = max(self.bandwidth / res, 0.5)
+        halo = max(int(np.ceil(3 * sigma)), 1)
+        if self.style.vmax is None:
+            self.style.vmax = self.scale.get("vmax")
+        live = observations.livetime > 0
+        if self.style.vmax is None and live.any():
+            self.style.vmax = float(np.percentile(observations.counts[live] /
+                                                  observations.livetime[live],
+                                                  99))
+            print "Color scale up to %.1f cps" % self.style.vmax
+        if self.style.vmax is not None:
+            self.scale["vmax"] = self.style.vmax
+        settings = [self.bandwidth, self.minLive] + self.style.key()
+        background = self.background
+        if self.style.surface == "significance":
+            # One background for every tile, so new data in one place
+            # doesn't change the significance of every other tile.
+            if background is None:
+                background = self.scale.get("background")
+            if background is None:
+                background = weightedMedian(observations.counts,
+                                            observations.livetime)
+            self.scale["background"] = background
+            settings.append(background)
+        settings = json.dumps(settings)
+
+        # Blocks holding observations, and their neighbours, which the
+        # kernel can reach
+        span = extent * self.block
+        bx = np.floor(observations.x / span).astype(int)
+        by = np.floor(observations.y / span).astype(int)
+        blocks = set()
+        for x, y in set(zip(bx.tolist(), by.tolist())):
+            blocks.update((x + dx, y + dy) for dx in (-1, 0, 1)
+                          for dy in (-1, 0, 1))
+
+        previous = self.state.get(str(zoom), {})
+        current = {}
+        written = unchanged = 0
+        for x, y in sorted(blocks):
+            raster = Raster(x * span - halo * res, y * span - halo * res, res,
+                            self.block * TILE + 2 * halo,
+                            self.block * TILE + 2 * halo)
+            near = (observations.x >= raster.xmin) & \
+                   (observations.x < raster.xmin + raster.width * res) & \
+                   (observations.y >= raster.ymin) & \
+                   (observations.y < raster.ymin + raster.height * res)
+            if not near.any():
+                continue
+            raster.add(Observations(observations.x[near], observations.y[near],
+                                    observations.livetime[near],
+                                    observations.counts[near]))
+            dirty = []
+            for j in range(self.block):
+                for i in range(self.block):
+                    window = (slice(j * TILE, (j + 1) * TILE + 2 * halo),
+                              slice(i * TILE, (i + 1) * TILE + 2 * halo))
+                    if not raster.live[window].any():
+                        continue
+                    tx, ty = x * self.block + i, y * self.block + j
+                    digest = hashlib.sha1(settings)
+                    digest.update(raster.counts[window].tobytes())
+                    digest.update(raster.live[window].tobytes())
+                    name = "%d/%d" % (tx, ty)
+                    current[name] = digest.hexdigest()
+                    if previous.get(name) == current[name] and \
+                       os.path.exists(self.path(zoom, tx, ty)):
+                        unchanged += 1
+                    else:
+                        dirty.append((i, j, tx, ty))
+            if not dirty:
+                continue
+            values = self.style.values(Surface(raster, sigma, background,
+                                               self.minLive))
+            for i, j, tx, ty in dirty:
+                tile = values[halo + j * TILE:halo + (j + 1) * TILE,
+                              halo + i * TILE:halo + (i + 1) * TILE]
+                writeImage(self.path(zoom, tx, ty), self.style.colors(tile))
+                written += 1
+
+        removed = 0
+        for name in set(previous) - set(current):
+            tx, ty = name.split("/")
+            path = self.path(zoom, int(tx), int(ty))
+            if os.path.exists(path):
+                os.remove(path)
+            removed += 1
+        self.state[str(zoom)] = current
+        self.save()
+        return written, unchanged, removed
+
+    def save(self):
+        with open(self.statePath + ".tmp", "w") as state:
+            json.dump(self.state, state)
+        os.rename(self.statePath + ".tmp", self.statePath)
+
+def zoomRange(text):
+    if "-" in text:
+        first, last = text.split("-")
+        return range(int(first), int(last) + 1)
+    return [int(text)]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    commands = parser.add_subparsers(dest="command")
+    imageParser = commands.add_parser("image")
+    imageParser.add_argument("path", help="PNG file to write")
+    imageParser.add_argument("--resolution", type=float, default=10.0,
+                             help="meters per pixel")
+    tilesParser = commands.add_parser("tiles")
+    tilesParser.add_argument("path", help="tile directory")
+    tilesParser.add_argument("--zooms", type=zoomRange,
+                             default=zoomRange("6-9"),
+                             help="zoom levels, e.g. 6-9 (%g m/px at 0)" %
+                                  RESOLUTION)
+    for command in (imageParser, tilesParser):
+        command.add_argument("--bandwidth", type=float, default=50.0,
+                             help="kernel standard deviation in meters")
+        command.add_argument("--surface", default="intensity",
+                             choices=("intensity", "significance"))
+        command.add_argument("--vmin", type=float)
+        command.add_argument("--vmax", type=float,
+                             help="top of the color scale (default: 99th " +
+                                  "percentile rate; kept for tiles)")
+        command.add_argument("--background", type=float,
+                             help="background cps for significance " +
+                                  "(default: median rate; kept for tiles)")
+        command.add_argument("--min-live", type=float, default=1.0,
+                             help="seconds of live time needed to draw a " +
+                                  "pixel")
+        command.add_argument("--rollup",
+                             help="read this square rollup grid, e.g. " +
+                                  "square-50, instead of histograms")
+        command.add_argument("--where", help="SQL filter on histograms")
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(database = "radiation", user = "radiation",
+                            password = "radiation", host = "localhost")
+    if args.rollup:
+        observations = rollupObservations(conn, args.rollup)
+    else:
+        observations = readObservations(conn, args.where)
+    conn.close()
+    if not len(observations.x):
+        print "No located observations"
+        return
+    style = Style(args.surface, args.vmin, args.vmax)
+    if args.command == "image":
+        surface = renderImage(observations, args.path, args.resolution,
+                              args.bandwidth, style, args.background,
+                              args.min_live)
+        print "Wrote %s (background %.1f cps)" % (args.path,
+                                                  surface.background)
+        return
+    renderer = TileRenderer(args.path, args.bandwidth, style, args.background,
+                            args.min_live)
+    for zoom in args.zooms:
+        written, unchanged, removed = renderer.render(observations, zoom)
+        print "zoom %d: %d tiles written, %d unchanged, %d removed" % \
+              (zoom, written, unchanged, removed)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+"""Compact binary codec for 4096-bin histograms.
+
+Postgres stores histograms.histogram as an integer[], which costs four bytes
+per bin plus array overhead even though most high-energy bins hold zero or a
+handful of counts. This codec stores a spectrum as
+
+    format byte | varint(zigzag(delta(bins)))...
+
+optionally deflated with zlib. Neighbouring bins have similar counts, so the
+deltas are small and nearly all of them fit in a single byte; runs of empty
+bins become runs of zero bytes, which zlib then removes almost entirely.
+Encoding and decoding are vectorized with NumPy; no Python loop runs per bin.
+
+Packed spectra live in the histograms.histpack bytea column (see
+sql/histpack.sql). The "histogramStorage" setting in radmonitor.config picks
+which column(s) writers fill: "array" (the default, histogram only), "bytea"
+(histpack only) or "both".
+"""
+
+import json, os, zlib
+import numpy as np
+
+FORMAT_VARINT = 1
+FORMAT_ZLIB = 2
+
+STORAGE_MODES = ("array", "bytea", "both")
+
+CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..",
+                      "radmonitor.config")
+
+def zigzag(values):
+    """Map signed int64 values onto unsigned ones, small magnitudes first."""
+    values = np.asarray(values, dtype=np.int64)
+    return ((values << 1) ^ (values >> 63)).astype(np.uint64)
+
+def unzigzag(values):
+    values = np.asarray(values, dtype=np.uint64)
+    return (values >> np.uint64(1)).astype(np.int64) ^ \
+           -(values & np.uint64(1)).astype(np.int64)
+
+def varintEncode(values):
+    """Encode unsigned integers as little-endian base-128 varints."""
+    values = np.asarray(values, dtype=np.uint64)
+    nbytes = np.ones(len(values), dtype=np.int64)
+    for shift in range(7, 64, 7):
+        nbytes += values >= (np.uint64(1) << np.uint64(shift))
+    ends = np.cumsum(nbytes)
+    starts = ends - nbytes
+    out = np.zeros(ends[-1] if len(ends) else 0, dtype=np.uint8)
+    for k in range(int(nbytes.max()) if len(nbytes) else 0):
+        sel = nbytes > k
+        byte = (values[sel] >> np.uint64(7 * k)) & np.uint64(0x7f)
+        more = (nbytes[sel] > k + 1).astype(np.uint64) << np.uint64(7)
+        out[starts[sel] + k] = byte | more
+    return out
+
+def varintDecode(data):
+    """Decode a uint8 array of varints back into a uint64 array."""
+    data = np.asarray(data, dtype=np.uint8)
+    if len(data) == 0:
+        return np.zeros(0, dtype=np.uint64)
+    last = (data & 0x80) == 0
+    if not last[-1]:
+        raise ValueError("Truncated varint data")
+    ends = np.nonzero(last)[0]
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    group = np.cumsum(last) - last
+    position = np.arange(len(data)) - starts[group]
+    parts = (data & 0x7f).astype(np.uint64) << (7 * position).astype(np.uint64)
+    return np.add.reduceat(parts, starts)
+
+def encode(hist, compress=True):
+    """Pack a histogram (any integer sequence) into a byte string."""
+    hist = np.asarray(hist, dtype=np.int64)
+    deltas = np.empty_like(hist)
+    deltas[:1] = hist[:1]
+    deltas[1:] = hist[1:] - hist[:-1]
+    body = varintEncode(zigzag(deltas)).tostring()
+    if compress:
+        return chr(FORMAT_ZLIB) + zlib.compress(body, 6)
+    return chr(FORMAT_VARINT) + body
+
+def decode(data):
+    """Unpack a byte string produced by encode() into an int64 array."""
+    data = bytes(data)
+    fmt = ord(data[0])
+    if fmt == FORMAT_ZLIB:
+        body = zlib.decompress(data[1:])
+    elif fmt == FORMAT_VARINT:
+        body = data[1:]
+    else:
+        raise ValueError("Unknown histogram format %d" % fmt)
+    return np.cumsum(unzigzag(varintDecode(np.frombuffer(body, np.uint8))))
+
+def encodeMany(hists, compress=True):
+    """Pack each row of an (N x bins) array."""
+    return [encode(hist, compress) for hist in np.asarray(hists)]
+
+def decodeMany(blobs):
+    """Unpack a sequence of packed histograms into an (N x bins) array."""
+    return np.vstack([decode(blob) for blob in blobs])
+
+def configuredStorage(path=CONFIG):
+    """Return the histogramStorage setting from radmonitor.config."""
+    try:
+        with open(path) as config:
+            storage = json.load(config).get("histogramStorage", "array")
+    except IOError:
+        storage = "array"
+    return checkStorage(storage)
+
+def checkStorage(storage):
+    if storage not in STORAGE_MODES:
+        raise ValueError("histogramStorage must be one of %s, not %r" %
+                         (", ".join(STORAGE_MODES), storage))
+    return storage
+
+def storageColumns(storage):
+    """Names of the histograms columns written for a storage mode."""
+    return {"array": ("histogram",),
+            "bytea": ("histpack",),
+            "both": ("histogram", "histpack")}[checkStorage(storage)]
+
+def selectColumns(storage, histogram="histogram"):
+    """Select-list SQL for a histogram, histpack pair naming only the
+       columns of a storage mode, with NULL for the other, so reading works
+       whether or not sql/histpack.sql was applied. histogram may be an
+       expression on the histogram column."""
+    columns = storageColumns(storage)
+    return (histogram if "histogram" in columns else "NULL AS histogram") + \
+           ", " + ("histpack" if "histpack" in columns else "NULL AS histpack")
+
+def storedCondition(storage):
+    """SQL condition for rows holding a histogram in a storage mode's
+       columns."""
+    return "(" + " OR ".join(column + " IS NOT NULL"
+                             for column in storageColumns(storage)) + ")"
+
+def storageValues(hist, storage, binary=str, array=list):
+    """Values matching storageColumns(storage) for one histogram. Packed
+       values are passed through binary, so give psycopg2.Binary when the
+       values will be used as query parameters; array formats the integer[]
+       value."""
+    values = ()
+    if storage in ("array", "both"):
+        values += (array(hist),)
+    if storage in ("bytea", "both"):
+        values += (binary(encode(hist)),)
+    return values
+
+def fromRow(histogram, histpack):
+    """Return a row's histogram as an array, whichever column holds it."""
+    if histpack is not None:
+        return decode(histpack)
+    return np.asarray(histogram, dtype=np.int64)
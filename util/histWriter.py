@@ -0,0 +1,305 @@
+"""Batched, asynchronous writer for histogram samples.
+
+The acquisition loop hands finished samples to a HistogramWriter through a
+bounded queue and goes straight back to the detector. The writer owns its own
+Postgres connection and thread, and flushes queued samples with one multi-row
+INSERT (and one commit) whenever the batch is large enough or the oldest
+sample has waited long enough. A slow or stalled database therefore fills the
+queue instead of delaying the next timed histogram.
+
+Samples are dicts with the keys in SAMPLE_KEYS; see headlessMonitor for an
+example. The histogram is written to the column(s) chosen by the storage mode,
+as described in util/histCodec.py. Optional columns, such as the anomaly
+score, are written when named in extraColumns and taken from the sample key
+of the same name. With partitioned set, each sample is inserted straight into
+its monthly partition (see sql/partitions.sql) rather than going through the
+routing trigger on histograms.
+
+Given a journal (see util/journal.py), put() appends the sample to it rather
+than to the in-memory queue, and the writer reads its batches back from the
+journal. Each batch is committed together with the journal's acknowledged
+sequence number in journal_acks, so a backlog survives crashes and outages
+and is written exactly once.
+"""
+
+import threading, time, Queue
+import psycopg2
+from util import histCodec, metrics
+from util.UTC import utc
+
+insertTime = metrics.histogram("db_insert_seconds",
+                               "Time to execute one batch INSERT")
+commitTime = metrics.histogram("db_commit_seconds",
+                               "Time to commit one batch")
+writeErrors = metrics.counter("db_write_errors_total",
+                              "Batches that failed to write")
+rowsWritten = metrics.counter("db_rows_written_total", "Rows written")
+
+SAMPLE_KEYS = ("longitude", "latitude", "hdop", "time", "sampletime", "temp",
+               "cps", "histogram", "altitude", "sensor", "version")
+
+def insertStatement(storage, extraColumns=(), table="histograms"):
+    """Return the INSERT prefix and per-row template for a storage mode."""
+    columns = histCodec.storageColumns(storage)
+    insert = "INSERT INTO " + table + " (location, hdop, time, sampletime, " + \
+             "temp, cps, " + ", ".join(columns) + ", altitude, sensor, " + \
+             "version" + "".join(", " + c for c in extraColumns) + ") VALUES "
+    row = "(ST_GeomFromText('POINT(%s %s)', 4326), %s, %s, %s, %s, %s, " + \
+          "%s, " * len(columns) + "%s, %s, %s" + ", %s" * len(extraColumns) + ")"
+    return insert, row
+
+def partitionName(timestamp):
+    """Name of the monthly partition holding a timezone-aware timestamp, or
+       None if it can't be placed without the routing trigger."""
+    if timestamp is None or timestamp.tzinfo is None:
+        return None
+    timestamp = timestamp.astimezone(utc)
+    return "histograms_y%04dm%02d" % (timestamp.year, timestamp.month)
+
+class HistogramWriter(threading.Thread):
+    """Queue samples with put(); a background thread writes them in batches.
+
+       batchSize is the number of samples that triggers a flush, maxAge the
+       number of seconds the oldest queued sample may wait before a flush is
+       forced, and queueSize the number of samples held before put() starts
+       rejecting new ones. storage is a histCodec storage mode and
+       extraColumns names optional columns to write. partitioned routes rows
+       to monthly partitions. With a journal, samples are kept there
+       instead of in the queue, and queueSize doesn't apply. Remaining
+       keyword arguments are passed to psycopg2.connect."""
+
+    def __init__(self, batchSize=30, maxAge=60, queueSize=1800, retryDelay=5,
+                 storage="array", extraColumns=(), partitioned=False,
+                 journal=None, **connArgs):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.storage = histCodec.checkStorage(storage)
+        self.extraColumns = tuple(extraColumns)
+        self.partitioned = partitioned
+        self.knownPartitions = set()
+        self.batchSize = batchSize
+        self.maxAge = maxAge
+        self.retryDelay = retryDelay
+        self.connArgs = connArgs
+        self.queue = Queue.Queue(queueSize)
+        self.journal = journal
+        self.ready = threading.Event()
+        self.cursor = journal.acked if journal is not None else 0
+        self.running = True
+        self.conn = None
+        self.pending = []
+        self.pendingSince = None
+        self.rowsWritten = 0
+        self.flushes = 0
+        self.dropped = 0
+        self.errors = 0
+        self.lastFlushLatency = 0.0
+        self.maxFlushLatency = 0.0
+
+    def put(self, sample):
+        """Queue a sample for writing without blocking. Returns False if the
+           queue (or journal) is full and the sample was dropped."""
+        if self.journal is not None:
+            if self.journal.append(sample) is None:
+                self.dropped += 1
+                return False
+            self.ready.set()
+            return True
+        try:
+            self.queue.put_nowait(sample)
+        except Queue.Full:
+            self.dropped += 1
+            return False
+        return True
+
+    def queueDepth(self):
+        """Number of samples waiting, both queued and in the unflushed batch."""
+        if self.journal is not None:
+            return self.journal.nextSeq - 1 - self.cursor + len(self.pending)
+        return self.queue.qsize() + len(self.pending)
+
+    def stats(self):
+        return {"queueDepth": self.queueDepth(),
+                "rowsWritten": self.rowsWritten,
+                "flushes": self.flushes,
+                "dropped": self.dropped,
+                "errors": self.errors,
+                "lastFlushLatency": self.lastFlushLatency,
+                "maxFlushLatency": self.maxFlushLatency}
+
+    def run(self):
+        # A journal's backlog stays there for the next start
+        while self.running or (self.journal is None and
+                               not self.queue.empty()):
+            self._collect()
+            if self._due():
+                self.flush()
+        self.flush()
+        if self.conn is not None:
+            self.conn.close()
+
+    def stop(self):
+        """Flush everything still queued and shut the writer down."""
+        self.running = False
+        self.join(max(self.maxAge, 10))
+
+    def _collect(self):
+        """Move samples from the queue into the pending batch, waiting at most
+           until the batch would be due by age. A full batch is left alone so
+           a database outage backs up into the bounded queue."""
+        if len(self.pending) >= self.batchSize:
+            return
+        timeout = 1.0
+        if self.pendingSince is not None:
+            timeout = max(0.0, min(timeout, self.pendingSince + self.maxAge -
+                                   time.time()))
+        if self.journal is not None:
+            self._collectJournal(timeout)
+            return
+        try:
+            sample = self.queue.get(True, timeout)
+        except Queue.Empty:
+            return
+        if self.pendingSince is None:
+            self.pendingSince = time.time()
+        self.pending.append(sample)
+        while len(self.pending) < self.batchSize:
+            try:
+                self.pending.append(self.queue.get_nowait())
+            except Queue.Empty:
+                break
+
+    def _collectJournal(self, timeout):
+        if self.journal.nextSeq - 1 <= self.cursor:
+            self.ready.wait(timeout)
+            self.ready.clear()
+        records, start = self.journal.read(self.cursor + 1,
+                                           self.batchSize - len(self.pending))
+        self.cursor = start - 1
+        if records and self.pendingSince is None:
+            self.pendingSince = time.time()
+        for seq, sample in records:
+            sample["journalSeq"] = seq
+            self.pending.append(sample)
+
+    def drain(self):
+        """Write the journal's whole backlog from the calling thread, for
+           drainJournal.py. Returns False if a batch failed."""
+        while self.queueDepth():
+            self._collect()
+            if not self.flush():
+                return False
+        return True
+
+    def _due(self):
+        if not self.pending:
+            return False
+        return len(self.pending) >= self.batchSize or not self.running or \
+               time.time() - self.pendingSince >= self.maxAge
+
+    def _connect(self):
+        if self.conn is None or self.conn.closed:
+            self.conn = psycopg2.connect(**self.connArgs)
+        return self.conn
+
+    def flush(self):
+        """Write the pending batch in one statement and one commit. On failure
+           the batch is kept and retried after retryDelay seconds."""
+        if not self.pending:
+            return True
+        started = time.time()
+        try:
+            conn = self._connect()
+            cur = conn.cursor()
+            if self.journal is not None:
+                acked = self._journalAck(cur)
+                self.pending = [sample for sample in self.pending
+                                if sample["journalSeq"] > acked]
+                self.cursor = max(self.cursor, acked)
+            tables = self._byTable(cur)
+            for table, samples in tables:
+                if not samples:
+                    continue
+                insert, row = insertStatement(self.storage, self.extraColumns,
+                                              table)
+                rows = ",".join(cur.mogrify(row,
+                                            rowValues(sample, self.storage,
+                                                      self.extraColumns))
+                                for sample in samples)
+                with insertTime.time():
+                    cur.execute(insert + rows)
+            if self.journal is not None:
+                cur.execute("UPDATE journal_acks SET seq = %s, updated = " +
+                            "now() WHERE journal = %s",
+                            (self.cursor, self.journal.id))
+            with commitTime.time():
+                conn.commit()
+            cur.close()
+            # Partitions created in a rolled back batch are gone again, so
+            # only remember them once committed
+            self.knownPartitions.update(table for table, samples in tables)
+            if self.journal is not None:
+                self.journal.acknowledge(self.cursor)
+        except psycopg2.Error as err:
+            print "Error: Couldn't write %d samples: %s" % (len(self.pending),
+                                                             err)
+            self.errors += 1
+            writeErrors.inc()
+            if self.conn is not None:
+                self.conn.close()
+            self.conn = None
+            time.sleep(self.retryDelay)
+            return False
+        self.lastFlushLatency = time.time() - started
+        self.maxFlushLatency = max(self.maxFlushLatency, self.lastFlushLatency)
+        self.rowsWritten += len(self.pending)
+        rowsWritten.inc(len(self.pending))
+        self.flushes += 1
+        self.pending = []
+        self.pendingSince = None
+        return True
+
+    def _journalAck(self, cur):
+        """Lock the journal's row in journal_acks and return the last
+           sequence number already in the database."""
+        cur.execute("SELECT seq FROM journal_acks WHERE journal = %s " +
+                    "FOR UPDATE", (self.journal.id,))
+        row = cur.fetchone()
+        if row is None:
+            cur.execute("INSERT INTO journal_acks (journal, seq) VALUES " +
+                        "(%s, 0)", (self.journal.id,))
+            return 0
+        return row[0]
+
+    def _byTable(self, cur):
+        """Group the pending samples by the table they should be inserted
+           into, creating monthly partitions as needed."""
+        if not self.partitioned:
+            return [("histograms", self.pending)]
+        tables = {}
+        for sample in self.pending:
+            name = partitionName(sample["time"])
+            if name is None:
+                name = "histograms"
+            elif name not in self.knownPartitions and name not in tables:
+                cur.execute("SELECT ensure_histograms_partition(%s)",
+                            (sample["time"],))
+            tables.setdefault(name, []).append(sample)
+        return sorted(tables.items())
+
+def configuredColumns(config):
+    """The extraColumns headlessMonitor writes with a radmonitor.config."""
+    if config.get("anomaly", {}).get("enabled", False):
+        return ("compression", "deadtime", "anomaly")
+    return ("compression", "deadtime")
+
+def rowValues(sample, storage="array", extraColumns=()):
+    """Order a sample dict's values to match insertStatement(storage,
+       extraColumns)."""
+    hist = histCodec.storageValues(sample["histogram"], storage,
+                                   psycopg2.Binary)
+    return (sample["longitude"], sample["latitude"], sample["hdop"],
+            sample["time"], sample["sampletime"], sample["temp"],
+            sample["cps"]) + hist + (sample["altitude"], sample["sensor"],
+                                     sample["version"]) + \
+           tuple(sample.get(column) for column in extraColumns)
@@ -1,24 +1,158 @@
-import psycopg2, csv
-from datetime import datetime
+"""Bulk import of exported CSV histograms into Postgres.
 
-conn = psycopg2.connect(database = "radiation", user = "radiation", 
-                        password = "radiation", host = "localhost")
-cur = conn.cursor()
+Each CSV row holds latitude, longitude, HDOP, an ISO timestamp, sample time,
+temperature, cps and then the 4096 histogram bins. The file is read in chunks
+of lines; a process pool parses each chunk with NumPy (one np.fromstring call
+for all the numeric fields of the chunk) and formats it as COPY text, and the
+main process loads the chunks in order with COPY.
 
-reader = csv.reader(open('netl-test-run.csv', 'rb'))
+Only a few chunks are in flight at once, so memory use does not depend on the
+size of the file. After each chunk the byte offset reached is committed in
+import_progress in the same transaction as the rows, so an interrupted import
+rerun with the same file picks up exactly where it stopped.
 
-for row in reader:
-    timestamp = datetime.strptime(row[3], "%Y-%m-%dT%H:%M:%S.%f")
-    print row[0:6]
-    try:
-        cur.execute("INSERT INTO histograms (location, hdop, time, sampletime, temp, cps, histogram) " + 
-                    "VALUES (ST_GeomFromText('POINT(%s %s)',4326), %s, %s, %s, %s, %s, %s)",
-                    (float(row[1]), float(row[0]), float(row[2]), timestamp, float(row[4]),
-                     float(row[5]), float(row[6]), map(float, row[7:4103])))
-    except ValueError:
-        pass
+Run from the util directory:
+
+    python import.py netl-test-run.csv [--chunk 500] [--processes 4]
+"""
+
+import argparse, collections, multiprocessing, os, re, time
+import numpy as np
+import psycopg2
+import histCodec, pgcopy
+
+BINS = 4096
+FIELDS = 7 + BINS
+TIMESTAMP = re.compile(r"^\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d(\.\d+)?$")
+
+PROGRESS = "CREATE TABLE IF NOT EXISTS import_progress (" + \
+           "source text PRIMARY KEY, byte_offset bigint NOT NULL, " + \
+           "rows bigint NOT NULL, updated timestamp with time zone)"
+
+def readChunks(path, offset, size):
+    """Yield (end offset, lines) for chunks of size lines from offset on."""
+    with open(path, "rb") as csvFile:
+        csvFile.seek(offset)
+        while True:
+            lines = []
+            for _ in range(size):
+                line = csvFile.readline()
+                if not line:
+                    break
+                lines.append(line)
+            if not lines:
+                return
+            yield csvFile.tell(), lines
+
+def parseChunk(args):
+    """Turn CSV lines into COPY text. Returns (text, rows, skipped).
+       Malformed rows are skipped, as the old row-by-row importer did."""
+    lines, storage = args
+    stamps = []
+    numbers = []
+    for line in lines:
+        fields = line.strip().split(",", 4)
+        if len(fields) != 5 or fields[4].count(",") != FIELDS - 5 or \
+           not TIMESTAMP.match(fields[3]):
+            continue
+        stamps.append(fields[3])
+        numbers.append(",".join(fields[:3]) + "," + fields[4])
+    if not numbers:
+        return "", 0, len(lines)
 
+    values = np.fromstring(",".join(numbers), sep=",")
+    if values.size != len(numbers) * (FIELDS - 1):
+        # Some field isn't a number; fall back to checking row by row
+        rows = [np.fromstring(line, sep=",") for line in numbers]
+        good = [i for i, row in enumerate(rows) if row.size == FIELDS - 1]
+        if not good:
+            return "", 0, len(lines)
+        stamps = [stamps[i] for i in good]
+        values = np.concatenate([rows[i] for i in good])
+    values = values.reshape(len(stamps), FIELDS - 1)
+    hists = values[:, 6:].astype(np.int64)
+
+    out = []
+    for row, stamp, hist in zip(values, stamps, hists):
+        out.append(pgcopy.formatRow(
+            (pgcopy.pointLiteral(row[1], row[0]), row[2], stamp, row[3],
+             row[4], row[5]) +
+            histCodec.storageValues(hist, storage, pgcopy.byteaLiteral,
+                                    pgcopy.arrayLiteral)))
+    return "".join(out), len(out), len(lines) - len(out)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("path", help="CSV file to import")
+    parser.add_argument("--chunk", type=int, default=500,
+                        help="rows per parse task and per commit")
+    parser.add_argument("--processes", type=int,
+                        default=multiprocessing.cpu_count(),
+                        help="parser processes")
+    parser.add_argument("--restart", action="store_true",
+                        help="ignore any saved progress for this file")
+    args = parser.parse_args()
+
+    storage = histCodec.configuredStorage()
+    columns = ("location", "hdop", "time", "sampletime", "temp", "cps") + \
+              histCodec.storageColumns(storage)
+    source = "%s:%d" % (os.path.basename(args.path),
+                        os.path.getsize(args.path))
+
+    conn = psycopg2.connect(database = "radiation", user = "radiation",
+                            password = "radiation", host = "localhost")
+    cur = conn.cursor()
+    cur.execute(PROGRESS)
+    cur.execute("SELECT byte_offset, rows FROM import_progress " +
+                "WHERE source = %s", (source,))
+    saved = cur.fetchone()
+    if saved is None:
+        cur.execute("INSERT INTO import_progress VALUES (%s, 0, 0, now())",
+                    (source,))
+        saved = (0, 0)
+    elif args.restart:
+        cur.execute("UPDATE import_progress SET byte_offset = 0, rows = 0 " +
+                    "WHERE source = %s", (source,))
+        saved = (0, 0)
+    conn.commit()
+    offset, total = saved
+    if offset:
+        print "Resuming %s at byte %d after %d rows" % (args.path, offset,
+                                                        total)
+
+    pool = multiprocessing.Pool(args.processes)
+    inFlight = collections.deque()
+    chunks = readChunks(args.path, offset, args.chunk)
+    started = time.time()
+    imported = skipped = 0
+    try:
+        while True:
+            while len(inFlight) < 2 * args.processes:
+                try:
+                    end, lines = next(chunks)
+                except StopIteration:
+                    break
+                inFlight.append((end, pool.apply_async(parseChunk,
+                                                       ((lines, storage),))))
+            if not inFlight:
+                break
+            end, result = inFlight.popleft()
+            text, rows, bad = result.get()
+            if rows:
+                pgcopy.copyText(cur, "histograms", columns, text)
+            total += rows
+            cur.execute("UPDATE import_progress SET byte_offset = %s, " +
+                        "rows = %s, updated = now() WHERE source = %s",
+                        (end, total, source))
+            conn.commit()
+            imported += rows
+            skipped += bad
+            print "%d rows imported (%d skipped), %.0f rows/s" % \
+                  (total, skipped, imported / (time.time() - started))
+    finally:
+        pool.terminate()
+        cur.close()
+        conn.close()
 
-conn.commit()
-cur.close()
-conn.close()
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,329 @@
+"""Crash-safe, append-only journal of samples on the device.
+
+With a journal, headlessMonitor's HistogramWriter writes every sample to
+local storage before anything touches Postgres, and fills histograms from
+the journal. A database that is down, stalled by autovacuum on the SD card
+or refusing writes only lets the backlog grow; no sample is lost, and
+nothing waits on the database.
+
+The journal is a directory of segment files, each preallocated to
+segmentRecords fixed-size slots of recordSize bytes and memory-mapped. A
+slot holds one record:
+
+    magic "RJ1\\0" | CRC-32 | sequence number | meta length | histogram length
+    | meta (JSON: every sample key but the histogram) | histogram (histCodec)
+
+The CRC covers everything after itself. Records go into consecutive slots
+with consecutive sequence numbers, so writes are strictly sequential, and
+segments are named by the sequence number of their first slot, which makes
+finding a record simple arithmetic. After a crash the write position is
+found again from the newest segment: its last slot holding the sequence
+number that belongs there. A torn or corrupted record fails its CRC and is
+skipped when read.
+
+Records are acknowledged once they are committed to histograms. The writer
+records the last acknowledged sequence number in journal_acks (see
+sql/journal.sql) in the same transaction as the rows, so a crash between
+the commit and updating the local "ack" file can't insert anything twice.
+Fully acknowledged segments are recycled, by renaming, for new records
+rather than deleted and preallocated again. When all maxSegments segments
+hold unacknowledged records the journal is full and new samples are
+dropped.
+
+Enable the "journal" section of radmonitor.config. When the monitor isn't
+running, drainJournal.py writes a journal's backlog to the database and
+removes acknowledged segments.
+"""
+
+import bisect, fcntl, glob, json, mmap, os, struct, threading, zlib
+from dateutil import parser
+from util import histCodec, metrics
+
+MAGIC = "RJ1\0"
+HEADER = struct.Struct("<4sIQII")
+
+appendTime = metrics.histogram("journal_append_seconds",
+                               "Writing one sample to the journal")
+corruptRecords = metrics.counter("journal_corrupt_records_total",
+                                 "Journal records that failed their CRC")
+
+def pyValue(value):
+    """JSON encoding for NumPy scalars and arrays."""
+    if hasattr(value, "tolist"):
+        return value.tolist()
+    raise TypeError("%r is not JSON serializable" % (value,))
+
+def packRecord(seq, sample):
+    """Encode a sample dict as a journal record."""
+    meta = dict((key, value) for key, value in sample.items()
+                if key not in ("histogram", "journalSeq"))
+    if meta.get("time") is not None:
+        meta["time"] = meta["time"].isoformat()
+    meta = json.dumps(meta, default=pyValue)
+    hist = histCodec.encode(sample["histogram"])
+    body = HEADER.pack(MAGIC, 0, seq, len(meta), len(hist))[8:] + meta + hist
+    return MAGIC + struct.pack("<I", zlib.crc32(body) & 0xffffffff) + body
+
+def unpackRecord(data):
+    """Return (seq, sample) for a record, or None if the slot doesn't hold
+       a valid one."""
+    magic, crc, seq, metaLength, histLength = HEADER.unpack_from(data)
+    end = HEADER.size + metaLength + histLength
+    if magic != MAGIC or end > len(data) or \
+       zlib.crc32(data[8:end]) & 0xffffffff != crc:
+        return None
+    sample = json.loads(data[HEADER.size:HEADER.size + metaLength])
+    if sample.get("time") is not None:
+        sample["time"] = parser.parse(sample["time"])
+    sample["histogram"] = histCodec.decode(
+        data[HEADER.size + metaLength:end]).tolist()
+    return seq, sample
+
+class Segment(object):
+    """One preallocated, memory-mapped segment file."""
+
+    def __init__(self, path, first, size, readOnly=False):
+        self.path = path
+        self.first = first
+        self.file = open(path, "rb" if readOnly else "r+b")
+        self.map = mmap.mmap(self.file.fileno(), size,
+                             access=mmap.ACCESS_READ if readOnly
+                                    else mmap.ACCESS_WRITE)
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+class Journal(object):
+    """The journal in directory, created if need be. A journal that already
+       exists keeps the recordSize and segmentRecords it was created with.
+       syncEvery is the number of appends between msyncs (0: leave it to
+       the kernel). The journal is locked against use by another process
+       unless opened readOnly."""
+
+    def __init__(self, directory, recordSize=16384, segmentRecords=1024,
+                 maxSegments=64, syncEvery=1, readOnly=False):
+        self.directory = directory
+        self.maxSegments = maxSegments
+        self.syncEvery = syncEvery
+        self.readOnly = readOnly
+        self.lock = threading.Lock()
+        self.lockFile = None
+        if not readOnly:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            self.lockFile = open(os.path.join(directory, "lock"), "a")
+            try:
+                fcntl.flock(self.lockFile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                raise IOError("Journal %s is in use by another process" %
+                              directory)
+        meta = os.path.join(directory, "journal.json")
+        if not os.path.exists(meta):
+            if readOnly:
+                raise IOError("No journal in %s" % directory)
+            if recordSize % mmap.PAGESIZE:
+                raise ValueError("recordSize must be a multiple of %d" %
+                                 mmap.PAGESIZE)
+            with open(meta + ".tmp", "w") as out:
+                json.dump({"id": os.urandom(8).encode("hex"),
+                           "recordSize": recordSize,
+                           "segmentRecords": segmentRecords}, out)
+            os.rename(meta + ".tmp", meta)
+        with open(meta) as config:
+            meta = json.load(config)
+        self.id = meta["id"]
+        self.recordSize = meta["recordSize"]
+        self.segmentRecords = meta["segmentRecords"]
+        self.segmentSize = self.recordSize * self.segmentRecords
+        self.acked = self._readAck()
+        self.segments = [Segment(path, int(os.path.basename(path)[:-4]),
+                                 self.segmentSize, readOnly)
+                         for path in sorted(glob.glob(os.path.join(directory,
+                                                                   "*.seg")))]
+        if self.segments:
+            # Segments are only recycled once acknowledged, so everything
+            # before the oldest one was, whatever a stale ack file says
+            self.acked = max(self.acked, self.segments[0].first - 1)
+        self.nextSeq = self._recover()
+        self.unsynced = None
+        self.corrupt = 0
+
+    def _readAck(self):
+        try:
+            with open(os.path.join(self.directory, "ack")) as ack:
+                return int(ack.read().strip() or 0)
+        except IOError:
+            return 0
+
+    def _recover(self):
+        """Find the sequence number to write next: one past the last record
+           in the newest segment that holds its own slot's number."""
+        if not self.segments:
+            return self.acked + 1
+        segment = self.segments[-1]
+        last = None
+        for slot in range(self.segmentRecords):
+            offset = slot * self.recordSize
+            magic, crc, seq = HEADER.unpack_from(segment.map, offset)[:3]
+            if magic == MAGIC and seq == segment.first + slot and \
+               self._slot(segment, slot) is not None:
+                last = slot
+        return segment.first + (0 if last is None else last + 1)
+
+    def _slot(self, segment, slot):
+        offset = slot * self.recordSize
+        return unpackRecord(segment.map[offset:offset + self.recordSize])
+
+    def _locate(self, seq):
+        """The segment and slot holding seq, or (None, None)."""
+        index = bisect.bisect_right([segment.first
+                                     for segment in self.segments], seq) - 1
+        if index < 0:
+            return None, None
+        segment = self.segments[index]
+        if seq - segment.first >= self.segmentRecords:
+            return None, None
+        return segment, seq - segment.first
+
+    def _newSegment(self, first):
+        """A segment starting at first: a fully acknowledged one recycled,
+           or a new one while there are fewer than maxSegments. None if the
+           journal is full."""
+        path = os.path.join(self.directory, "%016d.seg" % first)
+        spare = [segment for segment in self.segments
+                 if segment.first + self.segmentRecords - 1 <= self.acked]
+        if spare:
+            segment = spare[0]
+            self.segments.remove(segment)
+            os.rename(segment.path, path)
+            segment.path = path
+            segment.first = first
+        elif len(self.segments) < self.maxSegments:
+            with open(path, "wb") as out:
+                zeros = "\0" * (1 << 20)
+                for start in range(0, self.segmentSize, len(zeros)):
+                    out.write(zeros[:self.segmentSize - start])
+                out.flush()
+                os.fsync(out.fileno())
+            segment = Segment(path, first, self.segmentSize)
+        else:
+            return None
+        self.segments.append(segment)
+        return segment
+
+    def append(self, sample):
+        """Write a sample as the next record. Returns its sequence number,
+           or None if it was dropped because the journal is full."""
+        with appendTime.time():
+            with self.lock:
+                seq = self.nextSeq
+                record = packRecord(seq, sample)
+                if len(record) > self.recordSize:
+                    print "Error: Journal record of %d bytes doesn't fit" % \
+                          len(record)
+                    return None
+                segment, slot = self._locate(seq)
+                if segment is None:
+                    self._sync()
+                    segment = self._newSegment(seq)
+                    if segment is None:
+                        print "Error: Journal full, sample dropped"
+                        return None
+                    slot = 0
+                offset = slot * self.recordSize
+                segment.map[offset:offset + len(record)] = record
+                self.nextSeq = seq + 1
+                if self.unsynced is None:
+                    self.unsynced = (segment, offset)
+                if self.syncEvery and \
+                   seq - segment.first - self.unsynced[1] / self.recordSize \
+                   >= self.syncEvery - 1:
+                    self._sync()
+                return seq
+
+    def _sync(self):
+        """msync the records appended since the last sync."""
+        if self.unsynced is None:
+            return
+        segment, start = self.unsynced
+        end = (self.nextSeq - segment.first) * self.recordSize
+        segment.map.flush(start, min(end, self.segmentSize) - start)
+        self.unsynced = None
+
+    def read(self, start, limit):
+        """Read up to limit records from sequence number start on. Returns
+           ([(seq, sample)...], the sequence number to read from next);
+           corrupt records are skipped."""
+        with self.lock:
+            end = min(start + limit, self.nextSeq)
+            records = []
+            for seq in range(start, end):
+                segment, slot = self._locate(seq)
+                record = None if segment is None else \
+                         self._slot(segment, slot)
+                if record is None or record[0] != seq:
+                    print "Error: Journal record %d is corrupt, skipped" % seq
+                    self.corrupt += 1
+                    corruptRecords.inc()
+                    continue
+                records.append(record)
+            return records, max(start, end)
+
+    def acknowledge(self, seq):
+        """Note that every record up to seq is in the database."""
+        with self.lock:
+            if seq <= self.acked:
+                return
+            self.acked = seq
+            if self.readOnly:
+                return
+            path = os.path.join(self.directory, "ack")
+            with open(path + ".tmp", "w") as ack:
+                ack.write("%d\n" % seq)
+                ack.flush()
+                os.fsync(ack.fileno())
+            os.rename(path + ".tmp", path)
+
+    def backlog(self):
+        """Number of records not yet acknowledged."""
+        return self.nextSeq - 1 - self.acked
+
+    def compact(self):
+        """Delete the fully acknowledged segments, except the newest one, to
+           give the space back. Returns the number removed."""
+        with self.lock:
+            spare = [segment for segment in self.segments[:-1]
+                     if segment.first + self.segmentRecords - 1 <= self.acked]
+            for segment in spare:
+                self.segments.remove(segment)
+                segment.close()
+                os.remove(segment.path)
+            return len(spare)
+
+    def info(self):
+        return {"id": self.id, "directory": self.directory,
+                "segments": len(self.segments),
+                "bytes": len(self.segments) * self.segmentSize,
+                "firstSeq": self.segments[0].first if self.segments else None,
+                "nextSeq": self.nextSeq, "acked": self.acked,
+                "backlog": self.backlog()}
+
+    def close(self):
+        with self.lock:
+            if not self.readOnly:
+                self._sync()
+            for segment in self.segments:
+                segment.close()
+            self.segments = []
+        if self.lockFile is not None:
+            self.lockFile.close()
+            self.lockFile = None
+
+def configuredJournal(config):
+    """The Journal set up by the "journal" section of radmonitor.config, or
+       None if it isn't enabled."""
+    settings = dict(config.get("journal", {}))
+    if not settings.pop("enabled", False):
+        return None
+    return Journal(settings.pop("directory"), **settings)
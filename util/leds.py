@@ -0,0 +1,157 @@
+"""Persistent sysfs LED and GPIO control.
+
+Setting a BeagleBone LED used to mean forking a shell to run
+"echo ... > /sys/class/leds/.../trigger". Here each LED's sysfs files are
+opened once and kept open, the last value written is remembered, and a write
+only happens when the state actually changes.
+
+LEDs are driven by named patterns:
+
+- "off": dark
+- "solid": on
+- "heartbeat": the kernel heartbeat trigger
+- "blink": slow blink (500 ms on, 500 ms off)
+- "error": fast blink (100 ms on, 100 ms off)
+
+The blinking patterns use the kernel's timer trigger, so they cost nothing
+once set. The monitor's LEDs are addressed by role through the shared
+controller():
+
+    from util.leds import controller
+    controller().set("gps", "error")
+
+Off the BeagleBone (no sysfs LEDs) every call is a no-op.
+"""
+
+import os, threading
+
+LED_ROOT = "/sys/class/leds"
+GPIO_ROOT = "/sys/class/gpio"
+
+ROLES = {"sample": "beaglebone:green:usr1",
+         "gps": "beaglebone:green:usr2",
+         "wifi": "beaglebone:green:usr3"}
+
+PATTERNS = {"off": ("none", None),
+            "solid": ("default-on", None),
+            "heartbeat": ("heartbeat", None),
+            "blink": ("timer", (500, 500)),
+            "error": ("timer", (100, 100))}
+
+class SysfsFile(object):
+    """A sysfs attribute kept open for writing, written only on change."""
+
+    def __init__(self, path):
+        self.fd = os.open(path, os.O_WRONLY)
+        self.value = None
+
+    def write(self, value):
+        value = str(value)
+        if value != self.value:
+            os.lseek(self.fd, 0, os.SEEK_SET)
+            os.write(self.fd, value)
+            self.value = value
+
+    def forget(self):
+        """Forget the cached value, for attributes the kernel resets."""
+        self.value = None
+
+    def close(self):
+        os.close(self.fd)
+
+class LED(object):
+    """An LED under /sys/class/leds driven by named patterns."""
+
+    def __init__(self, name, root=LED_ROOT):
+        self.path = os.path.join(root, name)
+        self.trigger = SysfsFile(os.path.join(self.path, "trigger"))
+        self.brightness = SysfsFile(os.path.join(self.path, "brightness"))
+        self.delays = None
+        self.pattern = None
+
+    def set(self, pattern):
+        """Switch to a named pattern; does nothing if it is already set."""
+        if pattern == self.pattern:
+            return
+        trigger, delays = PATTERNS[pattern]
+        if trigger != self.trigger.value:
+            self.trigger.write(trigger)
+            self.brightness.forget()
+            if trigger == "timer":
+                # delay_on and delay_off only exist under the timer trigger
+                self.delays = (SysfsFile(os.path.join(self.path, "delay_on")),
+                               SysfsFile(os.path.join(self.path, "delay_off")))
+            elif self.delays is not None:
+                for delay in self.delays:
+                    delay.close()
+                self.delays = None
+        if delays is not None:
+            self.delays[0].write(delays[0])
+            self.delays[1].write(delays[1])
+        if pattern == "off":
+            self.brightness.write(0)
+        self.pattern = pattern
+
+    def toggle(self):
+        """Flip between solid and off."""
+        self.set("off" if self.pattern == "solid" else "solid")
+
+class GPIO(object):
+    """A GPIO output under /sys/class/gpio with its value file kept open."""
+
+    def __init__(self, port, root=GPIO_ROOT):
+        self.port = port
+        path = os.path.join(root, "gpio%d" % port)
+        if not os.path.exists(path):
+            with open(os.path.join(root, "export"), "w") as export:
+                export.write("%d" % port)
+        with open(os.path.join(path, "direction"), "w") as direction:
+            direction.write("out")
+        self.valueFile = SysfsFile(os.path.join(path, "value"))
+
+    def set(self, value):
+        self.valueFile.write(1 if value else 0)
+
+    @property
+    def value(self):
+        return int(self.valueFile.value or 0)
+
+class NullLED(object):
+    """Stands in for LEDs that don't exist on this machine."""
+
+    pattern = None
+
+    def set(self, pattern):
+        PATTERNS[pattern]
+        self.pattern = pattern
+
+    def toggle(self):
+        self.set("off" if self.pattern == "solid" else "solid")
+
+class LEDController(object):
+    """The monitor's LEDs, addressed by role (see ROLES)."""
+
+    def __init__(self, roles=ROLES, root=LED_ROOT):
+        self.leds = {}
+        for role, name in roles.items():
+            try:
+                self.leds[role] = LED(name, root)
+            except (IOError, OSError):
+                self.leds[role] = NullLED()
+
+    def set(self, role, pattern):
+        self.leds[role].set(pattern)
+
+    def toggle(self, role):
+        self.leds[role].toggle()
+
+_controller = None
+_controllerLock = threading.Lock()
+
+def controller():
+    """Return the process-wide LEDController, creating it on first use."""
+    global _controller
+    with _controllerLock:
+        if _controller is None:
+            _controller = LEDController()
+    return _controller
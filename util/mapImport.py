@@ -1,33 +1,105 @@
-import psycopg2
+"""Synthesize simulated survey routes from a shapefile of roads or bus lines.
+
+Every vertex of every shape is projected back to lat/lon in a single
+vectorized Basemap call, optionally after densifying the lines so that points
+are no more than --spacing meters apart, and then clipped to the region of
+interest with array masks. The surviving points are loaded as simulated rows
+(simulated = TRUE, empty histogram) with one COPY. The empty histogram is
+formatted once and shared by every row.
+
+Run from the util directory:
+
+    python mapImport.py [--shapefile maps/bus/bus] [--spacing 20]
+"""
+
+import argparse
+from datetime import datetime, timedelta
 import numpy as np
-from datetime import datetime
+import psycopg2
 from mpl_toolkits.basemap import Basemap
 from UTC import utc
-
-m = Basemap(projection="merc")
-shp = m.readshapefile('maps/bus/bus', 'buses', drawbounds=False)
-
-# Database
-conn = psycopg2.connect(database = "radiation", user = "radiation", 
-                        password = "radiation", host = "localhost")
-cur = conn.cursor()
+import histCodec, pgcopy
 
 # Region of interest
 topleft = (-97.74676, 30.28205)
 bottomright = (-97.73434, 30.26377)
 simulatedRunStart = datetime(2012, 7, 26, 13, 0, 0, 0, utc)
 
-for shapedict, shape in zip(m.buses_info, m.buses):
-    for point in shape:
-        lat, lon = m(point[0], point[1], inverse=True)
-        if lat > topleft[0] and lat < bottomright[0] \
-           and lon > bottomright[1] and lon < topleft[1]:
-            cur.execute("INSERT INTO histograms (time, location, sampletime, " +
-                        "temp, cps, hdop, histogram, simulated) " +
-                        "VALUES (%s, ST_GeomFromText('POINT(%s %s)', 4326), 10, " +
-                                "25, 0, 1, %s, TRUE)",
-                    (simulatedRunStart, lat, lon, list(np.zeros(4096))))
-
-conn.commit()
-cur.close()
-conn.close()
+def shapeVertices(shapes):
+    """Flatten a list of shapes into x, y and shape index arrays."""
+    points = np.concatenate([np.asarray(shape, dtype=float)[:, :2]
+                             for shape in shapes])
+    index = np.repeat(np.arange(len(shapes)), [len(shape) for shape in shapes])
+    return points[:, 0], points[:, 1], index
+
+def densify(x, y, index, spacing, basemap):
+    """Insert points along each shape so that consecutive points are at most
+       spacing meters apart on the ground. Mercator distances are scaled by
+       the cosine of latitude to get ground distances."""
+    sameShape = index[1:] == index[:-1]
+    dx = np.diff(x)
+    dy = np.diff(y)
+    lon, lat = basemap((x[1:] + x[:-1]) / 2, (y[1:] + y[:-1]) / 2,
+                       inverse=True)
+    ground = np.hypot(dx, dy) * np.cos(np.radians(lat))
+    steps = np.where(sameShape, np.maximum(np.ceil(ground / spacing), 1), 1)
+    steps = steps.astype(int)
+
+    # Each segment contributes its start plus steps - 1 interior points
+    segment = np.repeat(np.arange(len(dx)), steps)
+    offset = np.arange(len(segment)) - np.repeat(np.cumsum(steps) - steps,
+                                                 steps)
+    fraction = offset / steps[segment].astype(float)
+    newX = np.append(x[segment] + fraction * dx[segment], x[-1])
+    newY = np.append(y[segment] + fraction * dy[segment], y[-1])
+    return newX, newY, np.append(index[segment], index[-1])
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--shapefile", default="maps/bus/bus",
+                        help="shapefile path, without extension")
+    parser.add_argument("--spacing", type=float, default=0,
+                        help="densify routes to this many meters per point")
+    parser.add_argument("--step", type=float, default=0,
+                        help="seconds between consecutive simulated samples")
+    args = parser.parse_args()
+
+    m = Basemap(projection="merc")
+    m.readshapefile(args.shapefile, 'buses', drawbounds=False)
+
+    x, y, index = shapeVertices(m.buses)
+    if args.spacing > 0:
+        x, y, index = densify(x, y, index, args.spacing, m)
+    lon, lat = m(x, y, inverse=True)
+    inside = (lon > topleft[0]) & (lon < bottomright[0]) & \
+             (lat > bottomright[1]) & (lat < topleft[1])
+    lon = lon[inside]
+    lat = lat[inside]
+
+    # Every simulated point carries the same empty spectrum, so format it once
+    storage = histCodec.configuredStorage()
+    columns = ("location", "time", "sampletime", "temp", "cps", "hdop") + \
+              histCodec.storageColumns(storage) + ("simulated",)
+    emptyHist = histCodec.storageValues(np.zeros(4096, dtype=int), storage,
+                                        pgcopy.byteaLiteral,
+                                        pgcopy.arrayLiteral)
+    tail = "\t" + pgcopy.formatRow((10, 25, 0, 1) + emptyHist + (True,))
+
+    lines = []
+    for i in range(len(lon)):
+        stamp = simulatedRunStart + timedelta(seconds=args.step * i)
+        lines.append(pgcopy.pointLiteral(lon[i], lat[i]) + "\t" +
+                     stamp.isoformat() + tail)
+
+    conn = psycopg2.connect(database = "radiation", user = "radiation",
+                            password = "radiation", host = "localhost")
+    cur = conn.cursor()
+    pgcopy.copyText(cur, "histograms", columns, "".join(lines))
+    conn.commit()
+    cur.close()
+    conn.close()
+    print "Loaded %d simulated points from %d shapes" % (len(lon),
+                                                         len(m.buses))
+
+if __name__ == "__main__":
+    main()
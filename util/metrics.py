@@ -0,0 +1,330 @@
+"""Counters, gauges and latency histograms for the monitor.
+
+Metrics are cheap enough to update on every sample: a counter increment or
+histogram observation is a lock and an addition, and a histogram keeps a
+fixed set of bucket counts (by default doubling from 100 us to about 13 s)
+however many values it sees. Any metric can be split by labels:
+
+    from util import metrics
+    drops = metrics.counter("dropped_samples_total", "Samples dropped",
+                            ("cause",))
+    drops.inc(cause="no_gps")
+    with metrics.histogram("read_histogram_seconds", "eMorpho readout").time():
+        hist = e.readHistogram()
+
+Metrics are registered in a process-wide registry and asking for one by a
+name already registered returns the existing metric, so modules can declare
+what they record independently. The registry can be
+
+- written as a Prometheus text file (for node_exporter's textfile collector)
+  with writeTextfile(),
+- served on a local HTTP endpoint with serve(), or
+- summarized into the monitor_metrics table (sql/metrics.sql) every few
+  minutes by a SummaryWriter, with per-interval counts and percentiles.
+
+All names get the "radmonitor_" prefix on export.
+"""
+
+import bisect, os, threading, BaseHTTPServer
+from datetime import datetime
+import psycopg2
+from util.monotonic import monotonic
+from util.UTC import utc
+
+PREFIX = "radmonitor_"
+BUCKETS = tuple(0.0001 * 2 ** i for i in range(18))
+
+def labelText(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join('%s="%s"' % (name, str(value).replace('"', '\\"'))
+                          for name, value in pairs) + "}"
+
+class Metric(object):
+
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def key(self, labels):
+        if len(labels) != len(self.labels):
+            raise ValueError("%s needs labels %s" % (self.name,
+                                                     ", ".join(self.labels)))
+        return tuple(labels[name] for name in self.labels)
+
+    def header(self):
+        return "# HELP %s%s %s\n# TYPE %s%s %s\n" % (PREFIX, self.name,
+                                                     self.help, PREFIX,
+                                                     self.name, self.kind)
+
+class Counter(Metric):
+    """A count that only goes up."""
+
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.values)
+
+    def text(self):
+        lines = [self.header()]
+        for key, value in sorted(self.snapshot().items()):
+            lines.append("%s%s%s %r\n" % (PREFIX, self.name,
+                                          labelText(self.labels, key), value))
+        return "".join(lines)
+
+class Gauge(Counter):
+    """A value that is set, like a queue depth."""
+
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+class _Timer(object):
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = monotonic()
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        self.histogram.observe(monotonic() - self.started, **self.labels)
+        return False
+
+class Histogram(Metric):
+    """Counts of observations in fixed buckets, with their sum and maximum.
+       Values above the last bucket bound are counted in an overflow
+       bucket."""
+
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        Metric.__init__(self, name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            state = self.values.get(key)
+            if state is None:
+                state = self.values[key] = [[0] * (len(self.buckets) + 1),
+                                            0.0, value]
+            state[0][index] += 1
+            state[1] += value
+            state[2] = max(state[2], value)
+
+    def time(self, **labels):
+        """Context manager observing the seconds its block takes."""
+        return _Timer(self, labels)
+
+    def snapshot(self):
+        """Return {labels: (bucket counts, sum, max)}."""
+        with self.lock:
+            return dict((key, (list(counts), total, peak))
+                        for key, (counts, total, peak) in self.values.items())
+
+    def quantile(self, counts, q, peak=None):
+        """Estimate a quantile from bucket counts, interpolating linearly
+           within the bucket it falls in."""
+        total = sum(counts)
+        if not total:
+            return None
+        rank = q * total
+        seen = 0
+        for i, count in enumerate(counts):
+            if count and seen + count >= rank:
+                if i == len(self.buckets):
+                    return peak if peak is not None else self.buckets[-1]
+                lower = self.buckets[i - 1] if i else 0.0
+                value = lower + (self.buckets[i] - lower) * (rank - seen) / count
+                return value if peak is None else min(value, peak)
+            seen += count
+        return peak
+
+    def text(self):
+        lines = [self.header()]
+        for key, (counts, total, peak) in sorted(self.snapshot().items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append("%s%s_bucket%s %d\n" %
+                             (PREFIX, self.name,
+                              labelText(self.labels, key, [("le", le)]),
+                              cumulative))
+            labels = labelText(self.labels, key)
+            lines.append("%s%s_sum%s %r\n" % (PREFIX, self.name, labels, total))
+            lines.append("%s%s_count%s %d\n" % (PREFIX, self.name, labels,
+                                                cumulative))
+        return "".join(lines)
+
+class Registry(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+    def _get(self, cls, name, help, labels, **kwargs):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = cls(name, help, labels, **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError("%s is already a %s" % (name, metric.kind))
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self._get(Counter, name, help, labels)
+
+    def gauge(self, name, help, labels=()):
+        return self._get(Gauge, name, help, labels)
+
+    def histogram(self, name, help, labels=(), buckets=BUCKETS):
+        return self._get(Histogram, name, help, labels, buckets=buckets)
+
+    def text(self):
+        """All metrics in the Prometheus text exposition format."""
+        with self.lock:
+            metrics = sorted(self.metrics.items())
+        return "".join(metric.text() for name, metric in metrics)
+
+registry = Registry()
+counter = registry.counter
+gauge = registry.gauge
+histogram = registry.histogram
+
+def writeTextfile(path, registry=registry):
+    """Write the metrics to path, atomically, for a textfile collector."""
+    with open(path + ".tmp", "w") as out:
+        out.write(registry.text())
+    os.rename(path + ".tmp", path)
+
+def serve(port, host="127.0.0.1", registry=registry):
+    """Serve the metrics at http://host:port/metrics from a daemon thread.
+       Returns the server."""
+
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            if self.path not in ("/", "/metrics"):
+                self.send_error(404)
+                return
+            body = registry.text()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = BaseHTTPServer.HTTPServer((host, port), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+class SummaryWriter(threading.Thread):
+    """Every interval seconds, write what each metric recorded since the
+       previous summary to monitor_metrics: counts for counters, and count,
+       mean, percentiles and maximum bucket for histograms. Gauges are
+       written as their current value. Keyword arguments are passed to
+       psycopg2.connect."""
+
+    def __init__(self, sensor, interval=300, registry=registry, **connArgs):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.sensor = sensor
+        self.interval = interval
+        self.registry = registry
+        self.connArgs = connArgs
+        self.previous = {}
+        self.running = True
+        self.wake = threading.Event()
+        self.conn = None
+
+    def rows(self, now):
+        """Rows of the summary since the last written one, and the snapshot
+           to measure the next summary from once these are written."""
+        with self.registry.lock:
+            metrics = sorted(self.registry.metrics.items())
+        rows = []
+        current = {}
+        for name, metric in metrics:
+            for key, value in sorted(metric.snapshot().items()):
+                labels = labelText(metric.labels, key) or None
+                before = self.previous.get((name, key))
+                current[(name, key)] = value
+                if isinstance(metric, Histogram):
+                    counts, total, peak = value
+                    if before is not None:
+                        counts = [a - b for a, b in zip(counts, before[0])]
+                        total -= before[1]
+                    count = sum(counts)
+                    if not count:
+                        continue
+                    rows.append((now, self.sensor, name, labels, count,
+                                 total / count,
+                                 metric.quantile(counts, 0.5, peak),
+                                 metric.quantile(counts, 0.9, peak),
+                                 metric.quantile(counts, 0.99, peak)))
+                elif isinstance(metric, Gauge):
+                    rows.append((now, self.sensor, name, labels, None, value,
+                                 None, None, None))
+                else:
+                    delta = value - (before or 0)
+                    rows.append((now, self.sensor, name, labels, delta, None,
+                                 None, None, None))
+        return rows, current
+
+    def write(self):
+        rows, current = self.rows(datetime.now(utc))
+        if not rows:
+            self.previous = current
+            return
+        if self.conn is None or self.conn.closed:
+            self.conn = psycopg2.connect(**self.connArgs)
+        cur = self.conn.cursor()
+        cur.executemany("INSERT INTO monitor_metrics (time, sensor, name, " +
+                        "labels, count, value, p50, p90, p99) VALUES " +
+                        "(%s, %s, %s, %s, %s, %s, %s, %s, %s)", rows)
+        self.conn.commit()
+        cur.close()
+        # Only now, so a failed write is included in the next summary
+        self.previous = current
+
+    def run(self):
+        while self.running:
+            self.wake.wait(self.interval)
+            self.wake.clear()
+            try:
+                self.write()
+            except psycopg2.Error as error:
+                print "Error: Couldn't write metrics summary: %s" % error
+                if self.conn is not None:
+                    self.conn.close()
+                self.conn = None
+
+    def stop(self):
+        self.running = False
+        self.wake.set()
+        self.join(5)
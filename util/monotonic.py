@@ -0,0 +1,37 @@
+"""A monotonic clock for Python 2.
+
+time.time() jumps whenever the system clock is set, and headlessMonitor sets
+it from GPS. Anything that schedules or measures intervals should use
+monotonic() instead, which reads CLOCK_MONOTONIC through librt on Linux and
+falls back to time.time() elsewhere.
+"""
+
+import ctypes, ctypes.util, os, time
+
+CLOCK_MONOTONIC = 1
+
+class timespec(ctypes.Structure):
+    _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+def _librtMonotonic():
+    librt = ctypes.CDLL(ctypes.util.find_library("rt") or "librt.so.1",
+                        use_errno=True)
+    clock_gettime = librt.clock_gettime
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+
+    def monotonic():
+        """Seconds from an arbitrary fixed point, never going backwards."""
+        now = timespec()
+        if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(now)) != 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        return now.tv_sec + now.tv_nsec * 1e-9
+    return monotonic
+
+if hasattr(time, "monotonic"):
+    monotonic = time.monotonic
+else:
+    try:
+        monotonic = _librtMonotonic()
+    except (OSError, AttributeError):
+        monotonic = time.time
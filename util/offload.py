@@ -0,0 +1,440 @@
+"""Incremental offload of histograms to the base station.
+
+Each sensor keeps a high-water mark on histograms.id in offload_state (see
+sql/offload.sql). Its rows above the mark are dumped, a batch at a time, with
+COPY into gzipped files in a local spool directory, and the mark advances
+only once a batch is safely on disk. Spooled batches are then shipped to the
+target whenever the link is up:
+
+- each batch is a <sensor>-<first id>-<last id>.copy.gz file plus a .json
+  manifest with its columns, row count and SHA-256 checksum;
+- the file is written to the target as .part and appended to, so a dropped
+  link resumes where it stopped rather than starting the batch again;
+- once the whole file is there and its checksum matches, it is renamed and
+  the manifest written last, so a manifest on the target always means a
+  complete batch, and the spooled copy is deleted;
+- sending is rate limited (rateLimit bytes per second) so that it never
+  starves acquisition of CPU, SD card or USB bandwidth.
+
+Targets are a local directory (LocalTransport, also handy for testing) or a
+directory on the router reached over ssh (SSHTransport, using the routerIp,
+username and target settings). On the ingest side, merge() bulk-loads every
+complete batch in a directory into histograms, remembering in offload_ingest
+which batches each device has sent so that nothing is loaded twice.
+
+headlessMonitor runs an Offloader thread when the "offload" section of
+radmonitor.config is enabled. By hand, from the util directory:
+
+    python offload.py spool
+    python offload.py send [--local DIR]
+    python offload.py merge DIR
+    python offload.py status
+"""
+
+import argparse, glob, gzip, hashlib, json, os, shutil, subprocess
+import threading, time
+import psycopg2
+from monotonic import monotonic
+
+CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..",
+                      "radmonitor.config")
+
+CHUNK = 65536
+
+def loadConfig(path=CONFIG):
+    with open(path) as config:
+        return json.load(config)
+
+class RateLimiter(object):
+    """Token bucket allowing rate bytes per second on average, in bursts of
+       up to burst bytes. A rate of None or 0 means no limit."""
+
+    def __init__(self, rate, burst=CHUNK):
+        self.rate = rate
+        self.burst = max(burst, CHUNK)
+        self.tokens = self.burst
+        self.last = monotonic()
+
+    def consume(self, count):
+        if not self.rate:
+            return
+        now = monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        self.tokens -= count
+        if self.tokens < 0:
+            time.sleep(-self.tokens / float(self.rate))
+
+def checksum(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as data:
+        for block in iter(lambda: data.read(CHUNK), ""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def readManifest(path):
+    with open(path) as manifest:
+        return json.load(manifest)
+
+def writeManifest(path, manifest):
+    with open(path + ".tmp", "w") as out:
+        json.dump(manifest, out, indent=1)
+    os.rename(path + ".tmp", path)
+
+# Device side: spooling batches
+
+def highWaterMark(cur, sensor):
+    cur.execute("SELECT sentid FROM offload_state WHERE sensor = %s", (sensor,))
+    row = cur.fetchone()
+    return row[0] if row else 0
+
+def spoolBatch(conn, sensor, spool, batchRows=1800):
+    """Dump the sensor's next batchRows rows above its high-water mark into
+       the spool directory and advance the mark. Returns the manifest path, or None if
+       there was nothing new."""
+    cur = conn.cursor()
+    after = highWaterMark(cur, sensor)
+    cur.execute("SELECT max(id), count(*) FROM (SELECT id FROM histograms " +
+                "WHERE id > %s AND sensor = %s ORDER BY id LIMIT %s) batch",
+                (after, sensor, batchRows))
+    last, rows = cur.fetchone()
+    if not rows:
+        conn.rollback()
+        cur.close()
+        return None
+    cur.execute("SELECT * FROM histograms LIMIT 0")
+    columns = [column[0] for column in cur.description]
+
+    name = "%s-%010d-%010d" % (sensor, after + 1, last)
+    path = os.path.join(spool, name + ".copy.gz")
+    query = cur.mogrify("SELECT " + ", ".join('"%s"' % c for c in columns) +
+                        " FROM histograms WHERE id > %s AND id <= %s " +
+                        "AND sensor = %s ORDER BY id", (after, last, sensor))
+    dump = gzip.open(path + ".tmp", "wb")
+    cur.copy_expert("COPY (" + query + ") TO STDOUT", dump)
+    dump.close()
+    os.rename(path + ".tmp", path)
+    writeManifest(os.path.join(spool, name + ".json"),
+                  {"sensor": sensor, "first": after + 1, "last": last,
+                   "rows": rows, "columns": columns,
+                   "bytes": os.path.getsize(path), "sha256": checksum(path)})
+
+    cur.execute("UPDATE offload_state SET sentid = %s WHERE sensor = %s",
+                (last, sensor))
+    if cur.rowcount == 0:
+        cur.execute("INSERT INTO offload_state (sensor, sentid) " +
+                    "VALUES (%s, %s)", (sensor, last))
+    conn.commit()
+    cur.close()
+    return os.path.join(spool, name + ".json")
+
+def spooled(spool):
+    """Manifests of the batches waiting in the spool, oldest first."""
+    return sorted(glob.glob(os.path.join(spool, "*.json")))
+
+# Transports
+
+class LocalTransport(object):
+    """Ship batches to a directory on this machine, or a mounted share."""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def size(self, name):
+        try:
+            return os.path.getsize(self.path(name))
+        except OSError:
+            return 0
+
+    def append(self, name, source, offset, limiter):
+        with open(self.path(name), "ab") as out:
+            out.seek(0, os.SEEK_END)
+            if out.tell() != offset:
+                raise IOError("%s changed size while resuming" % name)
+            for block in iter(lambda: source.read(CHUNK), ""):
+                limiter.consume(len(block))
+                out.write(block)
+            out.flush()
+            os.fsync(out.fileno())
+
+    def checksum(self, name):
+        return checksum(self.path(name))
+
+    def rename(self, old, new):
+        os.rename(self.path(old), self.path(new))
+
+    def put(self, name, text):
+        with open(self.path(name + ".tmp"), "w") as out:
+            out.write(text)
+        os.rename(self.path(name + ".tmp"), self.path(name))
+
+    def remove(self, name):
+        if os.path.exists(self.path(name)):
+            os.remove(self.path(name))
+
+class SSHTransport(object):
+    """Ship batches to a directory on the router over ssh. Needs key-based
+       login and a POSIX shell with sha256sum at the far end."""
+
+    def __init__(self, host, username, directory, timeout=20):
+        self.login = "%s@%s" % (username, host)
+        self.directory = directory
+        self.timeout = timeout
+
+    def path(self, name):
+        return "'" + os.path.join(self.directory, name) + "'"
+
+    def command(self, script):
+        return ["ssh", "-o", "BatchMode=yes",
+                "-o", "ConnectTimeout=%d" % self.timeout,
+                "-o", "ServerAliveInterval=%d" % self.timeout,
+                self.login, script]
+
+    def run(self, script, stdin=None):
+        process = subprocess.Popen(self.command(script), stdin=stdin,
+                                   stdout=subprocess.PIPE)
+        output = process.communicate()[0]
+        if process.returncode != 0:
+            raise IOError("ssh %s failed with status %d" %
+                          (script, process.returncode))
+        return output
+
+    def size(self, name):
+        return int(self.run("wc -c < %s 2>/dev/null || echo 0" %
+                            self.path(name)).split()[0])
+
+    def append(self, name, source, offset, limiter):
+        process = subprocess.Popen(self.command("cat >> %s" % self.path(name)),
+                                   stdin=subprocess.PIPE)
+        try:
+            for block in iter(lambda: source.read(CHUNK), ""):
+                limiter.consume(len(block))
+                process.stdin.write(block)
+            process.stdin.close()
+        except IOError:
+            pass
+        if process.wait() != 0:
+            raise IOError("Sending %s failed with status %d" %
+                          (name, process.returncode))
+
+    def checksum(self, name):
+        return self.run("sha256sum %s" % self.path(name)).split()[0]
+
+    def rename(self, old, new):
+        self.run("mv -f %s %s" % (self.path(old), self.path(new)))
+
+    def put(self, name, text):
+        process = subprocess.Popen(self.command("cat > %s.tmp && mv -f %s.tmp %s"
+                                                % ((self.path(name),) * 3)),
+                                   stdin=subprocess.PIPE)
+        process.communicate(text)
+        if process.returncode != 0:
+            raise IOError("Writing %s failed" % name)
+
+    def remove(self, name):
+        self.run("rm -f %s" % self.path(name))
+
+def configuredTransport(config):
+    offload = config.get("offload", {})
+    if offload.get("transport", "ssh") == "local":
+        return LocalTransport(offload.get("target", config["target"]))
+    return SSHTransport(config["routerIp"], config["username"],
+                        offload.get("target", config["target"]))
+
+def sendBatch(transport, manifestPath, limiter):
+    """Send one spooled batch, resuming a partial upload, and delete it from
+       the spool once it has arrived intact."""
+    manifest = readManifest(manifestPath)
+    batch = manifestPath[:-len(".json")] + ".copy.gz"
+    name = os.path.basename(batch)
+    part = name + ".part"
+
+    offset = transport.size(part)
+    if offset > manifest["bytes"]:
+        transport.remove(part)
+        offset = 0
+    if offset < manifest["bytes"]:
+        with open(batch, "rb") as source:
+            source.seek(offset)
+            transport.append(part, source, offset, limiter)
+    if transport.checksum(part) != manifest["sha256"]:
+        transport.remove(part)
+        raise IOError("Checksum mismatch sending %s; will resend" % name)
+    transport.rename(part, name)
+    transport.put(os.path.basename(manifestPath), json.dumps(manifest, indent=1))
+    os.remove(batch)
+    os.remove(manifestPath)
+    return manifest["rows"]
+
+def sendSpool(transport, spool, limiter, keepGoing=lambda: True):
+    """Send spooled batches oldest first while keepGoing() holds. Returns the
+       number of rows sent."""
+    sent = 0
+    for manifestPath in spooled(spool):
+        if not keepGoing():
+            break
+        sent += sendBatch(transport, manifestPath, limiter)
+    return sent
+
+class Offloader(threading.Thread):
+    """Every interval seconds, spool new rows and, if linkUp() says the
+       router is reachable, send the spool. Errors are printed and retried
+       on the next round."""
+
+    def __init__(self, transport, sensor, spool, linkUp=lambda: True,
+                 interval=60, batchRows=1800, rateLimit=None,
+                 **connArgs):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.transport = transport
+        self.sensor = int(sensor)
+        self.spool = spool
+        self.linkUp = linkUp
+        self.interval = interval
+        self.batchRows = batchRows
+        self.limiter = RateLimiter(rateLimit)
+        self.connArgs = connArgs
+        self.running = True
+        self.wake = threading.Event()
+        self.rowsSpooled = 0
+        self.rowsSent = 0
+        self.errors = 0
+        if not os.path.isdir(spool):
+            os.makedirs(spool)
+
+    def run(self):
+        conn = None
+        while self.running:
+            try:
+                if conn is None:
+                    conn = psycopg2.connect(**self.connArgs)
+                while self.running:
+                    manifest = spoolBatch(conn, self.sensor, self.spool,
+                                          self.batchRows)
+                    if manifest is None:
+                        break
+                    self.rowsSpooled += readManifest(manifest)["rows"]
+                if self.linkUp():
+                    self.rowsSent += sendSpool(self.transport, self.spool,
+                                               self.limiter,
+                                               lambda: self.running and
+                                                       self.linkUp())
+            except (psycopg2.Error, IOError, OSError) as error:
+                self.errors += 1
+                print "Offload error:", error
+                if isinstance(error, psycopg2.Error) and conn is not None:
+                    conn.close()
+                    conn = None
+            self.wake.wait(self.interval)
+            self.wake.clear()
+        if conn is not None:
+            conn.close()
+
+    def stop(self):
+        self.running = False
+        self.wake.set()
+        self.join(5)
+
+# Ingest side
+
+def merge(conn, directory, done=None):
+    """Load every complete batch in directory into histograms, once. Loaded
+       batches are moved to done (default: directory/merged). Returns the
+       number of rows loaded."""
+    done = done or os.path.join(directory, "merged")
+    if not os.path.isdir(done):
+        os.makedirs(done)
+    cur = conn.cursor()
+    loaded = 0
+    for manifestPath in sorted(glob.glob(os.path.join(directory, "*.json"))):
+        manifest = readManifest(manifestPath)
+        batch = manifestPath[:-len(".json")] + ".copy.gz"
+        if checksum(batch) != manifest["sha256"]:
+            print "Skipping %s: checksum mismatch" % batch
+            continue
+        cur.execute("SELECT 1 FROM offload_ingest WHERE sensor = %s AND " +
+                    "firstid = %s", (manifest["sensor"], manifest["first"]))
+        if cur.fetchone() is None:
+            columns = manifest["columns"]
+            quoted = ", ".join('"%s"' % c for c in columns if c != "id")
+            cur.execute("CREATE TEMP TABLE offload_staging " +
+                        "(LIKE histograms) ON COMMIT DROP")
+            source = gzip.open(batch, "rb")
+            cur.copy_expert("COPY offload_staging (" +
+                            ", ".join('"%s"' % c for c in columns) +
+                            ") FROM STDIN", source)
+            source.close()
+            cur.execute("INSERT INTO histograms (" + quoted + ") SELECT " +
+                        quoted + " FROM offload_staging ORDER BY id")
+            # The partition routing trigger leaves rowcount at 0
+            cur.execute("SELECT count(*) FROM offload_staging")
+            rows = cur.fetchone()[0]
+            cur.execute("INSERT INTO offload_ingest (sensor, firstid, lastid, " +
+                        "rows) VALUES (%s, %s, %s, %s)",
+                        (manifest["sensor"], manifest["first"],
+                         manifest["last"], rows))
+            conn.commit()
+            loaded += rows
+            print "Merged %s: %d rows" % (os.path.basename(batch), rows)
+        else:
+            print "Already merged %s" % os.path.basename(batch)
+        shutil.move(batch, done)
+        shutil.move(manifestPath, done)
+    cur.close()
+    return loaded
+
+def status(conn, spool):
+    cur = conn.cursor()
+    cur.execute("SELECT sensor, sentid FROM offload_state ORDER BY sensor")
+    for sensor, sentid in cur.fetchall():
+        cur.execute("SELECT count(*) FROM histograms WHERE id > %s " +
+                    "AND sensor = %s", (sentid, sensor))
+        print "Sensor %s: spooled up to id %d, %d rows not yet spooled" % \
+              (sensor, sentid, cur.fetchone()[0])
+    batches = [readManifest(path) for path in spooled(spool)]
+    print "%d batches (%d rows) waiting in %s" % \
+          (len(batches), sum(batch["rows"] for batch in batches), spool)
+    cur.close()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    commands = parser.add_subparsers(dest="command")
+    commands.add_parser("spool")
+    sendParser = commands.add_parser("send")
+    sendParser.add_argument("--local", metavar="DIR",
+                            help="send to a local directory instead")
+    mergeParser = commands.add_parser("merge")
+    mergeParser.add_argument("dir", help="directory of received batches")
+    commands.add_parser("status")
+    args = parser.parse_args()
+
+    config = loadConfig()
+    offload = config.get("offload", {})
+    spool = offload.get("spool", "spool")
+    conn = psycopg2.connect(database = "radiation", user = "radiation",
+                            password = "radiation", host = "localhost")
+    if args.command == "spool":
+        if not os.path.isdir(spool):
+            os.makedirs(spool)
+        while spoolBatch(conn, int(config["sensor"]), spool,
+                         offload.get("batchRows", 1800)):
+            pass
+        status(conn, spool)
+    elif args.command == "send":
+        if args.local:
+            transport = LocalTransport(args.local)
+        else:
+            transport = configuredTransport(config)
+        sent = sendSpool(transport, spool, RateLimiter(offload.get("rateLimit")))
+        print "Sent %d rows" % sent
+    elif args.command == "merge":
+        print "Merged %d rows" % merge(conn, args.dir)
+    else:
+        status(conn, spool)
+    conn.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""Convert existing histograms rows to the packed bytea format.
+
+Walks the table in id order, a chunk at a time, packing each integer[]
+histogram with histCodec and writing it to histpack. Every chunk is committed
+on its own, so the tool can be stopped at any point and rerun; rows that
+already have a histpack are skipped. With --clear-arrays the integer[] column
+is set to NULL once the packed copy has been decoded and checked, which is
+what actually frees space on the SD card (after a VACUUM).
+
+Apply sql/histpack.sql first. Run from the util directory:
+
+    python packHistograms.py --chunk 2000 --clear-arrays
+"""
+
+import argparse, time
+import numpy as np
+import psycopg2
+import histCodec
+
+def packChunk(cur, afterId, chunk, clearArrays):
+    """Pack up to chunk unpacked rows with id > afterId. Returns the number
+       of rows packed, the raw and packed byte counts, and the last id seen."""
+    cur.execute("SELECT id, histogram FROM histograms " +
+                "WHERE id > %s AND histpack IS NULL AND histogram IS NOT NULL " +
+                "ORDER BY id LIMIT %s", (afterId, chunk))
+    rows = cur.fetchall()
+    if not rows:
+        return 0, 0, 0, afterId
+
+    ids = []
+    blobs = []
+    rawBytes = packedBytes = 0
+    for rowId, histogram in rows:
+        hist = np.asarray(histogram, dtype=np.int64)
+        blob = histCodec.encode(hist)
+        if clearArrays and not np.array_equal(histCodec.decode(blob), hist):
+            raise ValueError("Histogram %d did not survive packing" % rowId)
+        ids.append(rowId)
+        blobs.append(psycopg2.Binary(blob))
+        rawBytes += 4 * len(hist)
+        packedBytes += len(blob)
+
+    values = ",".join(cur.mogrify("(%s, %s)", pair) for pair in zip(ids, blobs))
+    clear = ", histogram = NULL" if clearArrays else ""
+    cur.execute("UPDATE histograms SET histpack = v.histpack" + clear + " " +
+                "FROM (VALUES " + values + ") AS v (id, histpack) " +
+                "WHERE histograms.id = v.id")
+    return len(rows), rawBytes, packedBytes, ids[-1]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--chunk", type=int, default=1000,
+                        help="rows converted per transaction")
+    parser.add_argument("--clear-arrays", action="store_true",
+                        help="set the integer[] histogram to NULL once packed")
+    parser.add_argument("--start-id", type=int, default=0,
+                        help="only convert rows with a larger id")
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(database = "radiation", user = "radiation",
+                            password = "radiation", host = "localhost")
+    cur = conn.cursor()
+
+    lastId = args.start_id
+    total = rawTotal = packedTotal = 0
+    started = time.time()
+    while True:
+        count, rawBytes, packedBytes, lastId = packChunk(cur, lastId,
+                                                         args.chunk,
+                                                         args.clear_arrays)
+        conn.commit()
+        if count == 0:
+            break
+        total += count
+        rawTotal += rawBytes
+        packedTotal += packedBytes
+        print "Packed %d rows through id %d (%.1fx, %.0f rows/s)" % \
+              (total, lastId, float(rawTotal) / packedTotal,
+               total / (time.time() - started))
+
+    cur.close()
+    conn.close()
+    print "Done: %d rows packed" % total
+
+if __name__ == "__main__":
+    main()
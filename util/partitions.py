@@ -0,0 +1,224 @@
+"""Manage the monthly partitions and summary tables of histograms.
+
+Apply sql/partitions.sql first; it installs the routing trigger and creates
+the summary tables. Then, from the util directory:
+
+    python partitions.py convert
+        Move rows still held in the parent table into their monthly
+        partitions, one month per transaction.
+
+    python partitions.py summarize
+        Fill histograms_hourly and histograms_daily with per-hour and per-day
+        sample counts, live time, mean cps, summed spectra and bounding
+        boxes. Only the buckets from the latest summarized hour onward are
+        recomputed, so this is cheap to run from cron.
+
+    python partitions.py archive --before 2014-01 --dir /mnt/archive [--drop]
+        Dump every partition older than the given month to a gzipped COPY
+        file, detach it from histograms and then either drop it or move it
+        to another tablespace (--tablespace). Newer partitions are untouched
+        and the summary tables keep covering archived months.
+
+    python partitions.py list
+        Show each partition with its row count and size.
+"""
+
+import argparse, gzip, os
+from datetime import datetime, timedelta
+import numpy as np
+import psycopg2
+import histCodec, pgcopy
+from UTC import utc
+
+SUMMARY_COLUMNS = ("bucket", "sensor", "simulated", "samples", "livetime",
+                   "meancps", "spectrum", "xmin", "ymin", "xmax", "ymax",
+                   "bbox")
+
+def partitions(cur):
+    """Return the names of the child tables of histograms, oldest first."""
+    cur.execute("SELECT c.relname FROM pg_inherits i " +
+                "JOIN pg_class c ON c.oid = i.inhrelid " +
+                "JOIN pg_class p ON p.oid = i.inhparent " +
+                "WHERE p.relname = 'histograms' ORDER BY c.relname")
+    return [row[0] for row in cur.fetchall()]
+
+def convert(conn):
+    """Move rows out of the parent table into their partitions."""
+    cur = conn.cursor()
+    cur.execute("SELECT DISTINCT date_trunc('month', time AT TIME ZONE 'UTC') " +
+                "FROM ONLY histograms")
+    months = sorted(row[0] for row in cur.fetchall())
+    for month in months:
+        if month is None:
+            where = "time IS NULL"
+            params = ()
+            cur.execute("SELECT ensure_histograms_partition(NULL)")
+        else:
+            where = "time >= %s AND time < %s"
+            start = month.replace(tzinfo=utc)
+            end = (start + timedelta(days=32)).replace(day=1)
+            params = (start, end)
+            cur.execute("SELECT ensure_histograms_partition(%s)", (start,))
+        child = cur.fetchone()[0]
+        cur.execute("INSERT INTO " + child + " SELECT * FROM ONLY histograms " +
+                    "WHERE " + where, params)
+        moved = cur.rowcount
+        cur.execute("DELETE FROM ONLY histograms WHERE " + where, params)
+        conn.commit()
+        print "Moved %d rows into %s" % (moved, child)
+    cur.close()
+
+def bboxLiteral(xmin, ymin, xmax, ymax):
+    return pgcopy.Literal("SRID=4326;POLYGON((%r %r,%r %r,%r %r,%r %r,%r %r))" %
+                          (xmin, ymin, xmin, ymax, xmax, ymax, xmax, ymin,
+                           xmin, ymin))
+
+def summaryRow(key, samples, livetime, sumcps, spectrum, box):
+    bucket, sensor, simulated = key
+    meancps = sumcps / samples if samples else None
+    if np.isnan(box[0]):
+        box = (None, None, None, None, None)
+    else:
+        box = tuple(float(edge) for edge in box) + (bboxLiteral(*box),)
+    return (bucket, sensor, simulated, samples, livetime, meancps,
+            pgcopy.arrayLiteral(spectrum)) + box
+
+def summarizeDay(cur, day):
+    """Recompute the hourly and daily summaries of one UTC day."""
+    end = day + timedelta(days=1)
+    cur.execute("SELECT time, coalesce(sensor, 0), simulated, " +
+                "coalesce(sampletime, 0), coalesce(cps, 0), " +
+                "ST_X(location), ST_Y(location), " +
+                histCodec.selectColumns(histCodec.configuredStorage()) + " " +
+                "FROM histograms WHERE time >= %s AND time < %s", (day, end))
+    hours = {}
+    for row in cur:
+        if row[7] is None and row[8] is None:
+            continue
+        hour = row[0].astimezone(utc).replace(minute=0, second=0,
+                                               microsecond=0)
+        key = (hour, row[1], row[2])
+        if key not in hours:
+            hours[key] = [0, 0.0, 0.0, 0, [np.inf, np.inf, -np.inf, -np.inf]]
+        summary = hours[key]
+        summary[0] += 1
+        summary[1] += row[3]
+        summary[2] += row[4]
+        summary[3] = summary[3] + histCodec.fromRow(row[7], row[8])
+        if row[5] is not None:
+            box = summary[4]
+            box[:] = [min(box[0], row[5]), min(box[1], row[6]),
+                      max(box[2], row[5]), max(box[3], row[6])]
+
+    days = {}
+    hourly = []
+    for key in sorted(hours):
+        samples, livetime, sumcps, spectrum, box = hours[key]
+        box = [np.nan] * 4 if np.isinf(box[0]) else box
+        hourly.append(summaryRow(key, samples, livetime, sumcps, spectrum,
+                                 box))
+        dayKey = (day, key[1], key[2])
+        if dayKey not in days:
+            days[dayKey] = [0, 0.0, 0.0, 0, [np.nan] * 4]
+        total = days[dayKey]
+        total[0] += samples
+        total[1] += livetime
+        total[2] += sumcps
+        total[3] = total[3] + spectrum
+        total[4] = [np.fmin(total[4][0], box[0]), np.fmin(total[4][1], box[1]),
+                    np.fmax(total[4][2], box[2]), np.fmax(total[4][3], box[3])]
+    daily = [summaryRow(key, *days[key]) for key in sorted(days)]
+
+    for table, rows in (("histograms_hourly", hourly),
+                        ("histograms_daily", daily)):
+        cur.execute("DELETE FROM " + table + " WHERE bucket >= %s AND " +
+                    "bucket < %s", (day, end))
+        if rows:
+            pgcopy.copyRows(cur, table, SUMMARY_COLUMNS, rows)
+    return len(hourly)
+
+def summarize(conn):
+    """Bring the summary tables up to date, from the last summarized day."""
+    cur = conn.cursor()
+    cur.execute("SELECT max(bucket) FROM histograms_hourly")
+    start = cur.fetchone()[0]
+    if start is None:
+        cur.execute("SELECT min(time) FROM histograms")
+        start = cur.fetchone()[0]
+    cur.execute("SELECT max(time) FROM histograms")
+    last = cur.fetchone()[0]
+    if start is None or last is None:
+        print "Nothing to summarize"
+        return
+    day = start.astimezone(utc).replace(hour=0, minute=0, second=0,
+                                        microsecond=0)
+    while day <= last:
+        count = summarizeDay(cur, day)
+        conn.commit()
+        print "Summarized %s: %d hourly buckets" % (day.date(), count)
+        day += timedelta(days=1)
+    cur.close()
+
+def archive(conn, before, directory, drop=False, tablespace=None):
+    """Dump and detach every monthly partition older than the month of
+       before, a date."""
+    cutoff = "histograms_y%04dm%02d" % (before.year, before.month)
+    cur = conn.cursor()
+    for child in partitions(cur):
+        if not child.startswith("histograms_y") or child >= cutoff:
+            continue
+        path = os.path.join(directory, child + ".copy.gz")
+        dump = gzip.open(path, "wb")
+        cur.copy_expert("COPY " + child + " TO STDOUT", dump)
+        dump.close()
+        cur.execute("ALTER TABLE " + child + " NO INHERIT histograms")
+        if drop:
+            cur.execute("DROP TABLE " + child)
+        elif tablespace:
+            cur.execute("ALTER TABLE " + child + " SET TABLESPACE " +
+                        tablespace)
+        conn.commit()
+        print "Archived %s to %s" % (child, path)
+    cur.close()
+
+def listPartitions(conn):
+    cur = conn.cursor()
+    for child in partitions(cur):
+        cur.execute("SELECT count(*), pg_size_pretty(pg_total_relation_size(" +
+                    "%s)) FROM " + child, (child,))
+        count, size = cur.fetchone()
+        print "%-24s %10d rows %10s" % (child, count, size)
+    cur.close()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    commands = parser.add_subparsers(dest="command")
+    commands.add_parser("convert")
+    commands.add_parser("summarize")
+    commands.add_parser("list")
+    archiveParser = commands.add_parser("archive")
+    archiveParser.add_argument("--before", required=True,
+                               help="archive partitions older than YYYY-MM")
+    archiveParser.add_argument("--dir", default=".",
+                               help="where to write the dumps")
+    archiveParser.add_argument("--drop", action="store_true",
+                               help="drop partitions once dumped")
+    archiveParser.add_argument("--tablespace",
+                               help="move partitions to this tablespace")
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(database = "radiation", user = "radiation",
+                            password = "radiation", host = "localhost")
+    if args.command == "convert":
+        convert(conn)
+    elif args.command == "summarize":
+        summarize(conn)
+    elif args.command == "archive":
+        before = datetime.strptime(args.before, "%Y-%m")
+        archive(conn, before, args.dir, args.drop, args.tablespace)
+    else:
+        listPartitions(conn)
+    conn.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""Helpers for loading rows with Postgres COPY.
+
+COPY ... FROM STDIN in text format is by far the fastest way to get many rows
+into Postgres: one round trip, no per-row statement parsing. These helpers
+format Python and NumPy values as COPY text lines and send them.
+
+Values are escaped for COPY text format, except Literal instances, which are
+sent verbatim. arrayLiteral, byteaLiteral and pointLiteral return Literals.
+"""
+
+from cStringIO import StringIO
+import binascii
+
+class Literal(str):
+    """A value already formatted for COPY text format."""
+
+NULL = Literal("\\N")
+
+ESCAPES = [("\\", "\\\\"), ("\t", "\\t"), ("\n", "\\n"), ("\r", "\\r")]
+
+def escape(value):
+    """Format one value as a COPY text field."""
+    if value is None:
+        return NULL
+    if isinstance(value, Literal):
+        return value
+    if isinstance(value, bool):
+        return "t" if value else "f"
+    if isinstance(value, float):
+        return repr(value)
+    if hasattr(value, "isoformat"):
+        return value.isoformat()
+    text = value if isinstance(value, str) else str(value)
+    for char, replacement in ESCAPES:
+        text = text.replace(char, replacement)
+    return text
+
+def arrayLiteral(values):
+    """Format a sequence of integers as a Postgres integer[] field."""
+    if hasattr(values, "tolist"):
+        values = values.tolist()
+    return Literal("{" + ",".join(str(int(value)) for value in values) + "}")
+
+def byteaLiteral(data):
+    """Format a byte string as a bytea field (hex input format)."""
+    return Literal("\\\\x" + binascii.hexlify(data))
+
+def pointLiteral(longitude, latitude, srid=4326):
+    """Format a point as an EWKT geometry field."""
+    return Literal("SRID=%d;POINT(%r %r)" % (srid, float(longitude),
+                                             float(latitude)))
+
+def formatRow(values):
+    """Format a sequence of values as one COPY text line."""
+    return "\t".join(escape(value) for value in values) + "\n"
+
+def copyText(cur, table, columns, text):
+    """COPY already formatted lines into table."""
+    cur.copy_expert("COPY %s (%s) FROM STDIN" % (table, ", ".join(columns)),
+                    StringIO(text))
+
+def copyRows(cur, table, columns, rows):
+    """COPY a sequence of value tuples into table."""
+    copyText(cur, table, columns, "".join(formatRow(row) for row in rows))
@@ -0,0 +1,113 @@
+"""A chain of threaded stages connected by bounded queues.
+
+Each stage is a function taking one item and returning the item to pass on,
+or None to drop it. Stages run on their own threads, so a slow stage (a GPS
+lookup, the database, the console) only delays the items behind it and never
+the producer at the head of the chain. headlessMonitor uses this to keep the
+detector loop doing nothing but reading out and re-arming timed histograms:
+
+    pipeline = Pipeline([("enrich", enrich), ("derive", derive),
+                         ("persist", persist), ("notify", notify)])
+    pipeline.start()
+    pipeline.put(sample)
+
+An exception in a stage is printed and drops that item; the stage carries on
+with the next one.
+"""
+
+import threading, traceback, Queue
+from util.monotonic import monotonic
+from util import metrics
+
+stageTime = metrics.histogram("stage_seconds", "Time spent on one item",
+                              ("stage",))
+stageErrors = metrics.counter("stage_errors_total",
+                              "Items dropped by an error", ("stage",))
+
+class Stage(threading.Thread):
+    """One stage: take items from inbox, call function, pass the result to
+       outbox (if any)."""
+
+    def __init__(self, name, function, inbox, outbox=None):
+        threading.Thread.__init__(self, name=name)
+        self.daemon = True
+        self.function = function
+        self.inbox = inbox
+        self.outbox = outbox
+        self.processed = 0
+        self.dropped = 0
+        self.errors = 0
+        self.lastDuration = 0.0
+        self.maxDuration = 0.0
+
+    def run(self):
+        while True:
+            item = self.inbox.get()
+            if item is Pipeline.STOP:
+                if self.outbox is not None:
+                    self.outbox.put(item)
+                return
+            started = monotonic()
+            try:
+                item = self.function(item)
+            except Exception:
+                self.errors += 1
+                stageErrors.inc(stage=self.name)
+                print "Error in %s stage:" % self.name
+                traceback.print_exc()
+                item = None
+            self.lastDuration = monotonic() - started
+            stageTime.observe(self.lastDuration, stage=self.name)
+            self.maxDuration = max(self.maxDuration, self.lastDuration)
+            self.processed += 1
+            if item is None:
+                self.dropped += 1
+            elif self.outbox is not None:
+                self.outbox.put(item)
+
+    def stats(self):
+        return {"name": self.name, "processed": self.processed,
+                "dropped": self.dropped, "errors": self.errors,
+                "backlog": self.inbox.qsize(),
+                "lastDuration": self.lastDuration,
+                "maxDuration": self.maxDuration}
+
+class Pipeline(object):
+    """Stages given as (name, function) pairs, run in order. queueSize bounds
+       each queue between stages; put() rejects items when the first stage
+       is that far behind."""
+
+    STOP = object()
+
+    def __init__(self, stages, queueSize=64):
+        self.stages = []
+        inbox = Queue.Queue(queueSize)
+        self.inbox = inbox
+        for i, (name, function) in enumerate(stages):
+            outbox = Queue.Queue(queueSize) if i < len(stages) - 1 else None
+            self.stages.append(Stage(name, function, inbox, outbox))
+            inbox = outbox
+        self.rejected = 0
+
+    def start(self):
+        for stage in self.stages:
+            stage.start()
+
+    def put(self, item):
+        """Hand an item to the first stage without blocking. Returns False if
+           its queue is full and the item was dropped."""
+        try:
+            self.inbox.put_nowait(item)
+            return True
+        except Queue.Full:
+            self.rejected += 1
+            return False
+
+    def stop(self, timeout=5):
+        """Let queued items drain through every stage, then stop."""
+        self.inbox.put(self.STOP)
+        for stage in self.stages:
+            stage.join(timeout)
+
+    def stats(self):
+        return [stage.stats() for stage in self.stages]
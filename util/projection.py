@@ -0,0 +1,57 @@
+"""Projection of WGS 84 coordinates onto the Texas Central plane (SRID 3663).
+
+SRID 3663 is NAD83(NSRS2007) / Texas Central: a Lambert conformal conic
+projection on the GRS 80 ellipsoid with coordinates in meters. The difference
+between WGS 84 and NAD83(NSRS2007) is around a meter, which is well inside our
+GPS error, so positions are projected directly.
+
+The formulas are the ellipsoidal ones from Snyder, "Map Projections: A Working
+Manual", and work on NumPy arrays so that whole tracks project in one call.
+"""
+
+import numpy as np
+
+A = 6378137.0                   # GRS 80 semi-major axis, meters
+F = 1 / 298.257222101           # GRS 80 flattening
+E = np.sqrt(2 * F - F * F)      # eccentricity
+
+LAT_1 = np.radians(31 + 53 / 60.0)
+LAT_2 = np.radians(30 + 7 / 60.0)
+LAT_0 = np.radians(29 + 40 / 60.0)
+LON_0 = np.radians(-100 - 20 / 60.0)
+FALSE_EASTING = 700000.0
+FALSE_NORTHING = 3000000.0
+
+def _m(lat):
+    return np.cos(lat) / np.sqrt(1 - (E * np.sin(lat)) ** 2)
+
+def _t(lat):
+    sin = E * np.sin(lat)
+    return np.tan(np.pi / 4 - lat / 2) / ((1 - sin) / (1 + sin)) ** (E / 2)
+
+N = (np.log(_m(LAT_1)) - np.log(_m(LAT_2))) / \
+    (np.log(_t(LAT_1)) - np.log(_t(LAT_2)))
+SCALE = A * _m(LAT_1) / (N * _t(LAT_1) ** N)
+RHO_0 = SCALE * _t(LAT_0) ** N
+
+def texasCentral(longitude, latitude):
+    """Project degrees of longitude and latitude to SRID 3663 (x, y) meters.
+       Accepts scalars or arrays."""
+    lat = np.radians(np.asarray(latitude, dtype=float))
+    theta = N * (np.radians(np.asarray(longitude, dtype=float)) - LON_0)
+    rho = SCALE * _t(lat) ** N
+    return (FALSE_EASTING + rho * np.sin(theta),
+            FALSE_NORTHING + RHO_0 - rho * np.cos(theta))
+
+def texasCentralInverse(x, y):
+    """Convert SRID 3663 meters back to degrees of (longitude, latitude)."""
+    dx = np.asarray(x, dtype=float) - FALSE_EASTING
+    dy = RHO_0 - (np.asarray(y, dtype=float) - FALSE_NORTHING)
+    rho = np.sign(N) * np.hypot(dx, dy)
+    theta = np.arctan2(dx, dy)
+    t = (rho / SCALE) ** (1 / N)
+    lat = np.pi / 2 - 2 * np.arctan(t)
+    for _ in range(6):
+        sin = E * np.sin(lat)
+        lat = np.pi / 2 - 2 * np.arctan(t * ((1 - sin) / (1 + sin)) ** (E / 2))
+    return np.degrees(theta / N + LON_0), np.degrees(lat)
@@ -0,0 +1,360 @@
+"""Hardware-free replay backends for the detector and GPS.
+
+ReplayEMorpho and ReplayGPSD stand in for emorpho.eMorpho and util.gpsd.GPSD,
+so headlessMonitor can run, and be profiled, on any machine. They play back
+either
+
+- a session recorded in the database: the histograms, count rates,
+  temperatures and positions of the rows between two times, or
+- Poisson draws of a spectrum from samples/ at a chosen count rate, along a
+  track from an NMEA log or a GPX file.
+
+Both run off a ReplayClock, which can run faster than real time: at speed
+100 a 2 second sample takes 20 ms. headlessMonitor takes its time, monotonic
+clock and sleeps from the same clock during a replay, so the whole pipeline
+sees consistent, accelerated time. With a seed, the Poisson draws and
+injected faults are the same on every run. Faults are failed histogram
+reads (failRate) and dropped GPS fixes (dropRate), each with a given
+probability.
+
+The replay ends when the recorded session or the track runs out;
+readHistogram then raises ReplayFinished. See headlessMonitor --help for the
+command-line options.
+"""
+
+import calendar, time, threading
+import xml.etree.ElementTree as ElementTree
+from datetime import datetime
+import numpy as np
+from pytz import timezone
+from util import histCodec
+from util.gpsd import GPSD, FixBuffer, Location, parseTime
+from util.monotonic import monotonic
+from util.simTools import loadSpectrum
+
+class ReplayFinished(Exception):
+    """The replayed session has no more samples."""
+
+class ReplayClock(object):
+    """Time running speed times faster than real time, starting at the epoch
+       start (default: now)."""
+
+    def __init__(self, speed=1.0, start=None):
+        self.speed = float(speed)
+        self.origin = monotonic()
+        self.start = time.time() if start is None else float(start)
+
+    def monotonic(self):
+        return (monotonic() - self.origin) * self.speed
+
+    def time(self):
+        return self.start + self.monotonic()
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            time.sleep(seconds / self.speed)
+
+    def sleepUntil(self, epoch):
+        self.sleep(epoch - self.time())
+
+# Tracks are lists of (epoch, latitude, longitude, altitude, error) tuples
+
+def nmeaCoordinate(value, hemisphere, degreeDigits):
+    coordinate = int(value[:degreeDigits]) + float(value[degreeDigits:]) / 60.0
+    return -coordinate if hemisphere in ("S", "W") else coordinate
+
+def readNMEA(path):
+    """Read a track from the RMC and GGA sentences of an NMEA log."""
+    fixes = []
+    extras = {}
+    with open(path) as log:
+        for line in log:
+            fields = line.strip().split("*")[0].split(",")
+            kind = fields[0][3:]
+            if kind == "RMC" and len(fields) > 9 and fields[2] == "A":
+                epoch = calendar.timegm(time.strptime(fields[9] + fields[1][:6],
+                                                      "%d%m%y%H%M%S"))
+                epoch += float("0" + fields[1][6:])
+                fixes.append((fields[1], epoch,
+                              nmeaCoordinate(fields[3], fields[4], 2),
+                              nmeaCoordinate(fields[5], fields[6], 3)))
+            elif kind == "GGA" and len(fields) > 9 and fields[6] not in ("", "0"):
+                extras[fields[1]] = (float(fields[9] or "nan"),
+                                     float(fields[8] or "nan"))
+    nan = float("nan")
+    return [(epoch, lat, lon) + extras.get(stamp, (nan, nan))
+            for stamp, epoch, lat, lon in fixes]
+
+def readGPX(path):
+    """Read a track from the track points of a GPX file."""
+    track = []
+    for point in ElementTree.parse(path).getroot().iter():
+        if not point.tag.endswith("trkpt"):
+            continue
+        values = dict((child.tag.split("}")[-1], child.text) for child in point)
+        epoch = parseTime(values.get("time"))
+        if epoch is None:
+            continue
+        track.append((epoch, float(point.get("lat")), float(point.get("lon")),
+                      float(values.get("ele", "nan")),
+                      float(values.get("hdop", "nan"))))
+    return sorted(track)
+
+def readTrack(path):
+    return readGPX(path) if path.lower().endswith(".gpx") else readNMEA(path)
+
+def loadSession(conn, start, end, sensor=None):
+    """Load the rows recorded between two times as (samples, track), where
+       samples is a list of (epoch, temp, cps, histogram) tuples. Simulated
+       rows, which include earlier replays' output, are left out."""
+    cur = conn.cursor()
+    query = "SELECT extract(epoch FROM time), temp, cps, " + \
+            histCodec.selectColumns(histCodec.configuredStorage()) + \
+            ", ST_Y(location), ST_X(location), altitude, hdop " + \
+            "FROM histograms WHERE time >= %s AND time < %s " + \
+            "AND NOT simulated"
+    params = (start, end)
+    if sensor is not None:
+        query += " AND sensor = %s"
+        params += (sensor,)
+    cur.execute(query + " ORDER BY time", params)
+    samples = []
+    track = []
+    for row in cur:
+        epoch = float(row[0])
+        samples.append((epoch, row[1], row[2], histCodec.fromRow(row[3], row[4])))
+        if row[5] is not None:
+            track.append((epoch, row[5], row[6], row[7], row[8]))
+    cur.close()
+    return samples, track
+
+# Spectrum sources
+
+class RecordedSpectra(object):
+    """Recorded histograms, one per timed histogram, in order."""
+
+    def __init__(self, samples):
+        self.samples = iter(samples)
+
+    def next(self, duration, random):
+        try:
+            epoch, temp, cps, histogram = next(self.samples)
+        except StopIteration:
+            raise ReplayFinished()
+        return histogram, cps, temp
+
+class SyntheticSpectra(object):
+    """Poisson draws of a spectrum's shape at a count rate, until the clock
+       passes end."""
+
+    def __init__(self, spectrum, cps, clock, end=None, temperature=25.0):
+        if isinstance(spectrum, str):
+            spectrum = loadSpectrum(spectrum)
+        spectrum = np.asarray(spectrum, dtype=float)
+        self.shape = spectrum / spectrum.sum()
+        self.cps = cps
+        self.clock = clock
+        self.end = end
+        self.temperature = temperature
+
+    def next(self, duration, random):
+        if self.end is not None and self.clock.time() > self.end:
+            raise ReplayFinished()
+        histogram = random.poisson(self.shape * self.cps * duration)
+        return histogram, histogram.sum() / float(duration), self.temperature
+
+class ReplayEMorpho(object):
+    """Stands in for emorpho.eMorpho. Register settings are accepted and
+       ignored."""
+
+    def __init__(self, source, clock, seed=None, failRate=0.0, devices=1):
+        self.source = source
+        self.clock = clock
+        self.random = np.random.RandomState(seed)
+        self.failRate = failRate
+        self.devices = devices
+        self.serial = None
+        self.armed = None
+        self.duration = 0
+        self.cps = 0.0
+        self.temperature = 25.0
+        self.reads = 0
+        self.failures = 0
+
+    def scan(self):
+        return self.devices
+
+    def open(self, index):
+        if index >= self.devices:
+            return False
+        self.serial = "replay%d" % index
+        return True
+
+    def clearStats(self):
+        self.cps = 0.0
+
+    def startTimedHistogram(self, duration):
+        self.armed = self.clock.monotonic()
+        self.duration = duration
+
+    def readHistogram(self):
+        """Wait out the timed histogram, then return the next spectrum, or
+           False for an injected read failure."""
+        if self.armed is None:
+            return False
+        self.clock.sleep(self.armed + self.duration - self.clock.monotonic())
+        self.armed = None
+        self.reads += 1
+        if self.failRate and self.random.random_sample() < self.failRate:
+            self.failures += 1
+            return False
+        histogram, self.cps, temperature = self.source.next(self.duration,
+                                                            self.random)
+        if temperature is not None:
+            self.temperature = temperature
+        return [int(count) for count in histogram]
+
+    def readStats(self):
+        return {"cps": self.cps}
+
+    def getTemperature(self):
+        return self.temperature
+
+class ReplayGPSD(GPSD):
+    """Stands in for util.gpsd.GPSD, feeding a track's fixes into the fix
+       buffer as the replay clock reaches them."""
+
+    def __init__(self, track, clock, TZ, seed=None, dropRate=0.0,
+                 bufferSize=64, maxAge=2.0):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.track = track
+        self.clock = clock
+        self.tz = timezone(TZ)
+        self.random = np.random.RandomState(seed)
+        self.dropRate = dropRate
+        self.maxAge = maxAge
+        self.fixes = FixBuffer(bufferSize)
+        self.running = True
+        self.dropped = 0
+
+    def run(self):
+        for epoch, latitude, longitude, altitude, error in self.track:
+            self.clock.sleepUntil(epoch)
+            if not self.running:
+                return
+            if self.dropRate and self.random.random_sample() < self.dropRate:
+                self.dropped += 1
+                continue
+            self.fixes.append((epoch, self.clock.time(), latitude, longitude,
+                               altitude, error, 3))
+
+    def stop(self):
+        self.running = False
+
+    def retry(self):
+        pass
+
+    def getLocation(self):
+        """The latest fix, or no position if it is older than maxAge."""
+        fixes = self.fixes.snapshot()
+        now = self.clock.time()
+        if not fixes or now - fixes[-1][1] > self.maxAge:
+            nan = float("nan")
+            return Location(nan, nan, nan, -1, 0, datetime.fromtimestamp(now,
+                                                                         self.tz))
+        epoch, received, latitude, longitude, altitude, error, mode = fixes[-1]
+        return Location(latitude, longitude, altitude, error, mode,
+                        datetime.fromtimestamp(epoch, self.tz))
+
+class NullWiFi(object):
+    """Leaves the network alone during a replay."""
+
+    Up = False
+    running = False
+
+    def start(self):
+        self.running = True
+
+    def stop(self):
+        self.running = False
+
+def addArguments(parser):
+    """Add the replay options to an argparse parser."""
+    group = parser.add_argument_group("replay",
+                                      "Run without hardware, replaying data.")
+    group.add_argument("--replay-db", nargs=2, metavar=("START", "END"),
+                       help="replay the rows recorded between two times")
+    group.add_argument("--replay-sensor", type=int,
+                       help="only replay rows from this sensor")
+    group.add_argument("--spectrum", metavar="NAME",
+                       help="replay Poisson draws of samples/NAME.csv")
+    group.add_argument("--cps", type=float, default=150.0,
+                       help="count rate for --spectrum (default 150)")
+    group.add_argument("--track", metavar="FILE",
+                       help="NMEA log or GPX file to drive --spectrum along")
+    group.add_argument("--speed", type=float, default=1.0,
+                       help="replay this many times faster than real time")
+    group.add_argument("--seed", type=int, help="seed for draws and faults")
+    group.add_argument("--fail-reads", type=float, default=0.0,
+                       metavar="P", help="fail histogram reads with chance P")
+    group.add_argument("--drop-fixes", type=float, default=0.0,
+                       metavar="P", help="drop GPS fixes with chance P")
+    group.add_argument("--detectors", type=int, default=1, metavar="N",
+                       help="replay N detectors at once (default 1)")
+
+class Replay(object):
+    """The clock and devices for a replay chosen on the command line."""
+
+    def __init__(self, source, track, clock, seed=None, failRate=0.0,
+                 dropRate=0.0, detectors=1):
+        self.source = source
+        self.track = track
+        self.clock = clock
+        self.seed = seed
+        self.failRate = failRate
+        self.dropRate = dropRate
+        self.detectors = detectors
+        self.handles = 0
+
+    @classmethod
+    def fromArgs(cls, args, connect=None):
+        """Build a Replay from parsed arguments, or return None if none was
+           asked for. connect() returns a database connection."""
+        if args.replay_db:
+            conn = connect()
+            samples, track = loadSession(conn, args.replay_db[0],
+                                         args.replay_db[1], args.replay_sensor)
+            conn.close()
+            if not samples:
+                raise ValueError("No rows recorded between %s and %s" %
+                                 tuple(args.replay_db))
+            clock = ReplayClock(args.speed, samples[0][0])
+            source = RecordedSpectra(samples)
+        elif args.spectrum:
+            if not args.track:
+                raise ValueError("--spectrum needs a --track")
+            track = readTrack(args.track)
+            if not track:
+                raise ValueError("No fixes in %s" % args.track)
+            clock = ReplayClock(args.speed, track[0][0])
+            source = SyntheticSpectra(args.spectrum, args.cps, clock,
+                                      track[-1][0])
+        else:
+            return None
+        return cls(source, track, clock, args.seed, args.fail_reads,
+                   args.drop_fixes, args.detectors)
+
+    def emorpho(self):
+        """A new detector handle; each draws from the same spectrum source
+           with its own random state."""
+        seed = self.seed
+        if seed is not None and self.handles:
+            seed += 1 + self.handles
+        self.handles += 1
+        return ReplayEMorpho(self.source, self.clock, seed, self.failRate,
+                             self.detectors)
+
+    def gpsd(self, TZ):
+        seed = None if self.seed is None else self.seed + 1
+        return ReplayGPSD(self.track, self.clock, TZ, seed, self.dropRate)
@@ -0,0 +1,246 @@
+"""Incrementally maintained spatial grid rollups in SRID 3663.
+
+Map and analysis queries rarely need individual spectra: a count-rate map
+only needs, for each grid cell, how many samples fell in it, their summed
+live time and cps, the summed spectrum and the time span. This module keeps
+those aggregates in the grid_cells table (see sql/rollup.sql) for one or more
+grids, square or hexagonal, laid out in the Texas Central plane.
+
+Each grid remembers in grid_state the highest histograms id it has absorbed.
+update() reads only newer rows, a chunk at a time, bins them with NumPy and
+merges the per-cell sums into grid_cells in the same transaction that
+advances the mark, so it can be run as often as liked (from cron, or with
+--follow) and never counts a row twice.
+
+Grids come from the "rollup" section of radmonitor.config. Run from the util
+directory:
+
+    python rollup.py [--follow 60] [--rebuild]
+"""
+
+import argparse, json, os, time
+import numpy as np
+import psycopg2
+import histCodec, pgcopy
+
+CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..",
+                      "radmonitor.config")
+
+SQRT3 = np.sqrt(3.0)
+
+class Grid(object):
+    """A square or pointy-top hexagonal grid in SRID 3663 meters. size is the
+       side of a square cell, or the center-to-corner radius of a hexagon."""
+
+    def __init__(self, shape="square", size=50.0):
+        if shape not in ("square", "hex"):
+            raise ValueError("Grid shape must be square or hex, not %r" % shape)
+        self.shape = shape
+        self.size = float(size)
+        self.name = "%s-%g" % (shape, size)
+
+    def cells(self, x, y):
+        """Return integer (cx, cy) cell indexes for arrays of coordinates;
+           for hexagons these are axial (q, r) coordinates."""
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        if self.shape == "square":
+            return (np.floor(x / self.size).astype(int),
+                    np.floor(y / self.size).astype(int))
+        q = (SQRT3 / 3 * x - y / 3) / self.size
+        r = (2.0 / 3 * y) / self.size
+        # Round cube coordinates (q, r, -q-r) to the nearest hexagon
+        s = -q - r
+        rq, rr, rs = np.round(q), np.round(r), np.round(s)
+        dq, dr, ds = np.abs(rq - q), np.abs(rr - r), np.abs(rs - s)
+        fixQ = (dq > dr) & (dq > ds)
+        fixR = ~fixQ & (dr > ds)
+        rq = np.where(fixQ, -rr - rs, rq)
+        rr = np.where(fixR, -rq - rs, rr)
+        return rq.astype(int), rr.astype(int)
+
+    def centers(self, cx, cy):
+        """Return the SRID 3663 coordinates of cell centers."""
+        cx = np.asarray(cx, dtype=float)
+        cy = np.asarray(cy, dtype=float)
+        if self.shape == "square":
+            return (cx + 0.5) * self.size, (cy + 0.5) * self.size
+        return (self.size * SQRT3 * (cx + cy / 2), self.size * 1.5 * cy)
+
+def configuredGrids(path=CONFIG):
+    """Return the Grids listed in the "rollup" section of radmonitor.config,
+       and whether simulated rows are included."""
+    with open(path) as config:
+        rollup = json.load(config).get("rollup", {})
+    grids = [Grid(**grid) for grid in rollup.get("grids", [{}])]
+    return grids, rollup.get("includeSimulated", False)
+
+def aggregate(grid, x, y, sampletime, cps, times, hists):
+    """Sum a block of rows per cell. Returns a dict of per-cell arrays."""
+    cx, cy = grid.cells(x, y)
+    keys = np.column_stack((cx, cy))
+    order = np.lexsort((cy, cx))
+    keys = keys[order]
+    starts = np.concatenate(([0], np.nonzero(np.any(np.diff(keys, axis=0),
+                                                    axis=1))[0] + 1))
+    return {"cx": keys[starts, 0],
+            "cy": keys[starts, 1],
+            "samples": np.diff(np.append(starts, len(keys))),
+            "livetime": np.add.reduceat(sampletime[order], starts),
+            "sumcps": np.add.reduceat(cps[order], starts),
+            "spectrum": np.add.reduceat(hists[order], starts, axis=0),
+            "tmin": [min(times[i] for i in group)
+                     for group in np.split(order, starts[1:])],
+            "tmax": [max(times[i] for i in group)
+                     for group in np.split(order, starts[1:])]}
+
+def merge(cur, grid, cells):
+    """Add per-cell sums to grid_cells, combining with existing cells."""
+    keys = ",".join(cur.mogrify("(%s, %s)", (int(cx), int(cy)))
+                    for cx, cy in zip(cells["cx"], cells["cy"]))
+    cur.execute("SELECT cx, cy, samples, livetime, sumcps, spectrum, tmin, " +
+                "tmax FROM grid_cells WHERE grid = %s AND (cx, cy) IN (" +
+                keys + ")", (grid.name,))
+    existing = dict(((row[0], row[1]), row[2:]) for row in cur.fetchall())
+
+    rows = []
+    for i in range(len(cells["cx"])):
+        key = (int(cells["cx"][i]), int(cells["cy"][i]))
+        samples = int(cells["samples"][i])
+        livetime = float(cells["livetime"][i])
+        sumcps = float(cells["sumcps"][i])
+        spectrum = cells["spectrum"][i]
+        tmin, tmax = cells["tmin"][i], cells["tmax"][i]
+        if key in existing:
+            oldSamples, oldLive, oldCps, oldSpectrum, oldMin, oldMax = \
+                existing[key]
+            samples += oldSamples
+            livetime += oldLive
+            sumcps += oldCps
+            spectrum = spectrum + np.asarray(oldSpectrum, dtype=np.int64)
+            tmin, tmax = min(tmin, oldMin), max(tmax, oldMax)
+        rows.append((grid.name, key[0], key[1], samples, livetime, sumcps,
+                     pgcopy.arrayLiteral(spectrum), tmin, tmax))
+
+    cur.execute("DELETE FROM grid_cells WHERE grid = %s AND (cx, cy) IN (" +
+                keys + ")", (grid.name,))
+    pgcopy.copyRows(cur, "grid_cells", ("grid", "cx", "cy", "samples",
+                                        "livetime", "sumcps", "spectrum",
+                                        "tmin", "tmax"), rows)
+
+def update(conn, grid, includeSimulated=False, chunk=5000):
+    """Absorb all histograms rows newer than the grid's high-water mark.
+       Returns the number of rows absorbed."""
+    cur = conn.cursor()
+    cur.execute("SELECT last_id FROM grid_state WHERE grid = %s", (grid.name,))
+    state = cur.fetchone()
+    if state is None:
+        cur.execute("INSERT INTO grid_state VALUES (%s, %s, %s, 0)",
+                    (grid.name, grid.shape, grid.size))
+        lastId = 0
+    else:
+        lastId = state[0]
+    conn.commit()
+
+    simulated = "" if includeSimulated else "AND NOT simulated "
+    histogram = histCodec.selectColumns(histCodec.configuredStorage())
+    total = 0
+    while True:
+        cur.execute("SELECT id, ST_X(p), ST_Y(p), sampletime, cps, time, " +
+                    "histogram, histpack FROM (SELECT id, sampletime, cps, " +
+                    "time, " + histogram + ", " +
+                    "ST_Transform(location, 3663) AS p FROM histograms " +
+                    "WHERE id > %s AND location IS NOT NULL " + simulated +
+                    "ORDER BY id LIMIT %s) AS chunk", (lastId, chunk))
+        rows = cur.fetchall()
+        if not rows:
+            break
+        lastId = rows[-1][0]
+        rows = [row for row in rows if row[5] is not None and
+                (row[6] is not None or row[7] is not None)]
+        if rows:
+            hists = np.vstack([histCodec.fromRow(row[6], row[7])
+                               for row in rows])
+            cells = aggregate(grid,
+                              np.array([row[1] for row in rows]),
+                              np.array([row[2] for row in rows]),
+                              np.array([row[3] or 0.0 for row in rows]),
+                              np.array([row[4] or 0.0 for row in rows]),
+                              [row[5] for row in rows], hists)
+            merge(cur, grid, cells)
+        cur.execute("UPDATE grid_state SET last_id = %s WHERE grid = %s",
+                    (lastId, grid.name))
+        conn.commit()
+        total += len(rows)
+    cur.close()
+    return total
+
+def rebuild(conn, grid):
+    """Forget a grid's cells so the next update() starts from scratch."""
+    cur = conn.cursor()
+    cur.execute("DELETE FROM grid_cells WHERE grid = %s", (grid.name,))
+    cur.execute("DELETE FROM grid_state WHERE grid = %s", (grid.name,))
+    conn.commit()
+    cur.close()
+
+def cellRates(cur, grid, bbox=None, since=None):
+    """Return per-cell arrays for mapping: x, y (cell centers, SRID 3663),
+       samples, livetime and mean cps. bbox is (xmin, ymin, xmax, ymax) in
+       SRID 3663; since limits the result to cells touched after a time."""
+    where = ""
+    params = [grid.name]
+    if since is not None:
+        where += " AND tmax >= %s"
+        params.append(since)
+    cur.execute("SELECT cx, cy, samples, livetime, sumcps FROM grid_cells " +
+                "WHERE grid = %s" + where, params)
+    rows = np.array(cur.fetchall(), dtype=float).reshape(-1, 5)
+    x, y = grid.centers(rows[:, 0], rows[:, 1])
+    keep = np.ones(len(rows), dtype=bool)
+    if bbox is not None:
+        keep = (x >= bbox[0]) & (y >= bbox[1]) & (x <= bbox[2]) & \
+               (y <= bbox[3])
+    samples = rows[keep, 2]
+    return {"x": x[keep], "y": y[keep], "samples": samples,
+            "livetime": rows[keep, 3],
+            "cps": rows[keep, 4] / np.maximum(samples, 1)}
+
+def cellSpectrum(cur, grid, x, y):
+    """Return the summed spectrum and live time of the cell containing the
+       SRID 3663 point (x, y), or (None, 0) if nothing was recorded there."""
+    cx, cy = grid.cells([x], [y])
+    cur.execute("SELECT spectrum, livetime FROM grid_cells WHERE grid = %s " +
+                "AND cx = %s AND cy = %s", (grid.name, int(cx[0]), int(cy[0])))
+    row = cur.fetchone()
+    if row is None:
+        return None, 0.0
+    return np.asarray(row[0], dtype=np.int64), row[1]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--follow", type=float, default=0,
+                        help="keep updating every this many seconds")
+    parser.add_argument("--rebuild", action="store_true",
+                        help="discard existing rollups and start over")
+    parser.add_argument("--chunk", type=int, default=5000,
+                        help="histograms rows read per transaction")
+    args = parser.parse_args()
+
+    grids, includeSimulated = configuredGrids()
+    conn = psycopg2.connect(database = "radiation", user = "radiation",
+                            password = "radiation", host = "localhost")
+    if args.rebuild:
+        for grid in grids:
+            rebuild(conn, grid)
+    while True:
+        for grid in grids:
+            count = update(conn, grid, includeSimulated, args.chunk)
+            if count:
+                print "%s: absorbed %d rows" % (grid.name, count)
+        if not args.follow:
+            break
+        time.sleep(args.follow)
+    conn.close()
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,22 @@
-"""Tools for simulating radioactive sources."""
+"""Tools for simulating radioactive sources.
 
+Everything here works on NumPy arrays: sizeToCPS broadcasts over arrays of
+source sizes and distances, sampleSpectra draws any number of Poisson
+resamples in one call, and simulateDrive combines the two into synthetic
+drives past point sources, generated a batch at a time so that thousands of
+passes can be produced without holding them all in memory.
+"""
+
+import os
 import numpy as np
-import math
+
+SAMPLES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..",
+                       "samples")
 
 def sizeToCPS(mCi, dist):
     """Convert a source size in miliCuries to an approximate number of counts
        at dist (meters), using calibrations with Cs-137 sources of known sizes.
+       Either argument may be an array; the result broadcasts like NumPy.
     """
 
     knownSize = 0.000844 # mCi
@@ -13,10 +24,11 @@ def sizeToCPS(mCi, dist):
     knownCounts = 630 # cps
     mu = 0.0100029 # attenuation coefficient, in units of m^{-1}, for 660 keV in air
 
-    return (mCi / knownSize) * knownCounts * math.pow(knownDist / dist, 2) * \
-            math.exp(-mu * (knownDist + dist))
+    dist = np.asarray(dist, dtype=float)
+    return (np.asarray(mCi, dtype=float) / knownSize) * knownCounts * \
+            np.square(knownDist / dist) * np.exp(-mu * (knownDist + dist))
 
-def sampleSpectrum(hist):
+def sampleSpectrum(hist, random=np.random):
     """Produce a sample histogram based on the given histogram,
        with added Poisson variability."""
 
@@ -24,4 +36,72 @@ def sampleSpectrum(hist):
     # distributions with mean zero. This adds a bit of noise, with bins with 0
     # counts in the source spectrum occasionally getting one or two counts in
     # the simulation.
-    return np.array(map(np.random.poisson, np.clip(hist, 0.0001, float("+inf"))))
+    return random.poisson(np.clip(hist, 0.0001, float("+inf")))
+
+def sampleSpectra(hist, count, random=np.random):
+    """Draw count Poisson resamples of hist at once, as a (count x bins)
+       array. hist may also be a (count x bins) array of expected counts."""
+    hist = np.clip(np.asarray(hist, dtype=float), 0.0001, float("+inf"))
+    return random.poisson(hist, size=(count, hist.shape[-1]))
+
+def loadSpectrum(name):
+    """Load a spectrum from the samples directory, e.g. "arl-background"."""
+    return np.loadtxt(os.path.join(SAMPLES, name + ".csv"), delimiter=",")
+
+def routePositions(path, spacing):
+    """Return points every spacing meters along a polyline given as an
+       (M x 2) array of planar coordinates in meters."""
+    path = np.asarray(path, dtype=float)
+    legs = np.sqrt(np.sum(np.square(np.diff(path, axis=0)), axis=1))
+    along = np.concatenate(([0.0], np.cumsum(legs)))
+    stations = np.arange(0.0, along[-1] + spacing / 2.0, spacing)
+    return np.column_stack((np.interp(stations, along, path[:, 0]),
+                            np.interp(stations, along, path[:, 1])))
+
+def simulateDrive(path, sources, background, backgroundCPS=150.0,
+                  sourceSpectrum="cs137", speed=10.0, sampleTime=2.0,
+                  standoff=1.0, passes=1, batchSize=500, seed=None):
+    """Generate synthetic drives along path past point sources.
+
+       path is an (M x 2) array of planar route vertices in meters (SRID 3663
+       coordinates, say) and sources a sequence of (x, y, mCi) tuples.
+       background and sourceSpectrum are spectra, or names of files in
+       samples/; only their shapes are used. backgroundCPS sets the
+       background count rate, speed is in m/s, and standoff is the height of
+       the detector above the source plane in meters.
+
+       Yields dicts of arrays for at most batchSize samples at a time:
+       "pass", "x", "y", "offset" (seconds from the start of the pass),
+       "sourceCPS" (expected counts from the sources) and "histograms"
+       (Poisson-sampled spectra). seed makes the output reproducible.
+    """
+    random = np.random.RandomState(seed)
+    if isinstance(background, str):
+        background = loadSpectrum(background)
+    if isinstance(sourceSpectrum, str):
+        sourceSpectrum = loadSpectrum(sourceSpectrum)
+    backgroundShape = np.asarray(background, dtype=float)
+    backgroundShape = backgroundShape / backgroundShape.sum()
+    sourceShape = np.asarray(sourceSpectrum, dtype=float)
+    sourceShape = sourceShape / sourceShape.sum()
+    expectedBackground = backgroundShape * backgroundCPS * sampleTime
+
+    positions = routePositions(path, speed * sampleTime)
+    sources = np.asarray(sources, dtype=float).reshape(-1, 3)
+
+    for run in range(passes):
+        for start in range(0, len(positions), batchSize):
+            batch = positions[start:start + batchSize]
+            offsets = sampleTime * np.arange(start, start + len(batch))
+            dx = batch[:, 0, np.newaxis] - sources[np.newaxis, :, 0]
+            dy = batch[:, 1, np.newaxis] - sources[np.newaxis, :, 1]
+            dist = np.sqrt(dx * dx + dy * dy + standoff * standoff)
+            cps = sizeToCPS(sources[np.newaxis, :, 2], dist).sum(axis=1)
+            expected = expectedBackground[np.newaxis, :] + \
+                       (cps * sampleTime)[:, np.newaxis] * sourceShape
+            yield {"pass": np.repeat(run, len(batch)),
+                   "x": batch[:, 0],
+                   "y": batch[:, 1],
+                   "offset": offsets,
+                   "sourceCPS": cps,
+                   "histograms": sampleSpectra(expected, len(batch), random)}
@@ -0,0 +1,307 @@
+"""Memory-mapped columnar cache of histograms rows for analysis.
+
+A store is a directory holding one flat binary file per column:
+
+    spectra.dat   (rows x bins) uint16 or int32 counts, row-major
+    id.dat        int64 histograms.id
+    time.dat      float64 epoch seconds
+    x.dat, y.dat  float64 SRID 3663 coordinates (NaN without a location)
+    cps.dat, temp.dat, sampletime.dat   float32
+    sensor.dat, compression.dat         int16
+    byTime.dat, byX.dat                 int64 row numbers sorted by time / x
+    meta.json     row count, last id, bins, dtype and row filter
+
+All of them open as NumPy memmaps, so summing or slicing millions of spectra
+reads straight from the page cache without copying them into Python objects:
+
+    store = SpectrumStore("cache")
+    rows = store.select(start=t0, end=t1, bbox=(xmin, ymin, xmax, ymax))
+    total = store.sum(rows)
+    first = store.spectra[rows[:100]]
+
+update() appends rows with ids above the last one cached, a chunk at a time,
+and rebuilds the two sort indexes. meta.json is written last, so the row
+count in it is always the number of complete rows; anything past it in the
+column files (from an interrupted update) is cut off when the store is next
+opened for writing. The indexes are only rebuilt at the end, so after an
+interruption they cover fewer rows than meta.json: select() then sorts in
+memory instead, and the next update rebuilds them first. A uint16 store is widened to int32 the first time a
+count does not fit.
+
+Run from the util directory:
+
+    python spectrumStore.py update cache [--where "NOT simulated"]
+                                         [--dtype uint16]
+    python spectrumStore.py info cache
+"""
+
+import argparse, json, os
+import numpy as np
+import psycopg2
+import histCodec
+
+COLUMNS = (("id", np.int64), ("time", np.float64), ("x", np.float64),
+           ("y", np.float64), ("cps", np.float32), ("temp", np.float32),
+           ("sampletime", np.float32), ("sensor", np.int16),
+           ("compression", np.int16))
+
+NAN = float("nan")
+
+class SpectrumStore(object):
+    """A columnar spectrum cache in directory path; see the module docstring.
+       The directory and meta.json are created on first use."""
+
+    def __init__(self, path, bins=4096, dtype="uint16", where=None):
+        self.path = path
+        metaPath = os.path.join(path, "meta.json")
+        if os.path.exists(metaPath):
+            with open(metaPath) as meta:
+                self.meta = json.load(meta)
+        else:
+            if np.dtype(dtype) not in (np.uint16, np.int32):
+                raise ValueError("Spectra must be stored as uint16 or int32")
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            self.meta = {"count": 0, "lastId": 0, "bins": bins,
+                         "dtype": np.dtype(dtype).name, "where": where}
+        self._maps = {}
+
+    @property
+    def count(self):
+        return self.meta["count"]
+
+    @property
+    def bins(self):
+        return self.meta["bins"]
+
+    def file(self, name):
+        return os.path.join(self.path, name + ".dat")
+
+    def _map(self, name, dtype, shape):
+        key = (name, shape)
+        if key not in self._maps:
+            if not shape[0]:
+                return np.zeros(shape, dtype=dtype)
+            self._maps = dict((k, v) for k, v in self._maps.items()
+                              if k[0] != name)
+            self._maps[key] = np.memmap(self.file(name), dtype=dtype,
+                                        mode="r", shape=shape)
+        return self._maps[key]
+
+    @property
+    def spectra(self):
+        """The (rows x bins) counts as a read-only memmap."""
+        return self._map("spectra", self.meta["dtype"],
+                         (self.count, self.bins))
+
+    def column(self, name):
+        """A side column as a read-only memmap."""
+        dtype = dict(COLUMNS + (("byTime", np.int64), ("byX", np.int64)))[name]
+        return self._map(name, dtype, (self.count,))
+
+    def _indexCurrent(self, name):
+        path = self.file(name)
+        return os.path.exists(path) and \
+               os.path.getsize(path) == self.count * 8
+
+    def index(self, name, key):
+        """Row numbers sorted by column key: the index file name, or, if it
+           doesn't cover the committed rows, the order sorted in memory."""
+        if self._indexCurrent(name):
+            return self.column(name)
+        mapKey = (name, (self.count,))
+        if mapKey not in self._maps:
+            self._maps[mapKey] = np.argsort(self.column(key), kind="mergesort")
+        return self._maps[mapKey]
+
+    # Selection
+
+    def select(self, start=None, end=None, bbox=None, sensor=None):
+        """Return the sorted row numbers with start <= time < end (epoch
+           seconds), inside bbox = (xmin, ymin, xmax, ymax) in SRID 3663
+           meters and from sensor. Time and x ranges are found by binary
+           search in the sorted indexes."""
+        rows = None
+        if start is not None or end is not None:
+            order = self.index("byTime", "time")
+            times = self.column("time")[order]
+            low = 0 if start is None else np.searchsorted(times, start, "left")
+            high = len(order) if end is None else \
+                   np.searchsorted(times, end, "left")
+            rows = np.sort(order[low:high])
+        if bbox is not None:
+            order = self.index("byX", "x")
+            xs = self.column("x")[order]
+            low = np.searchsorted(xs, bbox[0], "left")
+            high = np.searchsorted(xs, bbox[2], "right")
+            inX = np.sort(order[low:high])
+            ys = self.column("y")[inX]
+            inBox = inX[(ys >= bbox[1]) & (ys <= bbox[3])]
+            rows = inBox if rows is None else np.intersect1d(rows, inBox, True)
+        if rows is None:
+            rows = np.arange(self.count)
+        if sensor is not None:
+            rows = rows[self.column("sensor")[rows] == sensor]
+        return rows
+
+    def sum(self, rows=None, chunk=65536):
+        """Sum the spectra of the given rows (default: all) in chunks, as an
+           int64 array of bins."""
+        spectra = self.spectra
+        total = np.zeros(self.bins, dtype=np.int64)
+        if rows is None:
+            for first in range(0, self.count, chunk):
+                total += spectra[first:first + chunk].sum(axis=0,
+                                                          dtype=np.int64)
+        else:
+            rows = np.asarray(rows)
+            for first in range(0, len(rows), chunk):
+                total += spectra[rows[first:first + chunk]].sum(axis=0,
+                                                                dtype=np.int64)
+        return total
+
+    # Writing
+
+    def _truncate(self):
+        """Cut every file back to the committed row count, and rebuild the
+           indexes if an interrupted update left them behind."""
+        sizes = [("spectra", np.dtype(self.meta["dtype"]).itemsize * self.bins)]
+        sizes += [(name, np.dtype(dtype).itemsize) for name, dtype in COLUMNS]
+        for name, size in sizes:
+            path = self.file(name)
+            if not os.path.exists(path):
+                open(path, "wb").close()
+            if os.path.getsize(path) != self.count * size:
+                with open(path, "r+b") as data:
+                    data.truncate(self.count * size)
+        if not (self._indexCurrent("byTime") and self._indexCurrent("byX")):
+            self.reindex()
+
+    def _widen(self):
+        """Rewrite a uint16 store's spectra as int32."""
+        print "Widening %s to int32" % self.path
+        old = self.spectra
+        with open(self.file("spectra") + ".tmp", "wb") as out:
+            for first in range(0, self.count, 65536):
+                out.write(old[first:first + 65536].astype(np.int32).tobytes())
+        self._maps = {}
+        os.rename(self.file("spectra") + ".tmp", self.file("spectra"))
+        self.meta["dtype"] = "int32"
+        self._writeMeta()
+
+    def _writeMeta(self):
+        metaPath = os.path.join(self.path, "meta.json")
+        with open(metaPath + ".tmp", "w") as meta:
+            json.dump(self.meta, meta, indent=1)
+        os.rename(metaPath + ".tmp", metaPath)
+
+    def append(self, columns, spectra):
+        """Append rows: columns maps each name in COLUMNS to an array and
+           spectra is (rows x bins)."""
+        spectra = np.asarray(spectra)
+        if self.meta["dtype"] == "uint16" and len(spectra) and \
+           (spectra.max() > 65535 or spectra.min() < 0):
+            self._widen()
+        files = [("spectra", spectra.astype(self.meta["dtype"]))]
+        files += [(name, np.asarray(columns[name], dtype=dtype))
+                  for name, dtype in COLUMNS]
+        for name, values in files:
+            with open(self.file(name), "ab") as data:
+                data.write(values.tobytes())
+        self.meta["count"] += len(spectra)
+        self.meta["lastId"] = int(columns["id"][-1])
+        self._writeMeta()
+
+    def reindex(self):
+        """Rebuild the time and x sort indexes."""
+        self._maps = {}
+        for name, key in (("byTime", "time"), ("byX", "x")):
+            order = np.argsort(self.column(key), kind="mergesort")
+            with open(self.file(name) + ".tmp", "wb") as data:
+                data.write(order.astype(np.int64).tobytes())
+            os.rename(self.file(name) + ".tmp", self.file(name))
+        self._maps = {}
+
+    def update(self, conn, chunk=2000):
+        """Append every histograms row with an id above the last one cached
+           and matching the store's row filter. Returns the rows added."""
+        self._truncate()
+        where = " AND (%s)" % self.meta["where"] if self.meta["where"] else ""
+        storage = histCodec.configuredStorage()
+        histogram = histCodec.selectColumns(storage,
+                                            "array_to_string(histogram, ',')")
+        cur = conn.cursor()
+        added = 0
+        while True:
+            cur.execute("SELECT id, extract(epoch FROM time), ST_X(p), " +
+                        "ST_Y(p), cps, temp, sampletime, sensor, compression, " +
+                        histogram + " FROM (SELECT *, " +
+                        "ST_Transform(location, 3663) AS p FROM histograms " +
+                        "WHERE id > %s AND " +
+                        histCodec.storedCondition(storage) + where +
+                        " ORDER BY id LIMIT %s) AS chunk",
+                        (self.meta["lastId"], chunk))
+            rows = cur.fetchall()
+            if not rows:
+                break
+            spectra = np.zeros((len(rows), self.bins), dtype=np.int64)
+            for i, row in enumerate(rows):
+                if row[10] is not None:
+                    hist = histCodec.decode(row[10])
+                else:
+                    hist = np.fromstring(row[9], dtype=np.int64, sep=",")
+                spectra[i, :min(len(hist), self.bins)] = hist[:self.bins]
+            columns = dict((name, [NAN if row[i] is None else row[i]
+                                   for row in rows])
+                           for i, name in enumerate(("id", "time", "x", "y",
+                                                     "cps", "temp",
+                                                     "sampletime")))
+            columns["sensor"] = [row[7] or 0 for row in rows]
+            columns["compression"] = [row[8] or 0 for row in rows]
+            self.append(columns, spectra)
+            added += len(rows)
+            print "Cached %d rows, up to id %d" % (self.count,
+                                                   self.meta["lastId"])
+        cur.close()
+        self.reindex()
+        return added
+
+    def info(self):
+        size = sum(os.path.getsize(os.path.join(self.path, name))
+                   for name in os.listdir(self.path))
+        print "%s: %d spectra of %d bins as %s, last id %d, %.1f MB" % \
+              (self.path, self.count, self.bins, self.meta["dtype"],
+               self.meta["lastId"], size / 1e6)
+        if self.count:
+            times = self.column("time")
+            print "time %s to %s" % (np.nanmin(times), np.nanmax(times))
+        if self.meta["where"]:
+            print "rows where %s" % self.meta["where"]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    commands = parser.add_subparsers(dest="command")
+    updateParser = commands.add_parser("update")
+    updateParser.add_argument("path", help="store directory")
+    updateParser.add_argument("--where",
+                              help="SQL filter on histograms, fixed when the " +
+                                   "store is created")
+    updateParser.add_argument("--dtype", default="uint16",
+                              choices=("uint16", "int32"))
+    updateParser.add_argument("--chunk", type=int, default=2000)
+    infoParser = commands.add_parser("info")
+    infoParser.add_argument("path", help="store directory")
+    args = parser.parse_args()
+
+    if args.command == "info":
+        SpectrumStore(args.path).info()
+        return
+    store = SpectrumStore(args.path, dtype=args.dtype, where=args.where)
+    conn = psycopg2.connect(database = "radiation", user = "radiation",
+                            password = "radiation", host = "localhost")
+    print "Added %d rows" % store.update(conn, args.chunk)
+    conn.close()
+    store.info()
+
+if __name__ == "__main__":
+    main()
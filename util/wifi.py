@@ -1,41 +1,72 @@
-import subprocess, threading, os, time
+import subprocess
+from scheduler import sharedScheduler
+from util.leds import controller as leds
+from util import metrics
 
-class WiFi(threading.Thread):
+checkTime = metrics.histogram("wifi_check_seconds",
+                              "Time to check the WiFi association")
+reconnects = metrics.counter("wifi_reconnects_total",
+                             "Times wlan0 was taken down and up again")
 
-  def __init__(self):
-    threading.Thread.__init__(self)
+class WiFi(object):
+  """Keeps wlan0 associated with the base station while running. The check
+     is a job on the shared scheduler; reconnecting runs ifdown/ifup in the
+     background and is picked up on a later check, so the scheduler thread
+     never waits on it. stop() takes the interface down the same way."""
+
+  def __init__(self, interval=5):
     self.Up = False
-    os.system("echo heartbeat > /sys/class/leds/beaglebone\:green\:usr3/trigger")
-    self.running = True
+    leds().set("wifi", "heartbeat")
+    self.running = False
+    self.interval = interval
     self.timeoutDefault = 1
     self.timeout = self.timeoutDefault
+    self.job = None
+    self.reconnect = None
+
+  def start(self):
+    if self.running:
+      return
+    self.running = True
+    self.timeout = self.timeoutDefault
+    self.job = sharedScheduler().afterEach(self.interval, self.check,
+                                           jobName="wifi")
 
-  def run(self):
-    while self.running:
-      try:
+  def check(self):
+    if self.reconnect is not None:
+      if self.reconnect.poll() is None:
+        return
+      self.reconnect = None
+    try:
+      with checkTime.time():
         subprocess.check_call(["iwconfig 2>&1 | grep ESSID | grep -q 'AtheyRadMap'"], shell = True)
-      except subprocess.CalledProcessError:
-        if self.Up != False:
-          self.Up = False
-          os.system("echo heartbeat > /sys/class/leds/beaglebone\:green\:usr3/trigger")
-        os.system("ifdown wlan0")
-        os.system("ifup wlan0")
-        self.timeout = self.timeout - 1
-        if self.timeout < 0:
-          self.timeout = self.timeoutDefault
-          self.stop()
-          time.sleep(3)
-      else:
-        if self.Up != True:
-          self.Up = True
-          os.system("echo default-on > /sys/class/leds/beaglebone\:green\:usr3/trigger")
-        time.sleep(5)
+    except subprocess.CalledProcessError:
+      if self.Up != False:
+        self.Up = False
+        leds().set("wifi", "heartbeat")
+      self.timeout = self.timeout - 1
+      if self.timeout < 0:
+        self.stop()
+        return
+      reconnects.inc()
+      self.reconnect = subprocess.Popen("ifdown wlan0; ifup wlan0",
+                                        shell = True)
+    else:
+      if self.Up != True:
+        self.Up = True
+        leds().set("wifi", "solid")
 
   def stop(self):
     print "In stop"
     if self.running == True:
       self.running = False
+      if self.job is not None:
+        self.job.cancel()
+        self.job = None
+      if self.reconnect is not None and self.reconnect.poll() is None:
+        self.reconnect.terminate()
       print "Taking down interface"
-      os.system("ifdown wlan0")
+      # Checks after a restart wait for this like for a reconnect
+      self.reconnect = subprocess.Popen("ifdown wlan0", shell = True)
       self.Up = False
-    os.system("echo none > /sys/class/leds/beaglebone\:green\:usr3/trigger")
+    leds().set("wifi", "off")